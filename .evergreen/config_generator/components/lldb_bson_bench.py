@@ -0,0 +1,33 @@
+from shrub.v3.evg_command import EvgCommandType
+from shrub.v3.evg_task import EvgTask
+
+from config_generator.etc.function import Function
+from config_generator.etc.utils import bash_exec
+
+
+class LldbBsonBench(Function):
+    name = 'lldb-bson-bench'
+    commands = [
+        bash_exec(
+            command_type=EvgCommandType.TEST,
+            working_dir='mongoc',
+            script='python3 lldb_bson_bench.py --quick --compare lldb_bson_bench_baseline.json --max-regression 1.0',
+        ),
+    ]
+
+    @classmethod
+    def call(cls, **kwargs):
+        return cls.default_call(**kwargs)
+
+
+def functions():
+    return LldbBsonBench.defn()
+
+
+def tasks():
+    return [
+        EvgTask(
+            name=LldbBsonBench.name,
+            commands=[LldbBsonBench.call()],
+        )
+    ]
@@ -44,6 +44,7 @@ all_variants = [
         [
             "make-docs",
             "kms-divergence-check",
+            "lldb-bson-bench",
             "release-compile",
             "debug-compile-no-counters",
             "compile-tracing",
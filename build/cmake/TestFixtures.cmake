@@ -10,7 +10,7 @@ set (_MONGOC_PROC_CTL_COMMAND "$<TARGET_FILE:Python3::Interpreter>" -u -- "${_MO
 
 
 function (mongo_define_subprocess_fixture name)
-    cmake_parse_arguments(PARSE_ARGV 1 ARG "" "SPAWN_WAIT;STOP_WAIT;WORKING_DIRECTORY" "COMMAND")
+    cmake_parse_arguments(PARSE_ARGV 1 ARG "" "SPAWN_WAIT;STOP_WAIT;WORKING_DIRECTORY" "COMMAND;READY")
     string (MAKE_C_IDENTIFIER ident "${name}")
     if (NOT ARG_SPAWN_WAIT)
         set (ARG_SPAWN_WAIT 1)
@@ -31,6 +31,7 @@ function (mongo_define_subprocess_fixture name)
                 "--ctl-dir=${ctl_dir}"
                 "--cwd=${ARG_WORKING_DIRECTORY}"
                 "--spawn-wait=${ARG_SPAWN_WAIT}"
+                ${ARG_READY}
                 -- ${ARG_COMMAND})
     add_test (NAME "${name}/stop"
               COMMAND ${_MONGOC_PROC_CTL_COMMAND} stop "--ctl-dir=${ctl_dir}" --if-not-running=ignore)
@@ -41,7 +42,7 @@ endfunction ()
 # Create a fixture that runs a fake Azure IMDS server
 mongo_define_subprocess_fixture(
     mongoc/fixtures/fake_imds
-    SPAWN_WAIT 0.2
+    READY --ready-port=localhost:14987
     COMMAND
         "$<TARGET_FILE:Python3::Interpreter>" -u --
         "${_MONGOC_BUILD_SCRIPT_DIR}/bottle.py" fake_kms_provider_server:kms_provider
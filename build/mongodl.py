@@ -5,25 +5,41 @@ Use '--help' for more information.
 """
 import argparse
 import enum
+import errno
+import gzip
 import hashlib
+import http.client
+import io
 import json
+import multiprocessing
 import os
 import platform
+import posixpath
 import re
 import shutil
 import sqlite3
+import stat
 import sys
 import tarfile
 import tempfile
 import textwrap
+import threading
+import time
 import urllib.error
 import urllib.request
 import zipfile
-from collections import namedtuple
-from contextlib import contextmanager
+from collections import Counter, namedtuple
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+from contextlib import contextmanager, redirect_stdout
 from fnmatch import fnmatch
 from pathlib import Path, PurePath, PurePosixPath
 
+if sys.platform == 'win32':
+    import msvcrt
+else:
+    import fcntl
+
 DISTRO_ID_MAP = {
     'elementary': 'ubuntu',
     'fedora': 'rhel',
@@ -166,6 +182,35 @@ def cache_dir():
     return caches_root().joinpath('mongodl').absolute()
 
 
+@contextmanager
+def _file_lock(path):
+    """
+    Hold an exclusive lock on the file at 'path' (which is created if it does
+    not exist), to coordinate with other mongodl processes sharing the cache.
+    """
+    with path.open('a+b') as f:
+        if sys.platform == 'win32':
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after ten seconds. Keep waiting.
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
 @contextmanager
 def tmp_dir():
     tdir = tempfile.mkdtemp()
@@ -175,17 +220,111 @@ def tmp_dir():
         shutil.rmtree(tdir)
 
 
-def _import_json_data(db, json_file):
-    db.execute('DELETE FROM meta')
+# The version of the schema of the database. Increase this when changing it,
+# and the manifest tables will be recreated (and the manifest imported again).
+SCHEMA_VERSION = 3
+
+FULL_JSON_URL = 'https://downloads.mongodb.org/full.json'
+
+# The columns of the manifest tables, as written by '--export-manifest'
+MANIFEST_COLUMNS = (
+    ('versions', ('version_id', 'date', 'version', 'githash', 'data_hash')),
+    ('downloads', ('download_id', 'version_id', 'target', 'arch', 'edition',
+                   'ar_url')),
+    ('components', ('key', 'download_id', 'url', 'sha256', 'data')),
+)
+
+
+def _init_tables(db):
+    """
+    Create the database tables, replacing the manifest tables if they were
+    created for a different SCHEMA_VERSION.
+    """
+    schema_version, = next(iter(db.execute('PRAGMA user_version')))
+    if schema_version == SCHEMA_VERSION:
+        return
+    # Another process may be doing this at the same time, so check again once
+    # we have the database to ourselves:
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        schema_version, = next(iter(db.execute('PRAGMA user_version')))
+        if schema_version != SCHEMA_VERSION:
+            _create_cache_tables(db)
+            _create_manifest_tables(db)
+            db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    db.execute('COMMIT')
+
+
+def _create_cache_tables(db):
+    db.execute(r'''
+        CREATE TABLE IF NOT EXISTS url_cache (
+            url TEXT NOT NULL UNIQUE,
+            sha256 TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT
+        )
+    ''')
+    db.execute(r'''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT NOT NULL,
+            name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (sha256, name)
+        )
+    ''')
+    db.execute(r'''
+        CREATE INDEX IF NOT EXISTS blobs_by_last_used ON blobs (last_used)
+    ''')
+    db.execute(r'''
+        CREATE TABLE IF NOT EXISTS trees (
+            sha256 TEXT NOT NULL PRIMARY KEY,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        )
+    ''')
+    db.execute(r'''
+        CREATE INDEX IF NOT EXISTS trees_by_last_used ON trees (last_used)
+    ''')
+    db.execute(r'''
+        CREATE TABLE IF NOT EXISTS partial_downloads (
+            url TEXT NOT NULL UNIQUE,
+            etag TEXT,
+            last_modified TEXT,
+            size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            done_chunks TEXT NOT NULL
+        )
+    ''')
+
+
+def _create_manifest_tables(db):
+    db.execute('DROP TABLE IF EXISTS meta')
     db.execute('DROP TABLE IF EXISTS components')
     db.execute('DROP TABLE IF EXISTS downloads')
     db.execute('DROP TABLE IF EXISTS versions')
+    # 'data_hash' is a digest of the version's entry in the manifest, used to
+    # tell whether it needs to be imported again.
+    # 'checked_at' is the time.time() at which the manifest was last checked
+    # against the server.
+    db.execute(r'''
+        CREATE TABLE meta (
+            key TEXT PRIMARY KEY,
+            value
+        )
+    ''')
     db.execute(r'''
         CREATE TABLE versions (
             version_id INTEGER PRIMARY KEY,
             date TEXT NOT NULL,
             version TEXT NOT NULL,
-            githash TEXT NOT NULL
+            githash TEXT NOT NULL,
+            data_hash TEXT NOT NULL,
+            UNIQUE(version, githash)
         )
     ''')
     db.execute(r'''
@@ -195,56 +334,120 @@ def _import_json_data(db, json_file):
             target TEXT NOT NULL,
             arch TEXT NOT NULL,
             edition TEXT NOT NULL,
-            ar_url TEST NOT NULL,
-            data TEXT NOT NULL
+            ar_url TEXT NOT NULL
         )
     ''')
+    db.execute(r'''
+        CREATE INDEX downloads_by_version
+            ON downloads (version_id, target, arch, edition)
+    ''')
     db.execute(r'''
         CREATE TABLE components (
             component_id INTEGER PRIMARY KEY,
             key TEXT NOT NULL,
             download_id INTEGER NOT NULL REFERENCES downloads,
+            url TEXT NOT NULL,
+            sha256 TEXT,
             data TEXT NOT NULL,
-            UNIQUE(key, download_id)
+            UNIQUE(download_id, key)
         )
     ''')
+
+
+def _import_json_data(db, json_file):
+    """
+    Update the manifest tables from the 'full.json' manifest at 'json_file'.
+
+    Only the versions that were added, changed, or removed since the last
+    import are written.
+    """
     with json_file.open('r') as f:
         data = json.load(f)
+    known = {(version, githash): (version_id, data_hash)
+             for version_id, version, githash, data_hash in db.execute(
+                 'SELECT version_id, version, githash, data_hash FROM versions')}
+    next_version_id, next_download_id = next(
+        iter(
+            db.execute(r'''
+        VALUES(
+            (SELECT coalesce(max(version_id), 0) + 1 FROM versions),
+            (SELECT coalesce(max(download_id), 0) + 1 FROM downloads)
+        )
+        ''')))
+    seen = set()
+    stale_version_ids = []
+    version_rows = []
+    changed_version_rows = []
+    download_rows = []
+    component_rows = []
     for ver in data['versions']:
         version = ver['version']
         githash = ver['githash']
-        date = ver['date']
-        db.execute(
-            r'''
-            INSERT INTO versions (date, version, githash)
-            VALUES (?, ?, ?)
-            ''',
-            (date, version, githash),
-        )
-        version_id = db.lastrowid
+        if (version, githash) in seen:
+            # The manifest lists this version more than once. Keep the first.
+            continue
+        seen.add((version, githash))
+        data_hash = hashlib.sha1(
+            json.dumps(ver, sort_keys=True).encode('utf-8')).hexdigest()
+        prev = known.get((version, githash))
+        if prev is not None:
+            version_id, prev_hash = prev
+            if prev_hash == data_hash:
+                # Nothing has changed
+                continue
+            stale_version_ids.append(version_id)
+            changed_version_rows.append((ver['date'], data_hash, version_id))
+        else:
+            version_id = next_version_id
+            next_version_id += 1
+            version_rows.append(
+                (version_id, ver['date'], version, githash, data_hash))
         for dl in ver['downloads']:
-            arch = dl.get('arch', 'null')
-            target = dl.get('target', 'null')
-            edition = dl['edition']
-            ar_url = dl['archive']['url']
-            db.execute(
-                r'''
-                INSERT INTO downloads (version_id, target, arch, edition, ar_url, data)
-                VALUES (?, ?, ?, ?, ?, ?)
-                ''',
-                (version_id, target, arch, edition, ar_url, json.dumps(dl)),
-            )
-            dl_id = db.lastrowid
-            for key, data in dl.items():
-                if 'url' not in data:
+            download_id = next_download_id
+            next_download_id += 1
+            download_rows.append(
+                (download_id, version_id, dl.get('target', 'null'),
+                 dl.get('arch', 'null'), dl['edition'], dl['archive']['url']))
+            for key, comp in dl.items():
+                if not isinstance(comp, dict) or 'url' not in comp:
                     continue
-                db.execute(
-                    r'''
-                    INSERT INTO components (key, download_id, data)
-                    VALUES (?, ?, ?)
-                    ''',
-                    (key, dl_id, json.dumps(data)),
-                )
+                component_rows.append((key, download_id, comp['url'],
+                                       comp.get('sha256'), json.dumps(comp)))
+    removed_version_ids = [
+        version_id for key, (version_id, _) in known.items() if key not in seen
+    ]
+    stale_version_ids.extend(removed_version_ids)
+    stale = [(version_id, ) for version_id in stale_version_ids]
+    db.executemany(
+        r'''
+        DELETE FROM components
+        WHERE download_id IN (SELECT download_id FROM downloads WHERE version_id=?)
+        ''', stale)
+    db.executemany('DELETE FROM downloads WHERE version_id=?', stale)
+    db.executemany('DELETE FROM versions WHERE version_id=?',
+                   [(version_id, ) for version_id in removed_version_ids])
+    # Update changed versions in place, keeping their version_id, so that no
+    # row that refers to them is left behind:
+    db.executemany('UPDATE versions SET date=?, data_hash=? WHERE version_id=?',
+                   changed_version_rows)
+    db.executemany(
+        r'''
+        INSERT INTO versions (version_id, date, version, githash, data_hash)
+        VALUES (?, ?, ?, ?, ?)
+        ''', version_rows)
+    db.executemany(
+        r'''
+        INSERT INTO downloads (download_id, version_id, target, arch, edition, ar_url)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', download_rows)
+    db.executemany(
+        r'''
+        INSERT INTO components (key, download_id, url, sha256, data)
+        VALUES (?, ?, ?, ?, ?)
+        ''', component_rows)
+    print('Updated {} versions, removed {}'.format(
+        len(version_rows) + len(changed_version_rows),
+        len(removed_version_ids)))
 
 
 def _mkdir(dirpath):
@@ -265,35 +468,117 @@ def _mkdir(dirpath):
         pass
 
 
-def get_dl_db():
+def _open_dl_db():
     caches = cache_dir()
     _mkdir(caches)
-    db = sqlite3.connect(str(caches / 'downloads.db'), isolation_level=None)
-    db.executescript(r'''
-        CREATE TABLE IF NOT EXISTS meta (
-            etag TEXT,
-            last_modified TEXT
-        )
-    ''')
-    db.executescript(r'''
-        CREATE TABLE IF NOT EXISTS past_downloads (
-            url TEXT NOT NULL UNIQUE,
-            etag TEXT,
-            last_modified TEXT
+    # Other mongodl processes may be using the database at the same time, so
+    # wait for them rather than failing.
+    db = sqlite3.connect(str(caches / 'downloads.db'),
+                         isolation_level=None,
+                         timeout=60)
+    _init_tables(db)
+    return db
+
+
+def get_dl_db(max_age=None, offline=False, cache_limit=None):
+    """
+    Open the downloads database, and update the manifest from the server.
+
+    If 'offline' is true, or the manifest was checked less than 'max_age'
+    seconds ago, the server is not contacted. 'cache_limit' is passed on to
+    _download_file() for the download of the manifest.
+    """
+    db = _open_dl_db()
+    checked_at, have_manifest = next(
+        iter(
+            db.execute(r'''
+        VALUES(
+            (SELECT value FROM meta WHERE key='checked_at'),
+            EXISTS (SELECT 1 FROM versions)
         )
-    ''')
-    changed, full_json = _download_file(
-        db, 'https://downloads.mongodb.org/full.json')
-    if not changed:
+        ''')))
+    if have_manifest and offline:
+        return db
+    if (have_manifest and max_age is not None and checked_at is not None
+            and time.time() - checked_at < max_age):
+        return db
+    if offline:
+        raise RuntimeError(
+            'There is no downloads manifest in [{}], and "--offline" was '
+            'given. Use "--import-manifest" to load one.'.format(cache_dir()))
+    changed, full_json = _download_file(db,
+                                        FULL_JSON_URL,
+                                        cache_limit=cache_limit)
+    if not changed and have_manifest:
+        _set_meta(db, 'checked_at', time.time())
         return db
     with db:
         print('Refreshing downloads manifest ...')
         cur = db.cursor()
         cur.execute("begin")
         _import_json_data(cur, full_json)
+        _set_meta(cur, 'checked_at', time.time())
     return db
 
 
+def _set_meta(db, key, value):
+    db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+               (key, value))
+
+
+def _export_manifest(db, path):
+    """
+    Write the manifest tables to 'path', as gzipped JSON, for use with
+    _import_manifest().
+    """
+    checked_at = list(
+        db.execute("SELECT value FROM meta WHERE key='checked_at'"))
+    doc = {
+        'schema': SCHEMA_VERSION,
+        'checked_at': checked_at[0][0] if checked_at else None,
+    }
+    for table, columns in MANIFEST_COLUMNS:
+        doc[table] = [
+            list(row) for row in db.execute('SELECT {} FROM {}'.format(
+                ', '.join(columns), table))
+        ]
+    with gzip.open(str(path), 'wt', compresslevel=6, encoding='utf-8') as f:
+        json.dump(doc, f, separators=(',', ':'))
+    print('Exported {} versions to [{}] ({:.1f} MiB)'.format(
+        len(doc['versions']), path,
+        path.stat().st_size / (1024 * 1024)))
+
+
+def _import_manifest(db, path):
+    """
+    Replace the manifest tables with those written by _export_manifest().
+    """
+    with gzip.open(str(path), 'rt', encoding='utf-8') as f:
+        doc = json.load(f)
+    if doc.get('schema') != SCHEMA_VERSION:
+        raise RuntimeError(
+            '[{}] was exported by a different version of mongodl'.format(path))
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        for table, _ in reversed(MANIFEST_COLUMNS):
+            db.execute('DELETE FROM {}'.format(table))
+        for table, columns in MANIFEST_COLUMNS:
+            db.executemany(
+                'INSERT INTO {} ({}) VALUES ({})'.format(
+                    table, ', '.join(columns), ', '.join('?' * len(columns))),
+                doc[table])
+        if doc['checked_at'] is not None:
+            _set_meta(db, 'checked_at', doc['checked_at'])
+        # Our copy of full.json no longer matches the manifest tables, so do
+        # not ask whether it is current the next time we check:
+        db.execute('DELETE FROM url_cache WHERE url=?', [FULL_JSON_URL])
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    db.execute('COMMIT')
+    print('Imported {} versions from [{}]'.format(len(doc['versions']), path))
+
+
 def _print_list(db, version, target, arch, edition, component):
     if version or target or arch or edition or component:
         matching = db.execute(
@@ -369,53 +654,638 @@ def infer_arch():
 DLRes = namedtuple('DLRes', ['is_changed', 'path'])
 
 
-def _download_file(db, url):
-    caches = cache_dir()
+# Files at least this large are downloaded in pieces using HTTP Range requests,
+# so that they can be fetched over several connections and resumed if the
+# download is interrupted.
+RANGED_DOWNLOAD_MIN_SIZE = 1024 * 1024 * 64
+# The size of each piece of a ranged download
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024 * 16
+# The number of times to try downloading each piece before giving up
+DOWNLOAD_ATTEMPTS = 3
+
+
+# Files that have been used more recently than this many seconds ago are never
+# evicted from the cache, since another process may be about to open them.
+EVICTION_GRACE_SECONDS = 60 * 10
+# Partial downloads that have not been touched for this many seconds are
+# deleted by '--gc'
+STALE_PARTIAL_SECONDS = 60 * 60 * 24 * 7
+
+
+def _download_file(db,
+                   url,
+                   sha256=None,
+                   jobs=1,
+                   cache_limit=None,
+                   stream=None,
+                   offline=False):
+    """
+    Download the file at 'url' into the cache, unless the cached copy is still
+    current.
+
+    Downloaded files are stored by their SHA-256 digest. If 'sha256' is given
+    and a file with that digest is cached, it is used without contacting the
+    server. Otherwise the file is written to a '.part' file, which is moved
+    into the cache only after its size (and its digest, if 'sha256' is given)
+    has been checked. Large files are downloaded with up to 'jobs' connections.
+
+    If 'cache_limit' is given, least-recently-used files are then evicted until
+    the cache is no larger than 'cache_limit' bytes.
+
+    If 'stream' is given, it is a _DownloadStream that is kept up to date as
+    the file is downloaded.
+
+    If 'offline' is true, the file must already be cached.
+    """
+    name = PurePosixPath(url).name
+    if sha256:
+        sha256 = sha256.lower()
+        cached = _lookup_blob(db, sha256, name)
+        if cached:
+            if stream is not None:
+                stream.complete(cached)
+            return DLRes(False, cached)
+    if offline:
+        info = list(
+            db.execute('SELECT sha256 FROM url_cache WHERE url=?', [url]))
+        cached = None
+        if info and (sha256 is None or info[0][0] == sha256):
+            cached = _lookup_blob(db, info[0][0], name)
+        if cached is None:
+            raise RuntimeError(
+                '[{}] has not been downloaded, and "--offline" was '
+                'given'.format(url))
+        if stream is not None:
+            stream.complete(cached)
+        return DLRes(False, cached)
+    partial_dir = cache_dir() / 'partial'
+    _mkdir(partial_dir)
+    key = hashlib.md5(url.encode("utf-8")).hexdigest()[:8]
+    part = partial_dir / '{}-{}.part'.format(key, name)
+    with _file_lock(partial_dir / '{}.lock'.format(key)):
+        res = _download_file_locked(db, url, name, part, sha256, jobs, stream)
+    if stream is not None:
+        stream.complete(res.path)
+    if res.is_changed and cache_limit is not None:
+        _evict_cache(db, cache_limit)
+    return res
+
+
+def _download_file_locked(db, url, name, part, sha256, jobs, stream):
+    if sha256:
+        # Another process may have downloaded it while we waited for the lock
+        cached = _lookup_blob(db, sha256, name)
+        if cached:
+            return DLRes(False, cached)
+    etag = None
+    modtime = None
+    cached = None
     info = list(
         db.execute(
-            'SELECT etag, last_modified FROM past_downloads WHERE url=?',
+            'SELECT sha256, etag, last_modified FROM url_cache WHERE url=?',
             [url]))
-    etag = None
-    modtime = None
-    if info:
-        etag, modtime = info[0]
+    # If we know what digest we want, there is no point asking whether the file
+    # we have (which has some other digest) is current.
+    if info and not sha256:
+        cached = _lookup_blob(db, info[0][0], name)
+        if cached:
+            etag, modtime = info[0][1:]
     headers = {}
     if etag:
         headers['If-None-Match'] = etag
     if modtime:
         headers['If-Modified-Since'] = modtime
     req = urllib.request.Request(url, headers=headers)
-    digest = hashlib.md5(url.encode("utf-8")).hexdigest()[:4]
-    dest = caches / 'files' / digest / PurePosixPath(url).name
     try:
         resp = urllib.request.urlopen(req)
     except urllib.error.HTTPError as e:
-        if e.code != 304:
+        if e.code != 304 or cached is None:
             raise
-        return DLRes(False, dest)
-    else:
-        print('Downloading [{}] ...'.format(url))
-        _mkdir(dest.parent)
+        return DLRes(False, cached)
+    with resp:
         got_etag = resp.getheader("ETag")
         got_modtime = resp.getheader('Last-Modified')
-        with dest.open('wb') as of:
-            buf = resp.read(1024 * 1024 * 4)
-            while buf:
-                of.write(buf)
+        size = resp.getheader('Content-Length')
+        size = int(size) if size is not None else None
+        if (size is not None and size >= RANGED_DOWNLOAD_MIN_SIZE
+                and resp.getheader('Accept-Ranges') == 'bytes'):
+            # We'll request the pieces separately
+            resp.close()
+            _download_ranges(db, url, part, got_etag, got_modtime, size, jobs,
+                             stream)
+        else:
+            print('Downloading [{}] ...'.format(url))
+            with part.open('wb') as of:
+                if stream is not None:
+                    stream.begin(part)
+                nbytes = 0
                 buf = resp.read(1024 * 1024 * 4)
-        db.execute(
-            'INSERT OR REPLACE INTO past_downloads (url, etag, last_modified) VALUES (?, ?, ?)',
-            (url, got_etag, got_modtime))
+                while buf:
+                    of.write(buf)
+                    nbytes += len(buf)
+                    if stream is not None:
+                        of.flush()
+                        stream.advance(nbytes)
+                    buf = resp.read(1024 * 1024 * 4)
+    try:
+        got_sha256 = _check_download(part, size, sha256)
+    except RuntimeError:
+        # Don't try to resume from a bad file
+        part.unlink()
+        db.execute('DELETE FROM partial_downloads WHERE url=?', [url])
+        raise
+    dest = _store_blob(db, part, got_sha256, name)
+    db.execute('DELETE FROM partial_downloads WHERE url=?', [url])
+    db.execute(
+        'INSERT OR REPLACE INTO url_cache (url, sha256, etag, last_modified) VALUES (?, ?, ?, ?)',
+        (url, got_sha256, got_etag, got_modtime))
     return DLRes(True, dest)
 
 
-def _dl_component(db, out_dir, version, target, arch, edition, component,
-                  pattern, strip_components, test):
+def _download_ranges(db, url, part, etag, modtime, size, jobs, stream=None):
+    """
+    Download the 'size' bytes at 'url' into 'part' in pieces of
+    DOWNLOAD_CHUNK_SIZE, using up to 'jobs' connections.
+
+    The pieces that have been written are recorded in the 'partial_downloads'
+    table, so that an interrupted download can skip them when it is retried,
+    provided the file on the server has not changed.
+
+    If 'stream' is given, it is advanced as each leading piece is completed.
+    """
+    chunk_size = DOWNLOAD_CHUNK_SIZE
+    nchunks = (size + chunk_size - 1) // chunk_size
+    prev = list(
+        db.execute(
+            r'''
+            SELECT done_chunks FROM partial_downloads
+            WHERE url=? AND etag IS ? AND last_modified IS ? AND size=? AND chunk_size=?
+            ''', (url, etag, modtime, size, chunk_size)))
+    if prev and part.is_file() and part.stat().st_size == size:
+        done = set(json.loads(prev[0][0]))
+    else:
+        done = set()
+        with part.open('wb') as of:
+            of.truncate(size)
+        db.execute(
+            r'''
+            INSERT OR REPLACE INTO partial_downloads
+                (url, etag, last_modified, size, chunk_size, done_chunks)
+            VALUES (?, ?, ?, ?, ?, '[]')
+            ''', (url, etag, modtime, size, chunk_size))
+    pending = [n for n in range(nchunks) if n not in done]
+    if done:
+        print('Resuming download of [{}] ({} of {} pieces remain) ...'.format(
+            url, len(pending), nchunks))
+    else:
+        print('Downloading [{}] ...'.format(url))
+    # The number of leading pieces that are complete
+    n_leading = 0
+    while n_leading in done:
+        n_leading += 1
+    if stream is not None:
+        stream.begin(part)
+        stream.advance(min(size, n_leading * chunk_size))
+    # Only a strong ETag lets the server reject a range of a changed file
+    validator = etag if etag and not etag.startswith('W/') else modtime
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        futs = {
+            pool.submit(_download_range, url, part, n * chunk_size,
+                        min(size, (n + 1) * chunk_size), validator): n
+            for n in pending
+        }
+        try:
+            for fut in as_completed(futs):
+                fut.result()
+                done.add(futs[fut])
+                db.execute(
+                    'UPDATE partial_downloads SET done_chunks=? WHERE url=?',
+                    (json.dumps(sorted(done)), url))
+                while n_leading in done:
+                    n_leading += 1
+                if stream is not None:
+                    stream.advance(min(size, n_leading * chunk_size))
+        except BaseException:
+            for fut in futs:
+                fut.cancel()
+            raise
+
+
+def _download_range(url, part, start, end, validator):
+    """
+    Download the bytes from 'start' up to 'end' of the file at 'url', and write
+    them at the same position in 'part'.
+    """
+    headers = {'Range': 'bytes={}-{}'.format(start, end - 1)}
+    if validator:
+        headers['If-Range'] = validator
+    req = urllib.request.Request(url, headers=headers)
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        try:
+            with urllib.request.urlopen(req) as resp, part.open('r+b') as of:
+                if resp.getcode() != 206:
+                    raise RuntimeError(
+                        'The file at [{}] changed while it was being '
+                        'downloaded. Try again.'.format(url))
+                of.seek(start)
+                remaining = end - start
+                while remaining:
+                    buf = resp.read(min(remaining, 1024 * 1024))
+                    if not buf:
+                        raise http.client.IncompleteRead(b'', remaining)
+                    of.write(buf)
+                    remaining -= len(buf)
+            return
+        except (OSError, http.client.HTTPException):
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+
+
+def _check_download(path, size, sha256):
+    """
+    Check that the downloaded file at 'path' has the expected size and SHA-256
+    digest. Either may be None to skip that check.
+
+    :return: The SHA-256 digest of the file, as a hex string.
+    """
+    got_size = path.stat().st_size
+    if size is not None and got_size != size:
+        raise RuntimeError(
+            'Download of [{}] is incomplete: Expected {} bytes, but got {}'.format(
+                path.name, size, got_size))
+    got_sha256 = _file_sha256(path)
+    if sha256 is not None and got_sha256 != sha256:
+        raise RuntimeError(
+            'Download of [{}] is corrupt: Expected SHA-256 {}, but got {}'.format(
+                path.name, sha256, got_sha256))
+    return got_sha256
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with path.open('rb') as f:
+        buf = f.read(1024 * 1024 * 4)
+        while buf:
+            h.update(buf)
+            buf = f.read(1024 * 1024 * 4)
+    return h.hexdigest()
+
+
+def _blob_path(sha256, name):
+    """
+    Get the path at which the file 'name' with the given SHA-256 digest is
+    stored in the cache. The name is kept so that the file extension can be
+    used to tell how to expand the archive.
+    """
+    return cache_dir() / 'blobs' / sha256 / name
+
+
+def _lookup_blob(db, sha256, name):
+    """
+    Get the path of the cached file 'name' with the given SHA-256 digest, or
+    None if there is no such file, and mark it as recently used.
+
+    If the file has been modified since it was stored, its digest is checked
+    again, and the file is discarded if it no longer matches.
+    """
+    found = list(
+        db.execute(
+            'SELECT size, mtime_ns FROM blobs WHERE sha256=? AND name=?',
+            (sha256, name)))
+    if not found:
+        return None
+    size, mtime_ns = found[0]
+    path = _blob_path(sha256, name)
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        db.execute('DELETE FROM blobs WHERE sha256=? AND name=?',
+                   (sha256, name))
+        return None
+    if st.st_size != size or st.st_mtime_ns != mtime_ns:
+        if st.st_size != size or _file_sha256(path) != sha256:
+            print('Discarding modified cache file [{}]'.format(path))
+            _remove_blob(db, sha256, name)
+            return None
+        db.execute('UPDATE blobs SET mtime_ns=? WHERE sha256=? AND name=?',
+                   (st.st_mtime_ns, sha256, name))
+    db.execute('UPDATE blobs SET last_used=? WHERE sha256=? AND name=?',
+               (time.time(), sha256, name))
+    return path
+
+
+def _store_blob(db, part, sha256, name):
+    """
+    Move the downloaded file 'part', which has the given SHA-256 digest, into
+    the cache as 'name'.
+
+    :return: The path of the cached file.
+    """
+    dest = _blob_path(sha256, name)
+    with _file_lock(cache_dir() / 'blobs.lock'):
+        _mkdir(dest.parent)
+        os.replace(str(part), str(dest))
+        st = dest.stat()
+        db.execute(
+            r'''
+            INSERT OR REPLACE INTO blobs (sha256, name, size, mtime_ns, last_used)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (sha256, name, st.st_size, st.st_mtime_ns, time.time()))
+    return dest
+
+
+def _remove_blob(db, sha256, name):
+    """
+    Delete a file from the cache.
+
+    :return: Whether the file was deleted. A file that is in use cannot be
+        deleted on Windows.
+    """
+    path = _blob_path(sha256, name)
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return False
+    try:
+        path.parent.rmdir()
+    except OSError:
+        # Other files with the same content remain
+        pass
+    db.execute('DELETE FROM blobs WHERE sha256=? AND name=?', (sha256, name))
+    return True
+
+
+def _evict_cache(db, limit):
+    """
+    Delete the least-recently-used files and expanded archives from the cache
+    until it is no larger than 'limit' bytes. Those used within the last
+    EVICTION_GRACE_SECONDS are kept, even if the cache remains over the limit.
+
+    :return: The number of items and the number of bytes that were deleted.
+    """
+    n_removed = 0
+    n_bytes = 0
+    with _file_lock(cache_dir() / 'blobs.lock'):
+        total, = next(
+            iter(
+                db.execute(r'''
+            VALUES(
+                (SELECT coalesce(sum(size), 0) FROM blobs)
+                + (SELECT coalesce(sum(size), 0) FROM trees)
+            )
+            ''')))
+        if total <= limit:
+            return n_removed, n_bytes
+        grace = time.time() - EVICTION_GRACE_SECONDS
+        # Expanded archives have no name
+        candidates = list(
+            db.execute(
+                r'''
+                SELECT sha256, name, size, last_used FROM blobs
+                WHERE last_used < :grace
+                UNION ALL
+                SELECT sha256, NULL, size, last_used FROM trees
+                WHERE last_used < :grace
+                ORDER BY last_used
+                ''', dict(grace=grace)))
+        for sha256, name, size, _ in candidates:
+            if total - n_bytes <= limit:
+                break
+            if name is None:
+                removed = _remove_tree(db, sha256)
+            else:
+                removed = _remove_blob(db, sha256, name)
+            if removed:
+                n_removed += 1
+                n_bytes += size
+    return n_removed, n_bytes
+
+
+def _gc_cache(db, limit):
+    """
+    Tidy the download cache: Forget about files that have gone missing, delete
+    files that are not recorded in the database, delete stale partial
+    downloads, and then evict files until the cache is within 'limit' bytes.
+    """
+    caches = cache_dir()
+    n_removed = 0
+    n_bytes = 0
+    with _file_lock(caches / 'blobs.lock'):
+        known = set()
+        for sha256, name in list(db.execute('SELECT sha256, name FROM blobs')):
+            if _blob_path(sha256, name).is_file():
+                known.add(sha256)
+            else:
+                db.execute('DELETE FROM blobs WHERE sha256=? AND name=?',
+                           (sha256, name))
+        blobs_dir = caches / 'blobs'
+        if blobs_dir.is_dir():
+            for child in blobs_dir.iterdir():
+                if child.name not in known:
+                    n_bytes += sum(f.stat().st_size for f in child.glob('*'))
+                    shutil.rmtree(str(child), ignore_errors=True)
+                    n_removed += 1
+        known = set()
+        for sha256, in list(db.execute('SELECT sha256 FROM trees')):
+            if _tree_path(sha256).is_dir():
+                known.add(sha256)
+            else:
+                db.execute('DELETE FROM trees WHERE sha256=?', [sha256])
+        trees_dir = caches / 'trees'
+        stale = time.time() - STALE_PARTIAL_SECONDS
+        if trees_dir.is_dir():
+            for child in trees_dir.iterdir():
+                if child.name in known or child.suffix == '.lock':
+                    continue
+                # Another process may be filling in a '.tmp' directory
+                if child.suffix == '.tmp' and child.stat().st_mtime >= stale:
+                    continue
+                n_bytes += _tree_size(child)
+                _rmtree(child)
+                n_removed += 1
+    partial_dir = caches / 'partial'
+    if partial_dir.is_dir():
+        for part in partial_dir.glob('*.part'):
+            st = part.stat()
+            if st.st_mtime < stale:
+                part.unlink()
+                n_removed += 1
+                n_bytes += st.st_size
+    # Files downloaded by older versions of mongodl
+    legacy_dir = caches / 'files'
+    if legacy_dir.is_dir():
+        for f in legacy_dir.glob('**/*'):
+            if f.is_file():
+                n_removed += 1
+                n_bytes += f.stat().st_size
+        shutil.rmtree(str(legacy_dir), ignore_errors=True)
+    evicted, evicted_bytes = _evict_cache(db, limit)
+    n_removed += evicted
+    n_bytes += evicted_bytes
+    total, count, n_trees = next(
+        iter(
+            db.execute(r'''
+        VALUES(
+            (SELECT coalesce(sum(size), 0) FROM blobs)
+            + (SELECT coalesce(sum(size), 0) FROM trees),
+            (SELECT count(*) FROM blobs),
+            (SELECT count(*) FROM trees)
+        )
+        ''')))
+    print('Removed {} items ({:.1f} MiB). The cache now holds {} files and {} '
+          'expanded archives ({:.1f} MiB).'.format(n_removed,
+                                                   n_bytes / (1024 * 1024),
+                                                   count, n_trees,
+                                                   total / (1024 * 1024)))
+
+
+def _tree_path(sha256):
+    """
+    Get the path of the cached expansion of the archive with the given SHA-256
+    digest.
+    """
+    return cache_dir() / 'trees' / sha256
+
+
+def _lookup_tree(db, sha256):
+    """
+    Get the path of the cached expansion of the archive with the given SHA-256
+    digest, or None if there is none, and mark it as recently used.
+    """
+    found = list(db.execute('SELECT 1 FROM trees WHERE sha256=?', [sha256]))
+    if not found:
+        return None
+    tree = _tree_path(sha256)
+    if not tree.is_dir():
+        db.execute('DELETE FROM trees WHERE sha256=?', [sha256])
+        return None
+    db.execute('UPDATE trees SET last_used=? WHERE sha256=?',
+               (time.time(), sha256))
+    return tree
+
+
+def _ensure_tree(db, sha256, fill, cache_limit=None):
+    """
+    Get the path of the cached expansion of the archive with the given SHA-256
+    digest. If there is none, 'fill(dirpath)' is called to expand the whole
+    archive into 'dirpath', which is then added to the cache.
+    """
+    tree = _lookup_tree(db, sha256)
+    if tree is not None:
+        return tree
+    trees_dir = cache_dir() / 'trees'
+    _mkdir(trees_dir)
+    with _file_lock(trees_dir / '{}.lock'.format(sha256)):
+        # Another process may have expanded it while we waited for the lock
+        tree = _lookup_tree(db, sha256)
+        if tree is not None:
+            return tree
+        tmp = trees_dir / '{}.tmp'.format(sha256)
+        _rmtree(tmp)
+        fill(tmp)
+        # (The archive may have been empty)
+        _mkdir(tmp)
+        # The files may be hard-linked into other directories, where they
+        # should not be modified:
+        for root, _, files in os.walk(str(tmp)):
+            for f in files:
+                path = os.path.join(root, f)
+                if os.path.islink(path):
+                    # chmod() would change the file that it points to
+                    continue
+                os.chmod(path, stat.S_IMODE(os.lstat(path).st_mode) & ~0o222)
+        tree = _tree_path(sha256)
+        with _file_lock(cache_dir() / 'blobs.lock'):
+            _rmtree(tree)
+            os.replace(str(tmp), str(tree))
+            db.execute(
+                'INSERT OR REPLACE INTO trees (sha256, size, last_used) VALUES (?, ?, ?)',
+                (sha256, _tree_size(tree), time.time()))
+    if cache_limit is not None:
+        _evict_cache(db, cache_limit)
+    return tree
+
+
+def _remove_tree(db, sha256):
+    """
+    Delete an expanded archive from the cache.
+
+    :return: Whether it was deleted.
+    """
+    try:
+        _rmtree(_tree_path(sha256))
+    except OSError:
+        return False
+    db.execute('DELETE FROM trees WHERE sha256=?', [sha256])
+    return True
+
+
+def _tree_size(tree):
+    size = 0
+    for root, _, files in os.walk(str(tree)):
+        size += sum(os.lstat(os.path.join(root, f)).st_size for f in files)
+    return size
+
+
+def _rmtree(path):
+    """
+    Delete the directory 'path' and everything in it, if it exists. Files in
+    expanded archives are read-only, which prevents deleting them on Windows.
+    """
+
+    def make_writable(func, failed, _exc_info):
+        os.chmod(failed, stat.S_IWRITE)
+        func(failed)
+
+    if path.exists():
+        shutil.rmtree(str(path), onerror=make_writable)
+
+
+def _parse_duration(s):
+    """
+    Parse a duration in seconds, with an optional 's', 'm', 'h' or 'd' suffix.
+    """
+    mat = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*$', s, re.I)
+    if not mat:
+        raise argparse.ArgumentTypeError('Invalid duration: "{}"'.format(s))
+    scale = {'': 1, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24}
+    return float(mat.group(1)) * scale[mat.group(2).lower()]
+
+
+def _parse_size(s):
+    """
+    Parse a size in bytes, with an optional 'K', 'M', 'G' or 'T' suffix (in
+    powers of 1024).
+    """
+    mat = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', s, re.I)
+    if not mat:
+        raise argparse.ArgumentTypeError('Invalid size: "{}"'.format(s))
+    scale = 1024**' KMGT'.index(mat.group(2).upper() or ' ')
+    return int(float(mat.group(1)) * scale)
+
+
+def _dl_component(db,
+                  out_dir,
+                  version,
+                  target,
+                  arch,
+                  edition,
+                  component,
+                  pattern,
+                  strip_components,
+                  test,
+                  jobs=1,
+                  cache_limit=None,
+                  offline=False,
+                  link_mode='auto',
+                  exclude=()):
     print('Download {} v{}-{} for {}-{}'.format(component, version, edition,
                                                 target, arch))
     matching = db.execute(
         r'''
-        SELECT components.data
+        SELECT url, sha256
         FROM
             components,
             downloads USING(download_id),
@@ -439,13 +1309,464 @@ def _dl_component(db, out_dir, version, target, arch, edition, component,
             'No download for "{}" was found for '
             'the requested version+target+architecture+edition'.format(
                 component))
-    data = json.loads(found[0][0])
-    cached = _download_file(db, data['url']).path
+    url, sha256 = found[0]
+    if test or not sha256:
+        return _fetch_and_expand(db,
+                                 url,
+                                 sha256,
+                                 out_dir,
+                                 pattern,
+                                 strip_components,
+                                 test=test,
+                                 jobs=jobs,
+                                 cache_limit=cache_limit,
+                                 offline=offline,
+                                 exclude=exclude)
+    tree = _ensure_tree(
+        db, sha256, lambda tmp: _fetch_and_expand(db,
+                                                  url,
+                                                  sha256,
+                                                  tmp,
+                                                  None,
+                                                  0,
+                                                  test=False,
+                                                  jobs=jobs,
+                                                  cache_limit=cache_limit,
+                                                  offline=offline,
+                                                  quiet=True),
+        cache_limit=cache_limit)
+    return _place_tree(tree,
+                       PurePosixPath(url).name,
+                       out_dir,
+                       pattern,
+                       strip_components,
+                       link_mode=link_mode,
+                       exclude=exclude)
+
+
+def _fetch_and_expand(db,
+                      url,
+                      sha256,
+                      out_dir,
+                      pattern,
+                      strip_components,
+                      test,
+                      jobs,
+                      cache_limit,
+                      offline,
+                      quiet=False,
+                      exclude=()):
+    """
+    Download the archive at 'url' (if it is not cached) and expand it into
+    'out_dir'.
+    """
+    # A file that is open cannot be renamed on Windows, so we cannot read the
+    # file while it is being downloaded there.
+    if url.endswith('.tgz') and sys.platform != 'win32':
+        return _download_and_expand(db,
+                                    url,
+                                    sha256,
+                                    out_dir,
+                                    pattern,
+                                    strip_components,
+                                    test=test,
+                                    jobs=jobs,
+                                    cache_limit=cache_limit,
+                                    offline=offline,
+                                    quiet=quiet,
+                                    exclude=exclude)
+    cached = _download_file(db,
+                            url,
+                            sha256=sha256,
+                            jobs=jobs,
+                            cache_limit=cache_limit,
+                            offline=offline).path
     return _expand_archive(cached,
                            out_dir,
                            pattern,
                            strip_components,
-                           test=test)
+                           test=test,
+                           quiet=quiet,
+                           exclude=exclude)
+
+
+def _download_and_expand(db,
+                         url,
+                         sha256,
+                         out_dir,
+                         pattern,
+                         strip_components,
+                         test,
+                         jobs,
+                         cache_limit,
+                         offline=False,
+                         quiet=False,
+                         exclude=()):
+    """
+    Download a .tgz archive and expand it at the same time. The archive is
+    expanded on another thread, reading the file as it is downloaded.
+    """
+    stream = _DownloadStream()
+    outcome = []
+
+    def expand():
+        try:
+            outcome.append(
+                _expand_archive(PurePosixPath(url),
+                                out_dir,
+                                pattern,
+                                strip_components,
+                                test=test,
+                                fileobj=stream,
+                                quiet=quiet,
+                                exclude=exclude))
+        except BaseException as e:
+            outcome.append(e)
+        finally:
+            stream.close()
+
+    expander = threading.Thread(target=expand, daemon=True)
+    expander.start()
+    try:
+        _download_file(db,
+                       url,
+                       sha256=sha256,
+                       jobs=jobs,
+                       cache_limit=cache_limit,
+                       stream=stream,
+                       offline=offline)
+    except BaseException as e:
+        stream.fail(e)
+        expander.join()
+        if outcome and not isinstance(outcome[0], BaseException):
+            print('NOTE: The files extracted into [{}] came from a bad '
+                  'download, and must not be used'.format(out_dir))
+        raise
+    expander.join()
+    if isinstance(outcome[0], BaseException):
+        raise outcome[0]
+    return outcome[0]
+
+
+class _DownloadStream:
+    """
+    A readable file object for a file that is still being downloaded. Reads
+    wait until the data they need has been written, so that the file can be
+    consumed while it is being downloaded.
+
+    The downloading thread calls begin(), advance(), and then complete() or
+    fail().
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._path = None
+        self._file = None
+        self._available = 0
+        self._complete = False
+        self._error = None
+        self._pos = 0
+
+    def begin(self, path):
+        """The download has started writing to 'path'"""
+        # Open it now, while it is known to exist: Once it is complete, it is
+        # moved into the cache (and it remains readable after being moved).
+        f = path.open('rb')
+        with self._cond:
+            self._file = f
+            self._cond.notify_all()
+
+    def advance(self, available):
+        """The first 'available' bytes of the file have been written"""
+        with self._cond:
+            if available > self._available:
+                self._available = available
+                self._cond.notify_all()
+
+    def complete(self, path):
+        """The download has finished, and the file is now at 'path'"""
+        with self._cond:
+            self._path = path
+            self._complete = True
+            self._cond.notify_all()
+
+    def fail(self, error):
+        """The download failed with the given exception"""
+        with self._cond:
+            self._error = error
+            self._cond.notify_all()
+
+    def read(self, size=-1):
+        with self._cond:
+            while True:
+                if self._error is not None:
+                    raise RuntimeError('The download failed: {}'.format(
+                        self._error))
+                if self._complete:
+                    limit = None
+                    break
+                if self._file is not None and self._pos < self._available:
+                    limit = self._available - self._pos
+                    break
+                self._cond.wait()
+            if self._file is None:
+                # It was already downloaded, so begin() was never called
+                self._file = self._path.open('rb')
+        if limit is not None and (size < 0 or size > limit):
+            size = limit
+        buf = self._file.read(size)
+        self._pos += len(buf)
+        return buf
+
+    def reopen(self):
+        """
+        Wait for the download to finish, and open the whole file again for
+        random access.
+        """
+        with self._cond:
+            while not self._complete:
+                if self._error is not None:
+                    raise RuntimeError('The download failed: {}'.format(
+                        self._error))
+                self._cond.wait()
+        return self._path.open('rb')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+BatchItem = namedtuple('BatchItem', [
+    'version', 'target', 'arch', 'edition', 'component', 'out', 'pattern',
+    'strip_components', 'exclude'
+])
+
+# The keys that may appear in each entry of a '--batch' file
+BATCH_KEYS = ('version', 'component', 'target', 'arch', 'edition', 'out',
+              'only', 'exclude', 'strip_components')
+
+
+def _load_batch(path,
+                target,
+                arch,
+                edition,
+                out,
+                pattern,
+                strip_components,
+                exclude=()):
+    """
+    Load the list of components to download from the '--batch' file at 'path'.
+
+    The file holds a list of objects (or an object with such a list as its
+    'downloads' key) with the keys in BATCH_KEYS. The other arguments are
+    the values to use for keys that an entry omits (or sets to null). "only"
+    and "exclude" may each be a single pattern or a list of them.
+
+    :return: A list of BatchItem.
+    """
+    text = path.read_text(encoding='utf-8')
+    if path.suffix in ('.yml', '.yaml'):
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError(
+                'PyYAML is required to read [{}]. Install it, or use a JSON '
+                'file instead.'.format(path))
+        data = yaml.safe_load(text)
+    else:
+        data = json.loads(text)
+    if isinstance(data, dict):
+        data = data.get('downloads')
+    if not isinstance(data, list):
+        raise ValueError(
+            '[{}] should contain a list of downloads, or an object with '
+            'a "downloads" list'.format(path))
+    items = []
+    for n, ent in enumerate(data, 1):
+        unknown = sorted(set(ent) - set(BATCH_KEYS))
+        if unknown:
+            raise ValueError('Download #{} in [{}] has unknown keys: {}'.format(
+                n, path, ', '.join(unknown)))
+        # A null value is the same as leaving the key out
+        ent = {key: value for key, value in ent.items() if value is not None}
+        for key in ('version', 'component'):
+            if key not in ent:
+                raise ValueError('Download #{} in [{}] has no "{}"'.format(
+                    n, path, key))
+        item_out = ent.get('out', out)
+        if item_out is None:
+            raise ValueError(
+                'Download #{} in [{}] has no "out", and no "--out" directory '
+                'was provided'.format(n, path))
+        items.append(
+            BatchItem(version=str(ent['version']),
+                      target=ent.get('target', target),
+                      arch=ent.get('arch', arch),
+                      edition=ent.get('edition', edition),
+                      component=ent['component'],
+                      out=Path(item_out).absolute(),
+                      pattern=ent.get('only', pattern),
+                      strip_components=int(
+                          ent.get('strip_components', strip_components)),
+                      exclude=ent.get('exclude', exclude)))
+    return items
+
+
+def _resolve_batch(db, items):
+    """
+    Find the URL and SHA-256 digest of the download for each of 'items', with
+    a single query.
+
+    :return: A list of (url, sha256) pairs, corresponding to 'items'.
+    """
+    db.execute(r'''
+        CREATE TEMP TABLE IF NOT EXISTS wanted (
+            n INTEGER PRIMARY KEY,
+            version TEXT NOT NULL,
+            target TEXT NOT NULL,
+            arch TEXT NOT NULL,
+            edition TEXT NOT NULL,
+            key TEXT NOT NULL
+        )
+    ''')
+    db.execute('DELETE FROM wanted')
+    db.executemany(
+        'INSERT INTO wanted VALUES (?, ?, ?, ?, ?, ?)',
+        [(n, it.version, it.target, it.arch, it.edition, it.component)
+         for n, it in enumerate(items)])
+    found = {}
+    for n, url, sha256 in db.execute(r'''
+            SELECT n, url, sha256
+            FROM
+                wanted
+                JOIN versions USING(version)
+                JOIN downloads USING(version_id, target, arch, edition)
+                JOIN components USING(download_id, key)
+            '''):
+        found.setdefault(n, (url, sha256))
+    missing = [it for n, it in enumerate(items) if n not in found]
+    if missing:
+        raise ValueError('No download was found for: {}'.format(', '.join(
+            '{} v{}-{} for {}-{}'.format(it.component, it.version, it.edition,
+                                         it.target, it.arch)
+            for it in missing)))
+    return [found[n] for n in range(len(items))]
+
+
+def _dl_batch(db,
+              items,
+              test,
+              parallel,
+              jobs,
+              cache_limit,
+              offline=False,
+              link_mode='auto'):
+    """
+    Download and extract each of the given BatchItems.
+
+    Up to 'parallel' files are downloaded at once. Each archive is extracted
+    in a worker process as soon as it has been downloaded (or placed from the
+    cache of expanded archives).
+
+    :return: A list of ExpandResult, corresponding to 'items'.
+    """
+    sources = _resolve_batch(db, items)
+    # SQLite connections cannot be shared between threads
+    local = threading.local()
+
+    def fetch(item, url, sha256):
+        if not hasattr(local, 'db'):
+            local.db = _open_dl_db()
+        ar = _download_file(local.db,
+                            url,
+                            sha256=sha256,
+                            jobs=jobs,
+                            cache_limit=cache_limit,
+                            offline=offline).path
+        if test or not sha256:
+            return expanders.submit(_expand_archive_captured, ar, item.out,
+                                    item.pattern, item.strip_components,
+                                    test, item.exclude).result()
+        tree = _ensure_tree(local.db,
+                            sha256,
+                            lambda tmp: expanders.submit(
+                                _expand_archive_captured, ar, tmp, None, 0,
+                                False).result(),
+                            cache_limit=cache_limit)
+        return expanders.submit(_place_tree_captured, tree, ar.name, item.out,
+                                item.pattern, item.strip_components,
+                                link_mode, item.exclude).result()
+
+    results = [None] * len(items)
+    with ThreadPoolExecutor(max(1, parallel)) as fetchers, \
+            _expander_pool() as expanders:
+        fetching = {
+            fetchers.submit(fetch, item, url, sha256): n
+            for n, (item, (url, sha256)) in enumerate(zip(items, sources))
+        }
+        for fut in as_completed(fetching):
+            res, output = fut.result()
+            # Print each archive's output in one piece, rather than mixed
+            # with the others
+            print(output, end='')
+            results[fetching[fut]] = ExpandResult(res)
+    return results
+
+
+def _expander_pool():
+    # Forking a process that is running other threads is unsafe, so start the
+    # workers afresh. (Python 3.6 has no 'mp_context', and will fork.)
+    try:
+        return ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context('spawn'))
+    except TypeError:
+        return ProcessPoolExecutor()
+
+
+def _expand_archive_captured(ar,
+                             dest,
+                             pattern,
+                             strip_components,
+                             test,
+                             exclude=()):
+    """
+    Call _expand_archive() in a worker process.
+
+    :return: The value of the ExpandResult, and the output that was printed.
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        res = _expand_archive(ar,
+                              dest,
+                              pattern,
+                              strip_components,
+                              test=test,
+                              exclude=exclude)
+    return res.value, output.getvalue()
+
+
+def _place_tree_captured(tree,
+                         name,
+                         dest,
+                         pattern,
+                         strip_components,
+                         link_mode,
+                         exclude=()):
+    """
+    Call _place_tree() in a worker process.
+
+    :return: The value of the ExpandResult, and the output that was printed.
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        res = _place_tree(tree,
+                          name,
+                          dest,
+                          pattern,
+                          strip_components,
+                          link_mode=link_mode,
+                          exclude=exclude)
+    return res.value, output.getvalue()
 
 
 def pathjoin(items):
@@ -455,39 +1776,102 @@ def pathjoin(items):
     return PurePath('/'.join(items))
 
 
-def _test_pattern(path, pattern):
+def _compile_pattern(pattern, exclude=()):
     """
-    Test whether the given 'path' string matches the globbing pattern 'pattern'.
+    Compile the globbing pattern 'pattern' (or a list of patterns) to a
+    function that tests whether an archive member path (given as a sequence of
+    path components) matches any of them, and none of the 'exclude' patterns.
 
     Supports the '**' pattern to match any number of intermediate directories.
+    A pattern that matches a directory also matches everything within it.
+
+    All of the patterns are combined into a single regular expression, so the
+    cost of testing a path does not grow with the number of patterns.
     """
+    patterns = _pattern_list(pattern)
+    excludes = _pattern_list(exclude)
+    if not patterns and not excludes:
+        return lambda parts: True
+    regex = ''
+    if excludes:
+        regex += '(?!{})'.format('|'.join(map(_pattern_regex, excludes)))
+    if patterns:
+        regex += '(?:{})'.format('|'.join(map(_pattern_regex, patterns)))
+    # fnmatch() is case-insensitive on Windows
+    flags = re.IGNORECASE if sys.platform == 'win32' else 0
+    match = re.compile(regex, flags).match
+    # The path is given a trailing '/' so that each component is followed by
+    # one, as it is in the regex:
+    return lambda parts: match(''.join(p + '/' for p in parts)) is not None
+
+
+def _pattern_list(pattern):
+    'Get a tuple of the patterns given as None, one pattern, or a list'
     if pattern is None:
-        return True
-    # Convert to path objects
-    path = PurePath(path)
-    pattern = PurePath(pattern)
-    # Split pattern into parts
-    pattern_parts = pattern.parts
-    if not pattern_parts:
-        # An empty pattern always matches
-        return True
-    path_parts = path.parts
-    if not path_parts:
-        # Non-empty pattern requires more path components
-        return False
-    pattern_head = pattern_parts[0]
-    pattern_tail = pathjoin(pattern_parts[1:])
-    if pattern_head == '**':
-        # Special "**" pattern matches and suffix of the path
-        # Generate each suffix:
-        tails = (path_parts[i:] for i in range(len(path_parts)))
-        # Test if any of the suffixes match the remainder of the pattern:
-        return any(_test_pattern(pathjoin(t), pattern_tail) for t in tails)
-    if not fnmatch(path.parts[0], pattern_head):
-        # Leading path component cannot match
-        return False
-    # The first component matches. Test the remainder:
-    return _test_pattern(pathjoin(path_parts[1:]), pattern_tail)
+        return ()
+    if isinstance(pattern, str):
+        return (pattern, )
+    return tuple(pattern)
+
+
+def _pattern_regex(pattern):
+    """
+    Translate the globbing pattern 'pattern' to a regular expression that
+    matches the start of a path that is given with a '/' after each component.
+    """
+    parts = PurePath(pattern).parts
+    regex = ''
+    for n, part in enumerate(parts):
+        if part != '**':
+            regex += _glob_part_regex(part) + '/'
+        elif n + 1 < len(parts):
+            # Any number of intermediate directories
+            regex += '(?:[^/]+/)*'
+        else:
+            # A trailing "**" matches anything within the directory, but not
+            # the directory itself
+            regex += '[^/]+/'
+    return regex
+
+
+def _glob_part_regex(part):
+    """
+    Translate one path component of a globbing pattern (as understood by
+    fnmatch) to a regular expression that matches within a single path
+    component.
+    """
+    out = []
+    i = 0
+    n = len(part)
+    while i < n:
+        c = part[i]
+        i += 1
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            end = i
+            if end < n and part[end] == '!':
+                end += 1
+            if end < n and part[end] == ']':
+                end += 1
+            while end < n and part[end] != ']':
+                end += 1
+            if end >= n:
+                # No closing bracket: It is just a character
+                out.append(re.escape(c))
+                continue
+            body = part[i:end]
+            i = end + 1
+            negate = body.startswith('!')
+            if negate:
+                body = body[1:]
+            body = re.sub(r'([\\\[\]^&~|])', r'\\\1', body)
+            out.append('[^/' + body + ']' if negate else '[' + body + ']')
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
 
 
 class ExpandResult(enum.Enum):
@@ -495,37 +1879,66 @@ class ExpandResult(enum.Enum):
     Okay = 1
 
 
-def _expand_archive(ar, dest, pattern, strip_components, test):
+def _expand_archive(ar,
+                    dest,
+                    pattern,
+                    strip_components,
+                    test,
+                    fileobj=None,
+                    quiet=False,
+                    exclude=()):
     '''
     Expand the archive members from 'ar' into 'dest'. If 'pattern' is not-None,
-    only extracts members that match the pattern.
+    only extracts members that match the pattern (or any of a list of them).
+    Members that match any of the 'exclude' patterns are not extracted. If
+    'fileobj' is given, the archive is read from it rather than from 'ar'. If
+    'quiet' is true, nothing is printed.
     '''
-    print('Extract from: [{}]'.format(ar.name))
-    print('        into: [{}]'.format(dest))
+    if not quiet:
+        print('Extract from: [{}]'.format(ar.name))
+        print('        into: [{}]'.format(dest))
+    matcher = _compile_pattern(pattern, exclude)
     if ar.suffix == '.zip':
         n_extracted = _expand_zip(ar,
                                   dest,
-                                  pattern,
+                                  matcher,
                                   strip_components,
-                                  test=test)
+                                  test=test,
+                                  quiet=quiet)
     elif ar.suffix == '.tgz':
         n_extracted = _expand_tgz(ar,
                                   dest,
-                                  pattern,
+                                  matcher,
                                   strip_components,
-                                  test=test)
+                                  test=test,
+                                  fileobj=fileobj,
+                                  quiet=quiet)
     else:
         raise RuntimeError('Unknown archive file extension: ' + ar.suffix)
+    if quiet:
+        return ExpandResult.Okay if n_extracted else ExpandResult.Empty
+    return _report_expanded(n_extracted,
+                            pattern,
+                            strip_components,
+                            test,
+                            exclude=exclude)
+
+
+def _report_expanded(n_extracted, pattern, strip_components, test, exclude=()):
     verb = 'would be' if test else 'were'
     if n_extracted == 0:
-        if pattern and strip_components:
+        filters = ['"--only={}"'.format(p) for p in _pattern_list(pattern)]
+        filters += ['"--exclude={}"'.format(p) for p in _pattern_list(exclude)]
+        if filters and strip_components:
             print('NOTE: No files {verb} extracted. Likely all files {verb} '
-                  'excluded by "--only={p}" and/or "--strip-components={s}"'.
-                  format(p=pattern, s=strip_components, verb=verb))
-        elif pattern:
+                  'excluded by {f} and/or "--strip-components={s}"'.format(
+                      f=', '.join(filters), s=strip_components, verb=verb))
+        elif filters:
             print('NOTE: No files {verb} extracted. Likely all files {verb} '
-                  'excluded by the "--only={p}" filter'.format(p=pattern,
-                                                               verb=verb))
+                  'excluded by the {f} filter{s}'.format(
+                      f=', '.join(filters),
+                      s='s' if len(filters) > 1 else '',
+                      verb=verb))
         elif strip_components:
             print('NOTE: No files {verb} extracted. Likely all files {verb} '
                   'excluded by "--strip-components={s}"'.format(
@@ -542,25 +1955,128 @@ def _expand_archive(ar, dest, pattern, strip_components, test):
         return ExpandResult.Okay
 
 
-def _expand_tgz(ar, dest, pattern, strip_components, test):
+def _expand_tgz(ar,
+                dest,
+                matcher,
+                strip_components,
+                test,
+                fileobj=None,
+                quiet=False):
     'Expand a tar.gz archive'
     n_extracted = 0
-    with tarfile.open(str(ar), 'r:*') as tf:
-        for mem in tf.getmembers():
+    # Read the archive as a stream, so that members are expanded as they are
+    # decompressed, rather than after a pass over the whole archive.
+    if fileobj is None:
+        with ar.open('rb') as f:
+            return _expand_tgz(ar, dest, matcher, strip_components, test, f,
+                               quiet)
+    out = dest
+    # The destinations of the members that have been written, by member name,
+    # for resolving hard links to them
+    written = {}
+    # Links that must be written with the content of the linked member, by
+    # destination
+    unresolved = {}
+    # The symbolic links that were created, by destination
+    symlinks = {}
+
+    def write(mem, dest):
+        if mem.issym():
+            _unlink(dest)
+            if _link_escapes(out, dest, mem.linkname):
+                # Never create a link that leads out of the destination
+                unresolved[dest] = mem
+                return
+            os.symlink(mem.linkname, str(dest))
+            symlinks[dest] = mem
+        elif mem.islnk():
+            # A stream cannot go back to the data of the linked member, so
+            # link to the file that it was written to.
+            target = written.get(mem.linkname)
+            if target is None:
+                unresolved[dest] = mem
+                return
+            _unlink(dest)
+            try:
+                os.link(str(target), str(dest))
+            except OSError:
+                _copy_file(target, dest)
+        else:
+            _write_member(tf.extractfile(mem), dest, mem.mode)
+        written[mem.name] = dest
+
+    with tarfile.open(fileobj=fileobj, mode='r|*',
+                      bufsize=1024 * 1024) as tf:
+        for mem in tf:
             n_extracted += _maybe_extract_member(
                 dest,
                 mem.name,
-                pattern,
+                matcher,
                 strip_components,
                 mem.isdir(),
-                lambda: tf.extractfile(mem),
-                mem.mode,
+                lambda dest: write(mem, dest),
                 test=test,
+                quiet=quiet,
             )
+    for dest, mem in symlinks.items():
+        if not os.path.exists(str(dest)):
+            # The linked member was excluded by the pattern or by
+            # --strip-components, so write its content in place of the link
+            unresolved[dest] = mem
+    if unresolved:
+        # Read the archive again, with random access to the linked members
+        reopen = getattr(fileobj, 'reopen', None)
+        with (reopen() if reopen else ar.open('rb')) as f:
+            _extract_linked_members(f, unresolved)
     return n_extracted
 
 
-def _expand_zip(ar, dest, pattern, strip_components, test):
+def _extract_linked_members(fileobj, links):
+    """
+    Write the links in 'links' (tar members, by destination path), whose
+    linked members were not extracted, with the content of the linked members
+    from the archive in 'fileobj'.
+    """
+    with tarfile.open(fileobj=fileobj, mode='r:*') as tf:
+        for dest, mem in links.items():
+            linked = None
+            if mem.islnk():
+                linked = mem.linkname
+            elif not PurePosixPath(mem.linkname).is_absolute():
+                linked = posixpath.normpath(
+                    posixpath.join(posixpath.dirname(mem.name),
+                                   mem.linkname))
+            try:
+                linked = tf.getmember(linked) if linked else None
+            except KeyError:
+                # The link does not lead to a member of the archive
+                linked = None
+            if linked is not None and linked.isfile():
+                # Use the mode of the linked member, since that of a symbolic
+                # link is meaningless
+                _write_member(tf.extractfile(linked), dest, linked.mode)
+            elif not os.path.lexists(str(dest)):
+                # The link was not created, since it leads out of the
+                # destination
+                raise RuntimeError(
+                    'Refusing to extract the link "{}" to "{}", which leads '
+                    'outside of the destination directory'.format(
+                        mem.name, mem.linkname))
+
+
+def _link_escapes(out, dest, linkname):
+    """
+    Whether a symbolic link at 'dest' to 'linkname' would lead outside of the
+    directory 'out'.
+    """
+    if os.path.isabs(linkname):
+        return True
+    root = os.path.realpath(str(out))
+    target = os.path.realpath(os.path.join(str(dest.parent), linkname))
+    return os.path.commonpath([root, target]) != root
+
+
+def _expand_zip(ar, dest, matcher, strip_components, test, quiet=False):
     'Expand a .zip archive.'
     n_extracted = 0
     with zipfile.ZipFile(ar, 'r') as zf:
@@ -568,48 +2084,239 @@ def _expand_zip(ar, dest, pattern, strip_components, test):
             n_extracted += _maybe_extract_member(
                 dest,
                 item.filename,
-                pattern,
+                matcher,
                 strip_components,
                 item.is_dir(),
-                lambda: zf.open(item, 'r'),
-                0o655,
+                lambda dest: _write_member(zf.open(item, 'r'), dest, 0o655),
                 test=test,
+                quiet=quiet,
             )
     return n_extracted
 
 
-def _maybe_extract_member(out, relpath, pattern, strip, is_dir, opener,
-                          modebits, test):
+def _maybe_extract_member(out,
+                          relpath,
+                          matcher,
+                          strip,
+                          is_dir,
+                          write,
+                          test,
+                          quiet=False):
     """
-    Try to extract an archive member according to the given arguments.
+    Try to extract an archive member according to the given arguments. The
+    member is written by calling 'write(dest)' with its destination path.
 
     :return: Zero if the file was excluded by filters, one otherwise.
     """
     relpath = PurePath(relpath)
-    print('  | {:-<65} |'.format(str(relpath) + ' '), end='')
+    if not quiet:
+        print('  | {:-<65} |'.format(str(relpath) + ' '), end='')
     if len(relpath.parts) <= strip:
         # Not enough path components
-        print(' (Excluded by --strip-components)')
+        if not quiet:
+            print(' (Excluded by --strip-components)')
         return 0
-    if not _test_pattern(relpath, pattern):
+    if not matcher(relpath.parts):
         # Doesn't match our pattern
-        print(' (excluded by pattern)')
+        if not quiet:
+            print(' (excluded by pattern)')
         return 0
     stripped = pathjoin(relpath.parts[strip:])
     dest = Path(out) / stripped
-    print('\n    -> [{}]'.format(dest))
+    if not quiet:
+        print('\n    -> [{}]'.format(dest))
     if test:
         # We are running in test-only mode: Do not do anything
         return 1
     if is_dir:
         _mkdir(dest)
         return 1
-    with opener() as infile:
-        _mkdir(dest.parent)
+    _mkdir(dest.parent)
+    write(dest)
+    return 1
+
+
+def _write_member(infile, dest, modebits):
+    with infile:
+        # Replace the file rather than writing into it, since it may be a hard
+        # link into the cache.
+        _unlink(dest)
         with dest.open('wb') as outfile:
             shutil.copyfileobj(infile, outfile)
-        os.chmod(str(dest), modebits)
-    return 1
+    os.chmod(str(dest), modebits)
+
+
+def _unlink(path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _place_tree(tree,
+                name,
+                dest,
+                pattern,
+                strip_components,
+                link_mode,
+                exclude=()):
+    '''
+    Place the files from the cached expansion 'tree' of the archive 'name' into
+    'dest', as _expand_archive() would have extracted them from the archive.
+    '''
+    print('Extract from: [{}] (expanded in [{}])'.format(name, tree))
+    print('        into: [{}]'.format(dest))
+    matcher = _compile_pattern(pattern, exclude)
+    placer = _Placer(link_mode)
+    # The symbolic links to place, by destination. They are placed last, once
+    # it is known whether the members they lead to were placed.
+    symlinks = {}
+
+    def place(src, to):
+        if src.is_symlink():
+            symlinks[to] = src
+        else:
+            placer.place(src, to)
+
+    n_extracted = 0
+    for relpath, is_dir in _tree_members(tree):
+        n_extracted += _maybe_extract_member(
+            dest,
+            relpath,
+            matcher,
+            strip_components,
+            is_dir,
+            lambda to: place(tree / relpath, to),
+            test=False,
+        )
+    for to, src in symlinks.items():
+        placer.place_link(src, to, dest, tree)
+    if placer.counts:
+        print('Placed files by: {}'.format(', '.join(
+            '{} ({})'.format(method, n)
+            for method, n in sorted(placer.counts.items()))))
+    return _report_expanded(n_extracted,
+                            pattern,
+                            strip_components,
+                            False,
+                            exclude=exclude)
+
+
+def _tree_members(tree):
+    '''
+    Generate the relative path and whether it is a directory for each item in
+    the expanded archive 'tree', parents first, like the members of an archive.
+    '''
+    for root, dirs, files in os.walk(str(tree)):
+        # Links to directories are placed as links, like those to files
+        links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+        dirs[:] = sorted(d for d in dirs if d not in links)
+        rel = Path(root).relative_to(tree)
+        for d in dirs:
+            yield rel / d, True
+        for f in sorted(files + links):
+            yield rel / f, False
+
+
+# The Linux ioctl that makes a copy-on-write clone of a file
+FICLONE = 0x40049409
+
+
+class _Placer:
+    '''
+    Places copies of files from the cache of expanded archives, by the cheapest
+    of the methods of 'link_mode' that works: A copy-on-write clone (a
+    "reflink"), a hard link, or a copy.
+
+    Hard links share the file with the cache, which is why the cached files
+    are read-only. Changing the cached files through a hard link would corrupt
+    the cache, so hard links are only used if they are asked for.
+    '''
+
+    METHODS = {
+        'auto': ('reflink', 'copy'),
+        'reflink': ('reflink', 'copy'),
+        'hardlink': ('hardlink', 'copy'),
+        'copy': ('copy', ),
+    }
+
+    def __init__(self, link_mode):
+        self._methods = list(self.METHODS[link_mode])
+        self.counts = Counter()
+
+    def place(self, src, dest):
+        _unlink(dest)
+        for method in list(self._methods):
+            if method == 'copy':
+                _copy_file(src, dest)
+                break
+            try:
+                if method == 'reflink':
+                    _reflink(src, dest)
+                else:
+                    os.link(str(src), str(dest))
+                break
+            except OSError:
+                _unlink(dest)
+                # It will not work for the other files either
+                self._methods.remove(method)
+        self.counts[method] += 1
+
+    def place_link(self, src, dest, out, tree):
+        '''
+        Place the symbolic link 'src' from 'tree' at 'dest' within 'out'. If
+        the link would lead outside of 'out', or the file it leads to was not
+        placed, the file is placed in place of the link.
+        '''
+        linkname = os.readlink(str(src))
+        _unlink(dest)
+        escapes = _link_escapes(out, dest, linkname)
+        if not escapes and os.path.exists(
+                os.path.join(str(dest.parent), linkname)):
+            os.symlink(linkname, str(dest))
+            self.counts['symlink'] += 1
+            return
+        target = src.resolve()
+        root = str(tree.resolve())
+        in_tree = os.path.commonpath([root, str(target)]) == root
+        if target.is_file() and in_tree:
+            self.place(target, dest)
+        elif escapes:
+            raise RuntimeError(
+                'Refusing to place the link [{}] to "{}", which leads outside '
+                'of the destination directory'.format(dest, linkname))
+        else:
+            # It leads to nothing in the archive, so place it as it is
+            os.symlink(linkname, str(dest))
+            self.counts['symlink'] += 1
+
+
+def _reflink(src, dest):
+    if sys.platform != 'linux':
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported')
+    with src.open('rb') as infile, dest.open('wb') as outfile:
+        fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+    os.chmod(str(dest), stat.S_IMODE(src.stat().st_mode) | stat.S_IWUSR)
+
+
+def _copy_file(src, dest):
+    with src.open('rb') as infile, dest.open('wb') as outfile:
+        copied = False
+        if hasattr(os, 'copy_file_range'):
+            # Let the kernel copy it, without reading it into memory
+            try:
+                while os.copy_file_range(infile.fileno(), outfile.fileno(),
+                                         1024 * 1024 * 64):
+                    pass
+                copied = True
+            except OSError:
+                # Not supported between these files
+                infile.seek(0)
+                outfile.seek(0)
+                outfile.truncate()
+        if not copied:
+            shutil.copyfileobj(infile, outfile, 1024 * 1024)
+    os.chmod(str(dest), stat.S_IMODE(src.stat().st_mode) | stat.S_IWUSR)
 
 
 def main():
@@ -619,6 +2326,49 @@ def main():
                      action='store_true',
                      help='List available components, targets, editions, and '
                      'architectures. Download arguments will act as filters.')
+    cache_grp = parser.add_argument_group('Cache arguments')
+    cache_grp.add_argument(
+        '--gc',
+        action='store_true',
+        help='Tidy the download cache, evicting the least-recently-used files '
+        'until it is within the "--cache-limit", then exit.')
+    cache_grp.add_argument(
+        '--cache-limit',
+        metavar='SIZE',
+        type=_parse_size,
+        default=os.environ.get('MONGODL_CACHE_LIMIT', '10G'),
+        help='The maximum size of the download cache, such as "500M" or "20G". '
+        'Least-recently-used files are evicted after a download when the cache '
+        'is larger than this. The cache keeps both each downloaded archive and '
+        'its expanded tree of files, which roughly doubles the space that an '
+        'archive takes. (Default is $MONGODL_CACHE_LIMIT, or "10G")')
+    manifest_grp = parser.add_argument_group('Manifest arguments')
+    manifest_grp.add_argument(
+        '--offline',
+        action='store_true',
+        help='Do not contact the server. The downloads manifest and the '
+        'requested files must already be cached.')
+    manifest_grp.add_argument(
+        '--max-manifest-age',
+        metavar='DURATION',
+        type=_parse_duration,
+        help='Use the cached downloads manifest without checking whether it '
+        'is current, if it was last checked less than DURATION ago (such as '
+        '"90s", "30m", "12h" or "7d")')
+    manifest_grp.add_argument(
+        '--export-manifest',
+        metavar='FILE',
+        type=Path,
+        help='Write the downloads manifest to FILE, for use with '
+        '"--import-manifest", then exit.')
+    manifest_grp.add_argument(
+        '--import-manifest',
+        metavar='FILE',
+        type=Path,
+        help='Replace the cached downloads manifest with one that was written '
+        'by "--export-manifest" before doing anything else. The imported '
+        'manifest is used as-is for this run, without checking it against the '
+        'server. Later runs check it as usual (see "--max-manifest-age").')
     dl_grp = parser.add_argument_group(
         'Download arguments',
         description='Select what to download and extract. '
@@ -651,12 +2401,21 @@ def main():
                         'Use "--list" to list available components.')
     dl_grp.add_argument(
         '--only',
+        action='append',
         help=
         'Restrict extraction to items that match the given globbing expression. '
         'The full archive member path is matched, so a pattern like "*.exe" '
         'will only match "*.exe" at the top level of the archive. To match '
         'recursively, use the "**" pattern to match any number of '
-        'intermediate directories.')
+        'intermediate directories. May be given more than once, to extract '
+        'the items that match any of the patterns.')
+    dl_grp.add_argument(
+        '--exclude',
+        action='append',
+        default=[],
+        help='Do not extract items that match the given globbing expression, '
+        'which is matched in the same way as "--only". May be given more than '
+        'once.')
     dl_grp.add_argument(
         '--strip-path-components',
         '-p',
@@ -677,18 +2436,91 @@ def main():
         action='store_true',
         help='Do not extract or place any files/directories. '
         'Only print what will be extracted without placing any files.')
+    dl_grp.add_argument(
+        '--link-mode',
+        choices=sorted(_Placer.METHODS),
+        default='auto',
+        help='How to place files from the cache of expanded archives into '
+        '"--out". "auto" (the default) uses a reflink where the filesystem '
+        'supports it, otherwise a copy. "hardlink" uses hard links where '
+        'possible, which saves space, but the hard-linked files are shared '
+        'with the cache, and are read-only.')
     dl_grp.add_argument('--empty-is-error',
                         action='store_true',
                         help='If all files are excluded by other filters, '
                         'treat that situation as an error and exit non-zero.')
+    dl_grp.add_argument(
+        '--jobs',
+        '-j',
+        metavar='N',
+        default=4,
+        type=int,
+        help='The number of connections to use when downloading large files '
+        '(Default is 4)')
+    batch_grp = parser.add_argument_group('Batch arguments')
+    batch_grp.add_argument(
+        '--batch',
+        metavar='FILE',
+        type=Path,
+        help='Download and extract each of the components listed in the given '
+        'JSON (or YAML) file. It should contain a list of objects with '
+        '"version", "component" and "out" keys, and optionally "target", '
+        '"arch", "edition", "only", "exclude" and "strip_components" keys. '
+        '"only" and "exclude" may each be a pattern or a list of patterns. '
+        'Omitted (or null) keys take their values from the corresponding '
+        'Download arguments.')
+    batch_grp.add_argument(
+        '--parallel',
+        metavar='N',
+        default=4,
+        type=int,
+        help='With "--batch", the number of files to download at once '
+        '(Default is 4)')
     args = parser.parse_args()
-    db = get_dl_db()
+
+    if args.gc:
+        _gc_cache(_open_dl_db(), args.cache_limit)
+        return 0
+
+    if args.import_manifest is not None:
+        _import_manifest(_open_dl_db(), args.import_manifest)
+
+    # A manifest that was just imported is used as-is: Checking it would
+    # download all of full.json again, since it did not come from our copy.
+    db = get_dl_db(max_age=args.max_manifest_age,
+                   offline=args.offline or args.import_manifest is not None,
+                   cache_limit=args.cache_limit)
+
+    if args.export_manifest is not None:
+        _export_manifest(db, args.export_manifest)
+        return 0
 
     if args.list:
         _print_list(db, args.version, args.target, args.arch, args.edition,
                     args.component)
         return
 
+    if args.batch is not None:
+        items = _load_batch(args.batch,
+                            target=args.target or infer_target(),
+                            arch=args.arch or infer_arch(),
+                            edition=args.edition or 'enterprise',
+                            out=args.out,
+                            pattern=args.only,
+                            strip_components=args.strip_components,
+                            exclude=args.exclude)
+        results = _dl_batch(db,
+                            items,
+                            test=args.test,
+                            parallel=args.parallel,
+                            jobs=args.jobs,
+                            cache_limit=args.cache_limit,
+                            offline=args.offline,
+                            link_mode=args.link_mode)
+        if ExpandResult.Empty in results:
+            return 1
+        return 0
+
     if args.version is None:
         raise argparse.ArgumentError(None, 'A "--version" is required')
     if args.component is None:
@@ -712,7 +2544,12 @@ def main():
                            component=args.component,
                            pattern=args.only,
                            strip_components=args.strip_components,
-                           test=args.test)
+                           test=args.test,
+                           jobs=args.jobs,
+                           cache_limit=args.cache_limit,
+                           offline=args.offline,
+                           link_mode=args.link_mode,
+                           exclude=args.exclude)
     if result is ExpandResult.Empty:
         return 1
     return 0
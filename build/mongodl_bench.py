@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the archive member matching of mongodl's "--only" and
+"--exclude" options.
+
+The member list of a real archive is matched against a set of patterns, with
+the compiled matcher that mongodl uses and with the recursive matcher that it
+replaced. Use mongodl to download an archive first, for example:
+
+    python mongodl.py -C archive -V 7.0.0 -o /tmp/m --test
+    python mongodl_bench.py
+
+With no ARCHIVE, the largest archive in the mongodl download cache is used.
+"""
+
+import argparse
+import sys
+import tarfile
+import timeit
+import zipfile
+from fnmatch import fnmatch
+from pathlib import Path, PurePath
+
+import mongodl
+
+# The (only, exclude) pattern lists that are timed if none are given
+DEFAULT_CASES = (
+    (('*/bin/mongod', ), ()),
+    (('**/bin/*', ), ()),
+    (('**/*.so', '**/*.dll'), ()),
+    (('*/bin/**', '*/lib/**', '**/LICENSE*'), ('**/*.pdb', '**/*.debug')),
+    (('**/**/**/*.h', ), ()),
+)
+
+
+def _recursive_match(path, pattern):
+    """
+    The matcher that _compile_pattern() replaced, which re-tests each suffix of
+    the path for each '**' in the pattern.
+    """
+    path = PurePath(path)
+    pattern_parts = PurePath(pattern).parts
+    if not pattern_parts:
+        return True
+    path_parts = path.parts
+    if not path_parts:
+        return False
+    pattern_head = pattern_parts[0]
+    pattern_tail = mongodl.pathjoin(pattern_parts[1:])
+    if pattern_head == '**':
+        tails = (path_parts[i:] for i in range(len(path_parts)))
+        return any(
+            _recursive_match(mongodl.pathjoin(t), pattern_tail) for t in tails)
+    if not fnmatch(path.parts[0], pattern_head):
+        return False
+    return _recursive_match(mongodl.pathjoin(path_parts[1:]), pattern_tail)
+
+
+def _recursive_matcher(only, exclude):
+    def match(parts):
+        path = PurePath(*parts)
+        return ((not only or any(_recursive_match(path, p) for p in only))
+                and not any(_recursive_match(path, p) for p in exclude))
+
+    return match
+
+
+def _member_names(ar):
+    if ar.suffix == '.zip':
+        with zipfile.ZipFile(str(ar)) as zf:
+            return zf.namelist()
+    with tarfile.open(str(ar)) as tf:
+        return tf.getnames()
+
+
+def _cached_archive():
+    db = mongodl._open_dl_db()
+    for sha256, name in db.execute(r'''
+            SELECT sha256, name FROM blobs
+            WHERE name LIKE '%.tgz' OR name LIKE '%.zip'
+            ORDER BY size DESC
+            '''):
+        path = mongodl._lookup_blob(db, sha256, name)
+        if path is not None:
+            return path
+    raise RuntimeError(
+        'There are no archives in the mongodl cache. Download one with '
+        'mongodl.py, or give the path of an archive.')
+
+
+def _time(fn, min_time):
+    'Get the best time of a call to fn(), timing it for at least min_time'
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    if elapsed >= min_time:
+        # Slow enough that one measurement will do
+        return elapsed / number
+    number = int(number * min_time / elapsed) + 1
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('archive',
+                        metavar='ARCHIVE',
+                        nargs='?',
+                        type=Path,
+                        help='A .tgz or .zip archive whose members to match')
+    parser.add_argument('--only',
+                        action='append',
+                        help='Time this pattern instead of the default set. '
+                        'May be given more than once.')
+    parser.add_argument('--exclude',
+                        action='append',
+                        default=[],
+                        help='An exclude pattern to time with "--only"')
+    parser.add_argument('--min-time',
+                        type=float,
+                        default=0.5,
+                        help='The minimum number of seconds to time each '
+                        'matcher for (Default is 0.5)')
+    args = parser.parse_args(argv)
+
+    ar = args.archive or _cached_archive()
+    members = [PurePath(n).parts for n in _member_names(ar)]
+    print('Matching the {} members of [{}]'.format(len(members), ar.name))
+    cases = DEFAULT_CASES
+    if args.only or args.exclude:
+        cases = ((tuple(args.only), tuple(args.exclude)), )
+
+    for only, exclude in cases:
+        compiled = mongodl._compile_pattern(only, exclude)
+        recursive = _recursive_matcher(only, exclude)
+        n_matched = sum(map(compiled, members))
+        if n_matched != sum(map(recursive, members)):
+            raise RuntimeError('The matchers disagree for {} {}'.format(
+                only, exclude))
+        t_compiled = _time(lambda: sum(map(compiled, members)), args.min_time)
+        t_recursive = _time(lambda: sum(map(recursive, members)),
+                            args.min_time)
+        label = ' '.join(['--only=' + p for p in only] +
+                         ['--exclude=' + p for p in exclude])
+        print(label)
+        print('    {:6} matched   compiled: {:8.3f} ms   recursive: {:8.3f} ms'
+              '   ({:.0f}x)'.format(n_matched, t_compiled * 1000,
+                                    t_recursive * 1000,
+                                    t_recursive / t_compiled))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
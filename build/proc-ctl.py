@@ -2,15 +2,24 @@
 Extremely basic subprocess control
 """
 
+import abc
 import argparse
+import codecs
 import json
 import os
+import queue
 import random
+import re
+import select
 import signal
+import socket
 import subprocess
 import sys
+import threading
 import time
 import traceback
+import urllib.error
+import urllib.request
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import TYPE_CHECKING, NoReturn, Sequence, Union, cast
@@ -37,9 +46,39 @@ def create_parser() -> argparse.ArgumentParser:
                        type=Path)
     start.add_argument(
         '--spawn-wait',
-        help='Number of seconds to wait for child to be running',
+        help='Number of seconds to wait for child to be running (if no '
+        '--ready-* conditions are given)',
         type=float,
         default=3)
+    start.add_argument(
+        '--ready-port',
+        help='Wait until the child accepts TCP connections on [HOST:]PORT '
+        '(HOST defaults to localhost)',
+        metavar='[HOST:]PORT',
+        dest='ready',
+        action='append',
+        type=_PortProbe.parse)
+    start.add_argument(
+        '--ready-log',
+        help='Wait until the output of the child matches the given regular '
+        'expression',
+        metavar='REGEX',
+        dest='ready',
+        action='append',
+        type=_LogProbe.parse)
+    start.add_argument(
+        '--ready-http',
+        help='Wait until an HTTP GET of the given URL succeeds',
+        metavar='URL',
+        dest='ready',
+        action='append',
+        type=_HttpProbe.parse)
+    start.add_argument(
+        '--ready-timeout',
+        help='Number of seconds to wait for all of the --ready-* conditions to '
+        'hold (Default is 30)',
+        type=float,
+        default=30)
     start.add_argument('child_command',
                        nargs='+',
                        help='The command to execute',
@@ -61,6 +100,7 @@ def create_parser() -> argparse.ArgumentParser:
 
     ll_run = grp.add_parser('__run')
     ll_run.add_argument('--ctl-dir', type=Path, required=True)
+    ll_run.add_argument('--notify', type=int)
     ll_run.add_argument('child_command', nargs='+')
 
     return parser
@@ -73,6 +113,8 @@ if TYPE_CHECKING:
         ('cwd', Path),
         ('child_command', Sequence[str]),
         ('spawn_wait', float),
+        ('ready', 'list[_ReadinessProbe] | None'),
+        ('ready_timeout', float),
     ])
 
     StopCommandArgs = NamedTuple('StopCommandArgs', [
@@ -86,6 +128,7 @@ if TYPE_CHECKING:
         ('command', Literal['__run']),
         ('child_command', Sequence[str]),
         ('ctl_dir', Path),
+        ('notify', 'int | None'),
     ])
 
     CommandArgs = Union[StartCommandArgs, StopCommandArgs, _RunCommandArgs]
@@ -107,6 +150,11 @@ class _ChildControl:
     def __init__(self, ctl_dir: Path) -> None:
         self._ctl_dir = ctl_dir
 
+    @property
+    def ctl_dir(self):
+        """The control directory of the child"""
+        return self._ctl_dir
+
     @property
     def pid_file(self):
         """The file containing the child PID"""
@@ -117,15 +165,22 @@ class _ChildControl:
         """The file containing the exit result"""
         return self._ctl_dir / 'exit.json'
 
+    @property
+    def runner_pid_file(self):
+        """The file containing the PID of the process that runs the child"""
+        return self._ctl_dir / 'runner-pid.txt'
+
     def set_pid(self, pid: int):
         write_text(self.pid_file, str(pid))
 
     def get_pid(self) -> 'int | None':
-        try:
-            txt = self.pid_file.read_text()
-        except FileNotFoundError:
-            return None
-        return int(txt)
+        return _read_pid(self.pid_file)
+
+    def set_runner_pid(self, pid: int):
+        write_text(self.runner_pid_file, str(pid))
+
+    def get_runner_pid(self) -> 'int | None':
+        return _read_pid(self.runner_pid_file)
 
     def set_exit(self, exit: 'str | int | None', error: 'str | None') -> None:
         write_text(self.result_file, json.dumps({
@@ -133,6 +188,7 @@ class _ChildControl:
             'error': error
         }))
         remove_file(self.pid_file)
+        remove_file(self.runner_pid_file)
 
     def get_result(self) -> 'None | _ResultType':
         try:
@@ -145,7 +201,207 @@ class _ChildControl:
         remove_file(self.result_file)
 
 
+def _read_pid(fpath: Path) -> 'int | None':
+    try:
+        txt = fpath.read_text()
+    except FileNotFoundError:
+        return None
+    return int(txt)
+
+
+class _RunnerEvents:
+    """
+    Receives the messages that the child runner writes to its notification
+    pipe. The pipe is closed when the runner exits, so a reader can wait for
+    either without polling.
+    """
+
+    def __init__(self, fd: int) -> None:
+        self._queue = queue.Queue()  # type: queue.Queue[str | None]
+        # Pipes cannot be select()'d on Windows, so read on a thread:
+        threading.Thread(target=self._read, args=(fd, ), daemon=True).start()
+
+    def _read(self, fd: int) -> None:
+        with open(fd, 'rb') as pipe:
+            for line in pipe:
+                self._queue.put(line.decode().strip())
+        self._queue.put(None)
+
+    def wait(self, until: datetime) -> 'str | None':
+        """
+        Wait for the next message from the runner.
+
+        Returns ``None`` if the runner has exited, or if no message arrived
+        before ``until``.
+        """
+        timeout = max(0, (until - datetime.now()).total_seconds())
+        try:
+            msg = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if msg is None:
+            # Leave the end-of-pipe for later calls
+            self._queue.put(None)
+        return msg
+
+
+class _ReadinessProbe(abc.ABC):
+    """A condition that holds once the child is ready for use"""
+
+    @abc.abstractmethod
+    def check(self, ctl_dir: Path) -> bool:
+        """Test the condition for the child with the given control directory"""
+
+    @abc.abstractmethod
+    def describe(self) -> str:
+        """Describe the condition, for messages about probes that failed"""
+
+
+class _PortProbe(_ReadinessProbe):
+    """The child accepts TCP connections on a port"""
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+
+    @classmethod
+    def parse(cls, arg: str) -> '_PortProbe':
+        host, sep, port = arg.rpartition(':')
+        if not sep:
+            host = 'localhost'
+        try:
+            return cls(host.strip('[]'), int(port))
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                'Expected [HOST:]PORT, not "{}"'.format(arg))
+
+    def check(self, ctl_dir: Path) -> bool:
+        try:
+            conn = socket.create_connection((self.host, self.port), timeout=1)
+        except OSError:
+            return False
+        conn.close()
+        return True
+
+    def describe(self) -> str:
+        return 'accepting connections on {}:{}'.format(self.host, self.port)
+
+
+class _LogProbe(_ReadinessProbe):
+    """The output of the child matches a regular expression"""
+
+    def __init__(self, pattern: 're.Pattern[str]') -> None:
+        self.pattern = pattern
+        self._output = ''
+        self._offset = 0
+        # A read may end in the middle of a multi-byte character, which the
+        # decoder holds on to until the rest of it has been read
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    @classmethod
+    def parse(cls, arg: str) -> '_LogProbe':
+        try:
+            return cls(re.compile(arg, re.MULTILINE))
+        except re.error as e:
+            raise argparse.ArgumentTypeError(
+                'Invalid regular expression "{}": {}'.format(arg, e))
+
+    def check(self, ctl_dir: Path) -> bool:
+        # Only read what was written since the last check
+        try:
+            with ctl_dir.joinpath('child-output.txt').open('rb') as f:
+                f.seek(self._offset)
+                new = f.read()
+        except FileNotFoundError:
+            return False
+        self._offset += len(new)
+        self._output += self._decoder.decode(new)
+        return self.pattern.search(self._output) is not None
+
+    def describe(self) -> str:
+        return 'output matching "{}"'.format(self.pattern.pattern)
+
+
+class _HttpProbe(_ReadinessProbe):
+    """An HTTP GET of a URL succeeds"""
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        # The child runs on this host, so any proxy would only get in the way
+        self._opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler({}))
+
+    @classmethod
+    def parse(cls, arg: str) -> '_HttpProbe':
+        if not re.match(r'https?://', arg):
+            raise argparse.ArgumentTypeError(
+                'Expected an http:// or https:// URL, not "{}"'.format(arg))
+        return cls(arg)
+
+    def check(self, ctl_dir: Path) -> bool:
+        try:
+            with self._opener.open(self.url, timeout=1):
+                return True
+        except (urllib.error.URLError, OSError):
+            # Including HTTPError, for a non-2xx status
+            return False
+
+    def describe(self) -> str:
+        return 'a successful GET of {}'.format(self.url)
+
+
+def _wait_ready(child: '_ChildControl', events: _RunnerEvents,
+                probes: 'Sequence[_ReadinessProbe]',
+                until: datetime) -> 'list[_ReadinessProbe]':
+    """
+    Wait until all of the readiness probes hold, the child exits, or ``until``.
+
+    Returns the probes that do not yet hold.
+    """
+    pending = list(probes)
+    while True:
+        pending = [p for p in pending if not p.check(child.ctl_dir)]
+        if not pending or datetime.now() >= until:
+            return pending
+        # Check again shortly, or as soon as the runner exits
+        events.wait(min(until, datetime.now() + timedelta(seconds=0.05)))
+        if child.get_result() is not None:
+            return pending
+
+
+def _notify_pipe() -> 'tuple[int, int, int]':
+    """
+    Create a pipe for the child runner to write to.
+
+    Returns the read end, the write end, and the value to pass to the runner as
+    ``--notify``.
+    """
+    read_fd, write_fd = os.pipe()
+    if sys.platform == 'win32':
+        # Windows processes inherit handles, rather than file descriptors
+        import msvcrt
+        handle = msvcrt.get_osfhandle(write_fd)
+        os.set_handle_inheritable(handle, True)
+        return read_fd, write_fd, handle
+    return read_fd, write_fd, write_fd
+
+
+def _inherited_fd(notify: int) -> int:
+    """Get the file descriptor of the ``--notify`` pipe from _notify_pipe()"""
+    if sys.platform == 'win32':
+        import msvcrt
+        return msvcrt.open_osfhandle(notify, 0)
+    return notify
+
+
 def _start(args: 'StartCommandArgs') -> int:
+    args.ctl_dir.mkdir(exist_ok=True, parents=True)
+    child = _ChildControl(args.ctl_dir)
+    if child.get_pid() is not None:
+        raise RuntimeError('Child process is already running [PID {}]'.format(
+            child.get_pid()))
+    child.clear_result()
+    read_fd, write_fd, notify = _notify_pipe()
     ll_run_cmd = [
         sys.executable,
         '-u',
@@ -153,28 +409,30 @@ def _start(args: 'StartCommandArgs') -> int:
         __file__,
         '__run',
         '--ctl-dir={}'.format(args.ctl_dir),
+        '--notify={}'.format(notify),
         '--',
         *args.child_command,
     ]
-    args.ctl_dir.mkdir(exist_ok=True, parents=True)
-    child = _ChildControl(args.ctl_dir)
-    if child.get_pid() is not None:
-        raise RuntimeError('Child process is already running [PID {}]'.format(
-            child.get_pid()))
-    child.clear_result()
-    # Spawn the child controller
-    subprocess.Popen(
-        ll_run_cmd,
-        cwd=args.cwd,
-        stderr=subprocess.STDOUT,
-        stdout=args.ctl_dir.joinpath('runner-output.txt').open('wb'),
-        stdin=subprocess.DEVNULL)
-    expire = datetime.now() + timedelta(seconds=args.spawn_wait)
-    # Wait for the PID to appear
-    while child.get_pid() is None and child.get_result() is None:
-        if expire < datetime.now():
-            break
-        time.sleep(0.1)
+    # Spawn the child controller, which inherits the write end of the pipe. On
+    # Windows, the handle is only inherited if no handles are closed.
+    windows = sys.platform == 'win32'
+    try:
+        subprocess.Popen(
+            ll_run_cmd,
+            cwd=args.cwd,
+            stderr=subprocess.STDOUT,
+            stdout=args.ctl_dir.joinpath('runner-output.txt').open('wb'),
+            stdin=subprocess.DEVNULL,
+            close_fds=not windows,
+            pass_fds=() if windows else (write_fd, ))
+    finally:
+        # Only the runner may hold the write end, so that we see it close
+        os.close(write_fd)
+    events = _RunnerEvents(read_fd)
+    wait = args.ready_timeout if args.ready else args.spawn_wait
+    expire = datetime.now() + timedelta(seconds=wait)
+    # Wait for the runner to report that it spawned the child, or to exit
+    events.wait(expire)
     # Check that it actually spawned
     if child.get_pid() is None:
         result = child.get_result()
@@ -184,11 +442,14 @@ def _start(args: 'StartCommandArgs') -> int:
             print(result['error'], file=sys.stderr)
         raise RuntimeError('Child exited immediately [Exited {}]'.format(
             result['exit']))
-    # Wait to see that it is still running after --spawn-wait seconds
-    while child.get_result() is None:
-        if expire < datetime.now():
-            break
-        time.sleep(0.1)
+    not_ready = []  # type: list[_ReadinessProbe]
+    if args.ready:
+        # Wait for it to be ready, rather than for a fixed time
+        not_ready = _wait_ready(child, events, args.ready, expire)
+    else:
+        # Wait to see that it is still running after --spawn-wait seconds
+        while events.wait(expire) is not None:
+            pass
     # A final check to see if it is running
     result = child.get_result()
     if result is not None:
@@ -196,6 +457,11 @@ def _start(args: 'StartCommandArgs') -> int:
             print(result['error'], file=sys.stderr)
         raise RuntimeError('Child exited prematurely [Exited {}]'.format(
             result['exit']))
+    if not_ready:
+        raise RuntimeError(
+            'Child is running, but was not ready within {} seconds (no {})'.
+            format(args.ready_timeout,
+                   ', '.join(p.describe() for p in not_ready)))
     return 0
 
 
@@ -210,8 +476,13 @@ def _stop(args: 'StopCommandArgs') -> int:
             return 0
         else:
             assert False
+    runner_pid = child.get_runner_pid()
     os.kill(pid, INTERUPT_SIGNAL)
     expire_at = datetime.now() + timedelta(seconds=args.stop_wait)
+    if runner_pid is not None:
+        # The runner writes the result just before it exits
+        wait_for_exit(runner_pid, args.stop_wait)
+    # Poll if we could not wait for the runner
     while expire_at > datetime.now() and child.get_result() is None:
         time.sleep(0.1)
     result = child.get_result()
@@ -223,6 +494,12 @@ def _stop(args: 'StopCommandArgs') -> int:
 
 def __run(args: '_RunCommandArgs') -> int:
     this = _ChildControl(args.ctl_dir)
+    notify = None
+    if args.notify is not None:
+        notify = open(_inherited_fd(args.notify), 'wb', buffering=0)
+        # Don't let the child hold it open
+        os.set_inheritable(notify.fileno(), False)
+    this.set_runner_pid(os.getpid())
     try:
         pipe = subprocess.Popen(
             args.child_command,
@@ -233,11 +510,19 @@ def __run(args: '_RunCommandArgs') -> int:
         this.set_exit('spawn-failed', traceback.format_exc())
         raise
     this.set_pid(pipe.pid)
+    if notify is not None:
+        try:
+            notify.write(b'started\n')
+        except OSError:
+            # "start" has stopped waiting for us
+            pass
     retc = None
     try:
         while 1:
             try:
-                retc = pipe.wait(0.5)
+                # Windows will not interrupt an unbounded wait for CTRL+C, but
+                # elsewhere a timeout makes wait() poll.
+                retc = pipe.wait(0.5 if os.name == 'nt' else None)
             except subprocess.TimeoutExpired:
                 pass
             except KeyboardInterrupt:
@@ -258,12 +543,59 @@ def write_text(fpath: Path, content: str):
     """
     tmp = fpath.with_name(fpath.name + '.tmp')
     remove_file(tmp)
-    tmp.write_text(content)
-    os.sync()
+    with tmp.open('w') as f:
+        f.write(content)
+        # Flush only this file. (os.sync() would flush every filesystem.)
+        f.flush()
+        os.fsync(f.fileno())
     remove_file(fpath)
     tmp.rename(fpath)
 
 
+def wait_for_exit(pid: int, timeout: float) -> bool:
+    """
+    Wait for the process with the given PID to exit, without polling.
+
+    Returns ``False`` if it is still running after ``timeout`` seconds, or if
+    this platform gives no way to wait for a process that is not our child.
+    """
+    try:
+        if sys.platform == 'win32':
+            import _winapi
+            SYNCHRONIZE = 0x00100000
+            handle = _winapi.OpenProcess(SYNCHRONIZE, False, pid)
+            try:
+                return _winapi.WaitForSingleObject(
+                    handle, int(timeout * 1000)) == _winapi.WAIT_OBJECT_0
+            finally:
+                _winapi.CloseHandle(handle)
+        elif sys.platform == 'linux':
+            if hasattr(os, 'pidfd_open'):
+                fd = os.pidfd_open(pid)
+                try:
+                    # The pidfd becomes readable when the process exits
+                    return bool(select.select([fd], [], [], timeout)[0])
+                finally:
+                    os.close(fd)
+        elif hasattr(select, 'kqueue'):
+            # macOS and the BSDs
+            kq = select.kqueue()
+            try:
+                ev = select.kevent(pid, select.KQ_FILTER_PROC,
+                                   select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                                   select.KQ_NOTE_EXIT)
+                return bool(kq.control([ev], 1, timeout))
+            finally:
+                kq.close()
+    except ProcessLookupError:
+        # It has already exited
+        return True
+    except OSError:
+        # E.g. pidfd_open() is not supported by this kernel
+        return False
+    return False
+
+
 def remove_file(fpath: Path):
     """
     Safely remove a file.
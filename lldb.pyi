@@ -25,6 +25,7 @@ class SBDebugger:
     def __init__(self, _: NoReturn) -> None: ...
     def HandleCommand(self, command: str) -> None: ...
     def GetErrorFileHandle(self) -> IO[str]: ...
+    def GetIndexOfTarget(self, target: SBTarget) -> int: ...
     def GetSelectedTarget(self) -> SBTarget | None: ...
 
 class SBAddress:
@@ -105,6 +106,7 @@ class SBValue:
     format: ValueFormatType
 
 class SBFrame:
+    def IsValid(self) -> bool: ...
     def FindVariable(self, var_name: str) -> SBValue: ...
     def EvaluateExpression(self, expr: str) -> SBValue: ...
     @property
@@ -121,13 +123,37 @@ class SBThread:
 class SBProcess:
     def ReadMemory(self, addr: _Pointer, size: int, err: SBError) -> bytes: ...
     def ReadCStringFromMemory(self, addr: _Pointer, max: int, err: SBError) -> bytes: ...
+    def GetStopID(self, include_expression_stops: bool = False) -> int: ...
+    def GetMemoryRegions(self) -> SBMemoryRegionInfoList: ...
+    def IsValid(self) -> bool: ...
     @property
     def selected_thread(self) -> SBThread: ...
     @property
     def id(self) -> int: ...
+    @property
+    def target(self) -> SBTarget: ...
+
+class SBMemoryRegionInfo:
+    def __init__(self) -> None: ...
+    def GetRegionBase(self) -> _Pointer: ...
+    def GetRegionEnd(self) -> _Pointer: ...
+    def IsReadable(self) -> bool: ...
+
+class SBMemoryRegionInfoList:
+    def GetSize(self) -> int: ...
+    def GetMemoryRegionAtIndex(self, idx: int, region_info: SBMemoryRegionInfo) -> bool: ...
 
 class SBCommandReturnObject:
     def AppendMessage(self, s: str) -> None: ...
+    def SetError(self, s: str) -> None: ...
+
+class SBExecutionContext:
+    @property
+    def target(self) -> SBTarget: ...
+    @property
+    def process(self) -> SBProcess: ...
+    @property
+    def frame(self) -> SBFrame: ...
 
 class SBTarget:
     def FindFirstType(self, type: str) -> SBType: ...
@@ -135,12 +161,14 @@ class SBTarget:
     def CreateValueFromExpression(self, name: str, expr: str) -> SBValue: ...
     def CreateValueFromAddress(self, name: str, addr: SBAddress, type: SBType) -> SBValue: ...
     def GetBasicType(self, type: BasicType) -> SBType: ...
+    def GetDebugger(self) -> SBDebugger: ...
     @property
     def process(self) -> SBProcess: ...
 
 class SBType:
     def GetDisplayTypeName(self) -> str: ...
     def GetPointerType(self) -> SBType: ...
+    def GetPointeeType(self) -> SBType: ...
     def GetArrayType(self, size: int) -> SBType: ...
     @property
     def name(self) -> str: ...
@@ -155,10 +183,12 @@ class SBTypeMember:
     def name(self) -> str: ...
     @property
     def byte_offset(self) -> int: ...
+    @property
+    def type(self) -> SBType: ...
 
 class SBSyntheticValueProvider:
     def __init__(self, valobj: SBValue, internal_dict: _InternalDict) -> None: ...
-    def num_children(self) -> int: ...
+    def num_children(self, max_count: int | None = None) -> int: ...
     def get_child_at_index(self, pos: int) -> SBValue: ...
     def has_children(self) -> bool: ...
     def get_value(self) -> SBValue: ...
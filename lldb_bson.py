@@ -49,24 +49,38 @@ recursively.
 
 from __future__ import annotations
 
-import enum
+import argparse
+import bisect
+import codecs
+import contextlib
 import functools
 import hashlib
+import heapq
+import itertools
 import json
+import math
+import os
+import re
 import shlex
+import sqlite3
 import struct
+import sys
+import time
 import traceback
-from datetime import datetime
+from collections import OrderedDict
+from pathlib import Path
 from typing import (
     TYPE_CHECKING,
     Any,
     Callable,
     ClassVar,
+    ContextManager,
     Dict,
-    Generator,
     Generic,
     Iterable,
+    Iterator,
     NamedTuple,
+    NoReturn,
     Sequence,
     Tuple,
     Type,
@@ -78,14 +92,38 @@ from typing import (
 import lldb  # pyright: ignore
 from lldb import (  # pyright: ignore
     SBAddress,
+    SBCommandReturnObject,
     SBDebugger,
     SBError,
+    SBExecutionContext,
     SBFrame,
     SBProcess,
     SBSyntheticValueProvider,
     SBType,
     SBValue,
 )
+from lldb_bson_parse import (
+    BSONType,
+    Decimal128Value,
+    DocumentChange,
+    DocumentElement,
+    DocumentError,
+    DocumentSnapshot,
+    DocumentInfo,
+    ElementIndex,
+    LazySequence,
+    datetime_fields,
+    datetime_summaries_at,
+    datetime_summary,
+    decode_decimal128,
+    decode_decimal128_at,
+    diff_documents,
+    iter_extjson,
+    parse_elements,
+    parse_regex,
+    preview_document,
+    read_i32le,
+)
 
 if TYPE_CHECKING:
     from typing_extensions import override
@@ -101,7 +139,10 @@ def print_errors(fn: FuncT) -> FuncT:
     @functools.wraps(fn)
     def _wrap(*args: Any, **kwargs: Any) -> Any:
         try:
-            return fn(*args, **kwargs)
+            # LLDB calls into this module through functions decorated with
+            # print_errors, so this is also where profiling begins:
+            with stats.entry(fn, args):
+                return fn(*args, **kwargs)
         except:
             e = traceback.format_exc()
             print(e)
@@ -110,6 +151,20 @@ def print_errors(fn: FuncT) -> FuncT:
     return cast("FuncT", _wrap)
 
 
+def timed(category: str) -> Callable[[FuncT], FuncT]:
+    """Decorator that records the time spent in the decorated function under ``category`` for ``bson stats``"""
+
+    def _decorate(fn: FuncT) -> FuncT:
+        @functools.wraps(fn)
+        def _wrap(*args: Any, **kwargs: Any) -> Any:
+            with stats.timed(category):
+                return fn(*args, **kwargs)
+
+        return cast("FuncT", _wrap)
+
+    return _decorate
+
+
 @print_errors
 def __lldb_init_module(debugger: SBDebugger, internal_dict: InternalDict):
     # Inject the global magic document traverser:
@@ -138,6 +193,9 @@ def __lldb_init_module(debugger: SBDebugger, internal_dict: InternalDict):
     # Arrays of bytes as a sequence of hex values:
     debugger.HandleCommand(r"type summary add -s '${var[]%x}' -x '__bson_byte__\[[0-9]+\]'")
 
+    # The "bson" command, which dispatches to the functions in _SUBCOMMANDS
+    debugger.HandleCommand("command script add -f lldb_bson.bson_command bson")
+
     print("lldb_bson is ready")
 
 
@@ -158,6 +216,41 @@ ChildItem = Union[
 ]
 
 
+class _AddressMemo(Generic[T]):
+    """
+    Values that have been decoded from process memory, by their address. The
+    values are dropped whenever they are accessed for a different process, or
+    after the process has run.
+    """
+
+    def __init__(self) -> None:
+        self._values: dict[int, T] = {}
+        "The memoized values, by address"
+        self._generation: tuple[int, int] | None = None
+        "The process ID and stop ID for which ``_values`` is valid"
+
+    def _check_generation(self, proc: SBProcess) -> None:
+        generation = proc.id, proc.GetStopID()
+        if generation != self._generation:
+            self._values.clear()
+            self._generation = generation
+
+    def get(self, proc: SBProcess, addr: int) -> T | None:
+        """Get the value that was decoded at ``addr`` in ``proc``, or ``None``"""
+        self._check_generation(proc)
+        return self._values.get(addr)
+
+    def set(self, proc: SBProcess, addr: int, value: T) -> None:
+        """Memoize the value that was decoded at ``addr`` in ``proc``"""
+        self._check_generation(proc)
+        self._values[addr] = value
+
+    def update(self, proc: SBProcess, items: Iterable[tuple[int, T]]) -> None:
+        """Memoize the given pairs of address and decoded value in ``proc``"""
+        self._check_generation(proc)
+        self._values.update(items)
+
+
 class _SyntheticMeta(type):
     """
     Metaclass that handles subclassing of SyntheticDisplayBase. Does basic checks
@@ -171,6 +264,10 @@ class _SyntheticMeta(type):
     def __new__(
         cls: Type[_SyntheticMeta], name: str, bases: tuple[type, ...], namespace: dict[str, Any]
     ) -> Type[SyntheticDisplayBase[Any]]:
+        parse = namespace.get("__parse__")
+        if isinstance(parse, classmethod):
+            # Record the time spent parsing values for ``bson stats``:
+            namespace["__parse__"] = classmethod(timed("parse")(parse.__func__))
         new_class: Type[SyntheticDisplayBase[Any]] = type.__new__(cast(type, cls), name, bases, namespace)
         if namespace.get("__abstract__"):
             return new_class
@@ -223,14 +320,22 @@ class SyntheticDisplayBase(Generic[T], SBSyntheticValueProvider, metaclass=_Synt
         Obtain the SBType for this class. Can be overriden in subclasses, and
         the type may consider the value that lives at the address.
         """
-        return generate_or_get_type(f"struct {cls.__typename__} {{}}", frame)
+        return generate_or_get_types(_BSON_BYTE_DECL, [(cls.__typename__, cls.__type_definition__())], frame)[0]
+
+    @classmethod
+    def __type_definition__(cls) -> str:
+        """
+        Get the C definition of the type named by ``__typename__``, as used by
+        the default ``__get_sbtype__``. The definition may refer to ``__bson_byte__``.
+        """
+        return f"struct {cls.__typename__} {{}}"
 
     @print_errors
     def __init__(self, val: SBValue, idict: InternalDict | None = None) -> None:
         self.__sbvalue = val
         "The SBValue given for this object"
-        self.__children: list[ChildItem] = []
-        "The synthetic children associated with the value"
+        self.__children: LazySequence[ChildItem] = LazySequence(())
+        "The synthetic children associated with the value, generated on demand"
         self.__value: T | None = None
         "The decoded value, or ``None`` if it has not yet been decoded"
 
@@ -256,7 +361,8 @@ class SyntheticDisplayBase(Generic[T], SBSyntheticValueProvider, metaclass=_Synt
     def update(self) -> bool | None:
         """Update the parsed value and the child objects"""
         self.__value = None  # Clear the value so it will be re-read
-        self.__children = list(self.get_children())
+        # Children are only generated when LLDB asks for them:
+        self.__children = LazySequence(self.get_children())
 
     def get_children(self) -> Iterable[ChildItem]:
         """
@@ -266,16 +372,22 @@ class SyntheticDisplayBase(Generic[T], SBSyntheticValueProvider, metaclass=_Synt
         """
         raise NotImplementedError
 
+    @print_errors
     @override
-    def num_children(self) -> int:
-        """Called by LLDB to know how many children exist"""
-        n = len(self.__children)
-        return n
+    def num_children(self, max_count: int | None = None) -> int:
+        """
+        Called by LLDB to know how many children exist. If LLDB gives a
+        ``max_count``, we only need to generate that many children.
+        """
+        if max_count is None:
+            return len(self.__children)
+        return self.__children.count_up_to(max_count)
 
+    @print_errors
     @override
     def has_children(self) -> bool:
         """Optimization opportunity for LLDB if it knows it doesn't need to ask"""
-        return self.__enable_synthetic__ and self.num_children() != 0
+        return self.__enable_synthetic__ and self.num_children(1) != 0
 
     @print_errors
     @override
@@ -284,7 +396,7 @@ class SyntheticDisplayBase(Generic[T], SBSyntheticValueProvider, metaclass=_Synt
         Obtain the synthetic child of this value at index 'pos'.
         """
         # LLDB sometimes calls us with a child that we don't have?
-        if pos >= len(self.__children):
+        if self.__children.count_up_to(pos + 1) <= pos:
             print(f"NOTE: lldb called get_child_at_index({pos}), but we only have {len(self.__children)} children")
             return SBValue()
         # Get the child:
@@ -371,50 +483,33 @@ class UTF8Display(SyntheticDisplayBase[bytes]):
     @classmethod
     @override
     def __parse__(cls, value: SBValue) -> bytes:
+        """Get the string data, truncated to the ``max-string-bytes`` setting"""
         buf = memcache.get_cached(value.load_addr)
         size = read_i32le(buf)
-        return bytes(buf[4:][:size])
+        if settings.max_string_bytes:
+            size = min(size, settings.max_string_bytes)
+        return bytes(buf[4 : 4 + size])
 
     @override
     def get_children(self) -> Iterable[ChildItem]:
-        strlen = len(self.value)
+        strlen = read_i32le(memcache.get_cached(self.address))
         yield "size (bytes)", strlen
+        shown = len(self.value)
         # Create a char[] type to represent the string content:
-        array_t = self.sbvalue.target.GetBasicType(lldb.eBasicTypeChar).GetArrayType(strlen)
+        array_t = self.sbvalue.target.GetBasicType(lldb.eBasicTypeChar).GetArrayType(shown)
         yield lambda: self.sbvalue.synthetic_child_from_address("[content]", self.address + 4, array_t)
+        truncated = shown < strlen
+        if truncated:
+            yield "[truncated]", f"Showing the first {shown} of {strlen} bytes"
         try:
             # Attempt a UTF-8 decode. We don't actually show this, we just want to
-            # check if there are encoding errors, which we will display in the output
-            self.value.decode("utf-8")
+            # check if there are encoding errors, which we will display in the output.
+            # If the string was truncated, it may end within a multi-byte character:
+            codecs.getincrementaldecoder("utf-8")().decode(self.value, final=not truncated)
         except UnicodeDecodeError as e:
             yield "decode error", str(e)
 
 
-class DocumentInfo(NamedTuple):
-    """A decoded document"""
-
-    elements: Sequence[DocumentElement | DocumentError]
-    "Existing elements or errors found while parsing the data"
-
-
-class DocumentElement(NamedTuple):
-    """Represents an element within a document"""
-
-    type: BSONType
-    key: str
-    value_offset: int
-    "Offset from the beginning of the document data where the element's value appears"
-    value_size: int
-    "The size of the element's value (in bytes)"
-
-
-class DocumentError(NamedTuple):
-    """Represents an error while decoding a document"""
-
-    message: str
-    error_offset: int
-
-
 class DocumentDisplay(SyntheticDisplayBase["DocumentInfo | DocumentError"]):
     """
     Main display of BSON document elements. This parses a document/array, and
@@ -427,6 +522,14 @@ class DocumentDisplay(SyntheticDisplayBase["DocumentInfo | DocumentError"]):
     __typename__ = "__bson_document_[0-9]+__"
     __qualifier__: ClassVar[str] = "document"
     "The 'qualifier' of this type. Overriden by ArrayDisplay."
+    __summary_count_limit__: ClassVar[int] = 1000
+    "The summary will not count elements beyond this many"
+    __type_batch_size__: ClassVar[int] = 256
+    "The number of sibling elements for which document/array types are generated together"
+    __value_batch_size__: ClassVar[int] = 4096
+    "The number of sibling elements whose fixed-width values are decoded together"
+    _parsed: ClassVar[_AddressMemo[DocumentInfo | DocumentError]] = _AddressMemo()
+    "Documents that have been parsed, so that refreshing a display does not parse them again"
 
     @classmethod
     @override
@@ -436,154 +539,76 @@ class DocumentDisplay(SyntheticDisplayBase["DocumentInfo | DocumentError"]):
         doc = cls.__parse__(value)
         if isinstance(doc, DocumentError):
             return f"Error parsing {prefix} at byte {doc.error_offset}: {doc.message}"
-        if len(doc.elements) == 0:
+        # Don't parse a huge document just to count its elements:
+        limit = cls.__summary_count_limit__
+        count = doc.elements.count_up_to(limit + 1)
+        if count == 0:
             return f"{prefix} (empty)"
-        if len(doc.elements) == 1:
+        if count == 1:
             return f"{prefix} (1 element)"
-        return f"{prefix} ({len(doc.elements)} elements)"
+        if count > limit:
+            return f"{prefix} (≥{count} elements)"
+        return f"{prefix} ({count} elements)"
 
     @classmethod
     @override
     def __get_sbtype__(cls, frame: SBFrame, addr: int) -> SBType:
         """Generate a unique type for the length of the document, allowing for byte-wise inspection"""
         # Read the size prefix:
-        err = SBError()
-        header = frame.thread.process.ReadMemory(addr, 4, err)
-        assert err.success, f"{err=}, {frame=}, {addr=}"
+        header = memcache.read_at(frame.thread.process, addr, 4)[1]
         size = read_i32le(header)
-        # Generate the type:
+        return cls.get_sbtype_for_size(frame, size)
+
+    @classmethod
+    def get_sbtype_for_size(cls, frame: SBFrame, size: int) -> SBType:
+        """Generate the type for a document of ``size`` bytes"""
+        return generate_or_get_types(_BSON_BYTE_DECL, [cls._type_definition(size)], frame)[0]
+
+    @classmethod
+    def _type_definition(cls, size: int) -> tuple[str, str]:
+        """Get the name and the definition of the type for a document of ``size`` bytes"""
         typename = f"__bson_{cls.__qualifier__}_{size}__"
-        doc_t = generate_or_get_type(
-            f"""
-            enum __bson_byte__ : unsigned char {{}};
-            struct {typename} {{ __bson_byte__ bytes[{size}]; }}
-            """,
-            frame,
-        )
-        return doc_t
+        return typename, f"struct {typename} {{ __bson_byte__ bytes[{size}]; }}"
 
     @classmethod
     @override
     def __parse__(cls, value: SBValue) -> DocumentInfo | DocumentError:
         try:
-            # Read from memory and refresh the segment in the memory cache. All
-            # child element displays will re-use the same memory segment that
-            # will be pulled here:
-            buf = memcache.read(value)[1]
+            # Read from memory (or from the memory cache, if the process has not
+            # run since the last read). All child element displays will re-use
+            # the same memory segment that will be pulled here:
+            buf, offset = memcache.read_segment(value.process, value.load_addr, value.size)
         except LookupError as e:
             return DocumentError(f"Failed to read memory: {e}", value.load_addr)
-        return cls.parse_bytes(buf)
-
-    @classmethod
-    def parse_bytes(cls, buf: bytes) -> DocumentInfo | DocumentError:
-        """Parse a document from the given data buffer"""
-        elems = list(cls._parse_elems(buf))
-        return DocumentInfo(elems)
+        doc = cls._parsed.get(value.process, value.load_addr)
+        if doc is None:
+            doc = cls.parse_bytes(buf, offset, offset + value.size)
+            cls._parsed.set(value.process, value.load_addr, doc)
+        return doc
 
     @classmethod
-    def _parse_elems(cls, buf: bytes) -> Iterable[DocumentElement | DocumentError]:
-        """Iteratively yield elements, or an error if parsing fails"""
-        cur_offset = 4
-        array_idx = 0
-        while buf:
-            elem = yield from cls._parse_one(buf[cur_offset:], cur_offset)
-            if isinstance(elem, DocumentError):
-                # An error ocurred, so we can't reliably continue parsing
-                yield elem
-                return
-            if elem.type == BSONType.EOD:
-                # This is the end.
-                break
-            # Yield this one, and then advance to the next element:
-            yield elem
-            elem_size = 1 + len(elem.key) + 1 + elem.value_size
-            if cls.__qualifier__ == "array":
-                # Validate that array keys are increasing integers:
-                expect_key = str(array_idx)
-                if elem.key != expect_key:
-                    yield DocumentError(
-                        f"Array element must have incrementing integer keys "
-                        f'(Expected "{expect_key}", got "{elem.key}")',
-                        cur_offset,
-                    )
-            array_idx += 1
-            cur_offset += elem_size
-        # Check that we actually consumed the whole buffer:
-        remain = len(buf) - cur_offset
-        if remain > 1:
-            yield DocumentError(f"Extra {len(buf)} bytes in document data", cur_offset)
+    def parse_bytes(cls, buf: bytes, start: int = 0, end: int | None = None) -> DocumentInfo | DocumentError:
+        """
+        Parse a document from ``buf[start:end]`` (by default, all of ``buf``).
+        The elements are parsed lazily as they are accessed.
+        """
+        if end is None:
+            end = len(buf)
+        if element_store.enabled and end - start >= element_store.MIN_DOCUMENT_SIZE:
+            # Parsing a big document may take longer than loading it from disk
+            return DocumentInfo(LazySequence(element_store.load_or_parse(cls, buf, start, end)))
+        elements = cls._parse_elems(buf, start, end)
+        if stats.enabled:
+            # Elements are parsed as they are pulled, which may happen long after this returns:
+            elements = stats.timed_iter("parse", elements)
+        return DocumentInfo(LazySequence(elements))
 
     @classmethod
-    def _parse_one(
-        cls, buf: bytes, elem_offset: int
-    ) -> Generator[DocumentError, None, DocumentElement | DocumentError]:
-        try:
-            # Read the tag type
-            type_tag = BSONType(buf[0])
-        except ValueError:
-            # The tag byte is not a valid tag value
-            return DocumentError(f"Invalid element type tag 0x{buf[0]:x}", elem_offset)
-        except IndexError:
-            # 'buf' was empty
-            return DocumentError(f"Unexpected end-of-data", elem_offset)
-        # Stop if this is the end:
-        if type_tag == BSONType.EOD:
-            return DocumentElement(type_tag, "", 0, 0)
-        # Find the null terminator on the key:
-        try:
-            key_nulpos = buf.index(0, 1)
-        except ValueError:
-            return DocumentError(f"Unexpected end-of-data while parsing the element key", elem_offset)
-        key_bytes = buf[1:key_nulpos]
-        try:
-            key = key_bytes.decode("utf-8")
-        except UnicodeDecodeError as e:
-            yield DocumentError(f"Element key {key_bytes} is not valid UTF-8 ({e})", elem_offset)
-            key = key_bytes.decode("utf-8", errors="replace")
-        # The offset of the value within the element:
-        inner_offset = key_nulpos + 1
-        # The buffer that starts at the value:
-        value_bytes = buf[inner_offset:]
-        # Get the fixed size of the element:
-        fixed_size = {
-            BSONType.Double: 8,
-            BSONType.Bool: 1,
-            BSONType.Undefined: 0,
-            BSONType.Null: 0,
-            BSONType.MinKey: 0,
-            BSONType.MaxKey: 0,
-            BSONType.Datetime: 8,
-            BSONType.ObjectID: 12,
-            BSONType.Int32: 4,
-            BSONType.Timestamp: 8,
-            BSONType.Int64: 8,
-            BSONType.Decimal128: 16,
-        }
-        value_size = fixed_size.get(BSONType(type_tag))
-        if value_size is not None:
-            pass  # This element has a fixed size
-        elif type_tag in (BSONType.Code, BSONType.Symbol, BSONType.UTF8):
-            # Size is 4 + a length prefix
-            value_size = read_i32le(value_bytes) + 4
-        elif type_tag in (BSONType.Array, BSONType.Document, BSONType.CodeWithScope):
-            # Size is given by the length prefix
-            value_size = read_i32le(value_bytes)
-        elif type_tag == BSONType.DBPointer:
-            # Size is a length prefix, plus four, plus 12 bytes for the OID
-            value_size = read_i32le(value_bytes) + 4 + 12
-        elif type_tag == BSONType.Regex:
-            # Size is dynamic and given as two C strings:
-            nul1 = value_bytes.index(0)
-            nul2 = value_bytes.index(0, nul1 + 1)
-            value_size = nul2 + 1
-        elif type_tag == BSONType.Binary:
-            # Size is a length prefix, plus four, plus one for the subtype
-            value_size = read_i32le(value_bytes) + 4 + 1
-        else:
-            assert False, f"Unhandled value tag? {type_tag=} {buf=} {key=}"
-        # The absolute offset of the element within the parent document:
-        value_offset = elem_offset + inner_offset
-        return DocumentElement(type_tag, key, value_offset, value_size)
+    def _parse_elems(
+        cls, buf: bytes, start: int = 0, end: int | None = None
+    ) -> Iterable[DocumentElement | DocumentError]:
+        """Iteratively yield the elements of the document in ``buf[start:end]``. See `parse_elements`"""
+        return parse_elements(buf, start, end, is_array=cls.__qualifier__ == "array")
 
     @override
     def get_children(self) -> Iterable[ChildItem]:
@@ -592,13 +617,85 @@ class DocumentDisplay(SyntheticDisplayBase["DocumentInfo | DocumentError"]):
             # The entire document failed to parse. Just generate one error:
             yield "[error]", f"Parsing error at byte {doc.error_offset}: {doc.message}"
             return
-        for elem in doc.elements:
+        elements = doc.elements
+        limit = settings.max_children
+        if limit and elements.count_up_to(limit + 1) > limit:
+            # Too many to show them all. Show a sample instead:
+            elements, description = self._sample_elements(limit)
+            yield "[sampled]", description
+        for idx, elem in enumerate(elements):
             if isinstance(elem, DocumentError):
                 # There was an error at this location.
                 yield "[error]", f"Data error at offset {elem.error_offset}: {elem.message}"
             else:
                 # Create a ValueFactory for each element:
-                yield functools.partial(self.create_child, self.sbvalue, elem)
+                yield functools.partial(self._create_child_at, elements, idx, elem)
+
+    def _sample_elements(self, limit: int) -> tuple[LazySequence[DocumentElement | DocumentError], str]:
+        """
+        Select the leading elements, the trailing elements, and every k-th
+        element in between, according to the `settings`. Returns the selected
+        elements and a description of the sample.
+        """
+        buf, offset = memcache.read_segment(self.sbvalue.process, self.address, self.sbvalue.size)
+        # The offset index can step over the skipped elements without parsing them:
+        index = element_index(self.sbvalue.process, self.address, buf, offset, offset + self.sbvalue.size)
+        with stats.timed("parse"):
+            count = len(index)
+        head = min(settings.sample_head, count)
+        tail = min(settings.sample_tail, count - head)
+        middle = count - head - tail
+        stride = settings.sample_stride or max(1, math.ceil(middle / max(1, limit - head - tail)))
+        indices = itertools.chain(range(head), range(head, count - tail, stride), range(count - tail, count))
+        sample: list[DocumentElement | DocumentError] = [index[n] for n in indices]
+        if index.error is not None:
+            sample.append(index.error)
+        description = f"{len(sample)} of {count} elements: the first {head}, every {stride}, and the last {tail}"
+        return LazySequence(sample), description
+
+    @print_errors
+    @override
+    def update(self) -> bool | None:
+        self._types_batched_to = 0
+        "The index of the first element whose type has not been generated in a batch"
+        self._values_batched_to = 0
+        "The index of the first element whose value has not been decoded in a batch"
+        return super().update()
+
+    def _create_child_at(
+        self, elements: LazySequence[DocumentElement | DocumentError], idx: int, elem: DocumentElement
+    ) -> SBValue:
+        """Create the child for ``elem``, which is ``elements[idx]``"""
+        if elem.type in _DOCUMENT_DISPLAYS and idx >= self._types_batched_to:
+            # Each distinct document size needs its own type. Rather than
+            # evaluating an expression for each one as it is expanded, generate
+            # the types for this and the following siblings all at once:
+            end = elements.count_up_to(idx + self.__type_batch_size__)
+            self._types_batched_to = end
+            generate_or_get_types(
+                _BSON_BYTE_DECL,
+                [
+                    _DOCUMENT_DISPLAYS[sib.type]._type_definition(sib.value_size)
+                    for sib in (elements[n] for n in range(idx, end))
+                    if isinstance(sib, DocumentElement) and sib.type in _DOCUMENT_DISPLAYS
+                ],
+                self.sbvalue.frame,
+            )
+        if elem.type in _BATCH_DECODERS and idx >= self._values_batched_to:
+            # LLDB will ask for the summary of each of the siblings in turn, so
+            # decode the values of this and the following siblings all at once:
+            end = elements.count_up_to(idx + self.__value_batch_size__)
+            self._values_batched_to = end
+            siblings = [elements[n] for n in range(idx, end)]
+            buf, offset = memcache.read_segment(self.sbvalue.process, self.address, self.sbvalue.size)
+            for type, decode_batch in _BATCH_DECODERS.items():
+                offsets = [
+                    offset + s.value_offset for s in siblings if isinstance(s, DocumentElement) and s.type == type
+                ]
+                if offsets:
+                    # The offsets are within the whole segment, which begins before our address:
+                    decode_batch(self.sbvalue.process, self.address - offset, buf, offsets)
+        return self.create_child(self.sbvalue, elem)
 
     @classmethod
     def create_child(cls, parent: SBValue, elem: DocumentElement) -> SBValue:
@@ -609,48 +706,36 @@ class DocumentDisplay(SyntheticDisplayBase["DocumentInfo | DocumentError"]):
         else:
             name = f"['{elem.key}']"
         value_addr = parent.load_addr + elem.value_offset
-        frame = parent.frame
-        # Create a new SBType to represent the element value. For each type tag, we
-        # want a function that maps an SBFrame and an address to a new SBType:
-        by_type: dict[BSONType, Callable[[SBFrame, int], SBType]] = {
-            BSONType.Double: DoubleDisplay.__get_sbtype__,
-            BSONType.UTF8: UTF8Display.__get_sbtype__,
-            BSONType.Document: DocumentDisplay.__get_sbtype__,
-            BSONType.Binary: BinaryDisplay.__get_sbtype__,
-            BSONType.Array: ArrayDisplay.__get_sbtype__,
-            # For bool, we can just use LLDB's basic type:
-            BSONType.Bool: lambda _fr, _addr: parent.target.GetBasicType(lldb.eBasicTypeBool),
-            BSONType.Code: CodeDisplay.__get_sbtype__,
-            BSONType.CodeWithScope: CodeWithScopeDisplay.__get_sbtype__,
-            BSONType.Int32: Int32Display.__get_sbtype__,
-            BSONType.Int64: Int64Display.__get_sbtype__,
-            BSONType.ObjectID: ObjectIDDisplay.__get_sbtype__,
-            BSONType.DBPointer: DBPointerDisplay.__get_sbtype__,
-            BSONType.Regex: RegexDisplay.__get_sbtype__,
-            BSONType.Symbol: SymbolDisplay.__get_sbtype__,
-            BSONType.Datetime: DatetimeDisplay.__get_sbtype__,
-            BSONType.Timestamp: TimestampDisplay.__get_sbtype__,
-            BSONType.Decimal128: Decimal128Display.__get_sbtype__,
-            BSONType.Null: NullDisplay.__get_sbtype__,
-            BSONType.Undefined: UndefinedDisplay.__get_sbtype__,
-            BSONType.MaxKey: MaxKeyDisplay.__get_sbtype__,
-            BSONType.MinKey: MinKeyDisplay.__get_sbtype__,
-        }
-        get_type = by_type.get(elem.type)
-        assert get_type is not None, f"Unhandled type tag? {elem=}"
-        # Create the SBType:
-        type = get_type(frame, value_addr)
+        # Create a new SBType to represent the element value:
+        type = element_sbtype(parent.frame, elem.type, value_addr, elem.value_size)
         # Create a synthetic child of that type at the address of the element's value:
         val = parent.synthetic_child_from_address(name, value_addr, type)
         assert val.error.success, f"{elem=}, {val.error=}"
         return val
 
 
+def element_sbtype(frame: SBFrame, type: BSONType, addr: int, size: int) -> SBType:
+    """Get the SBType for an element value of the given type and size that lives at ``addr``"""
+    if type in _DOCUMENT_DISPLAYS:
+        # We already know the size of documents and arrays:
+        return _DOCUMENT_DISPLAYS[type].get_sbtype_for_size(frame, size)
+    if type == BSONType.Bool:
+        # For bool, we can just use LLDB's basic type:
+        return frame.thread.process.target.GetBasicType(lldb.eBasicTypeBool)
+    display = _ELEMENT_DISPLAYS.get(type)
+    assert display is not None, f"Unhandled type tag? {type=}"
+    if _target_key(frame) not in _warmed_up_targets:
+        # Generate all of the common element types at once, rather than one at a time
+        warm_up_types(frame)
+    return display.__get_sbtype__(frame, addr)
+
+
 class ArrayDisplay(DocumentDisplay):
     """Display for arrays. Most logic is implemented in the DocumentDisplay base."""
 
     __typename__ = "__bson_array_[0-9]+__"
     __qualifier__: ClassVar[str] = "array"
+    _parsed: ClassVar[_AddressMemo[DocumentInfo | DocumentError]] = _AddressMemo()
 
 
 class BinaryInfo(NamedTuple):
@@ -672,7 +757,7 @@ class BinaryDisplay(SyntheticDisplayBase[BinaryInfo]):
         # Type tag:
         type = buf[4]
         # The remainder of the data:
-        data = buf[5:][:data_size]
+        data = bytes(buf[5 : 5 + data_size])
         return BinaryInfo(type, data)
 
     @override
@@ -706,26 +791,21 @@ class ObjectIDDisplay(SyntheticDisplayBase[bytes]):
 
     @classmethod
     @override
+    @print_errors
     def __summary__(cls, value: SBValue, idict: InternalDict) -> str:
         val = cls.__parse__(value)
         return f'ObjectID("{val.hex()}")'
 
     @classmethod
     @override
-    def __get_sbtype__(cls, frame: SBFrame, addr: int) -> SBType:
-        return generate_or_get_type(
-            r"""
-            enum __bson_byte__ : char {};
-            struct __bson_objectid__ { __bson_byte__ bytes[12]; }
-            """,
-            frame,
-        )
+    def __type_definition__(cls) -> str:
+        return "struct __bson_objectid__ { __bson_byte__ bytes[12]; }"
 
     @classmethod
     @override
     def __parse__(cls, value: SBValue) -> bytes:
         buf = memcache.get_cached(value.load_addr)
-        return buf[:12]
+        return bytes(buf[:12])
 
     @override
     def get_children(self) -> Iterable[ChildItem]:
@@ -737,41 +817,34 @@ class DatetimeDisplay(SyntheticDisplayBase[int]):
 
     __typename__ = "__bson_datetime__"
     __summary_str__: ClassVar[str] = "datetime: ${var[0]}"
+    _summaries: ClassVar[_AddressMemo[str]] = _AddressMemo()
+    "Summaries that were generated by `decode_batch`"
 
     @classmethod
     @override
+    @print_errors
     def __summary__(cls, value: SBValue, idict: InternalDict) -> str:
-        dt = datetime.fromtimestamp(cls.__parse__(value) / 1000)
-        s = f"{dt:%a %b %m %Y %H:%M:%S +%fμs}"
-        return f'Date("{s}")'
+        summary = cls._summaries.get(value.process, value.load_addr)
+        if summary is None:
+            summary = datetime_summary(cls.__parse__(value))
+        return summary
 
     @classmethod
     @override
     def __parse__(cls, val: SBValue) -> int:
         buf = memcache.get_cached(val.load_addr)
         buf = buf[:8]
-        value: int = struct.unpack("<Q", buf)[0]
+        value: int = struct.unpack("<q", buf)[0]
         return value
 
+    @classmethod
+    def decode_batch(cls, proc: SBProcess, addr: int, buf: bytes, offsets: Sequence[int]) -> None:
+        """Generate the summaries of the values at ``offsets`` within ``buf``, which lives at ``addr`` in ``proc``"""
+        cls._summaries.update(proc, zip([addr + off for off in offsets], datetime_summaries_at(buf, offsets)))
+
     @override
     def get_children(self) -> Iterable[ChildItem]:
-        # We can create a rich display using Python's datetime parsing:
-        dt = datetime.fromtimestamp(self.value / 1000)
-        # Adjusted to the local time zone:
-        adjusted = dt.astimezone()
-        yield from {
-            "[isoformat]": dt.isoformat(),
-            "[date]": f"{dt:%B %d, %Y}",
-            "[time]": dt.strftime("%H:%M:%S +%fμs"),
-            "[local]": adjusted.strftime("%c"),
-            "Year": dt.year,
-            "Month": dt.month,
-            "Day": dt.day,
-            "Hour": dt.hour,
-            "Minute": dt.minute,
-            "Second": dt.second,
-            "+μs": dt.microsecond,
-        }.items()
+        yield from datetime_fields(self.value).items()
 
 
 class NullDisplay(UndefinedDisplay):
@@ -811,6 +884,7 @@ class RegexDisplay(SyntheticDisplayBase[Tuple[bytes, bytes]]):
 
     @classmethod
     @override
+    @print_errors
     def __summary__(cls, value: SBValue, idict: InternalDict) -> str:
         # Create a JS-style regex literal:
         pair = cls.__parse__(value)
@@ -820,15 +894,8 @@ class RegexDisplay(SyntheticDisplayBase[Tuple[bytes, bytes]]):
 
     @classmethod
     def parse_at(cls, addr: int) -> tuple[bytes, bytes]:
-        buf = memcache.get_cached(addr)
-        # A regex is encoded with two C-strings. Find the nulls:
-        nulpos_1 = buf.index(0)
-        nulpos_2 = buf.index(0, nulpos_1 + 1)
-        # Split them up:
-        regex = buf[:nulpos_1]
-        options = buf[nulpos_1 + 1 : nulpos_2]
-        # Decode and return:
-        return regex, options
+        buf, offset = memcache.get_cached_segment(addr)
+        return parse_regex(buf, offset)
 
     @classmethod
     def decode_pair(cls, value: tuple[bytes, bytes]) -> tuple[str, str]:
@@ -851,7 +918,7 @@ class DBPointerDisplay(SyntheticDisplayBase[Tuple[bytes, int]]):
         # Grab the string and the OID position
         strlen = read_i32le(buf)
         size = strlen + 4 + 12
-        return buf[:size], strlen + 4
+        return bytes(buf[:size]), strlen + 4
 
     @override
     def get_children(self) -> Iterable[ChildItem]:
@@ -876,6 +943,7 @@ class SymbolDisplay(UTF8Display):
 
     @classmethod
     @override
+    @print_errors
     def __summary__(cls, value: SBValue, idict: InternalDict) -> str:
         spell = cls.__parse__(value)
         dec = spell.decode("utf-8", errors="replace").rstrip("\x00")
@@ -894,7 +962,7 @@ class CodeWithScopeDisplay(SyntheticDisplayBase[int]):
     def __parse__(cls, value: SBValue) -> int:
         buf = memcache.get_cached(value.load_addr)
         # Find the end position of the string:
-        strlen = read_i32le(buf[4:])
+        strlen = read_i32le(buf, 4)
         str_end = 4 + strlen + 4
         return str_end
 
@@ -917,6 +985,7 @@ class Int32Display(PrimitiveDisplay[int]):
 
     @classmethod
     @override
+    @print_errors
     def __summary__(cls, value: SBValue, idict: InternalDict) -> str:
         return f"NumberInt({cls.__parse__(value)})"
 
@@ -929,6 +998,7 @@ class Int64Display(PrimitiveDisplay[int]):
 
     @classmethod
     @override
+    @print_errors
     def __summary__(cls, value: SBValue, idict: InternalDict) -> str:
         return f"NumberLong({cls.__parse__(value)})"
 
@@ -953,36 +1023,22 @@ class TimestampDisplay(SyntheticDisplayBase[Tuple[int, int]]):
         yield "increment", self.value[1]
 
 
-class Decimal128Value(NamedTuple):
-    """Represents a parsed Decimal128 value"""
-
-    sign: int
-    combination: int
-    exponent: int
-    significand: int
-    spelling: str
-
-
 class Decimal128Display(SyntheticDisplayBase[Decimal128Value]):
     """The display type for BSON's Decimal128 type"""
 
     __typename__ = "__bson_decimal128__"
+    _decoded: ClassVar[_AddressMemo[Decimal128Value]] = _AddressMemo()
+    "Values that were decoded by `decode_batch`"
 
     @classmethod
     @override
-    def __get_sbtype__(cls, frame: SBFrame, addr: int) -> SBType:
+    def __type_definition__(cls) -> str:
         """Generate a type for byte-wise introspection"""
-        return generate_or_get_type(
-            r"""
-            struct __bson_decimal128__ {
-                unsigned char bytes[16];
-            }
-            """,
-            frame,
-        )
+        return "struct __bson_decimal128__ { unsigned char bytes[16]; }"
 
     @classmethod
     @override
+    @print_errors
     def __summary__(cls, value: SBValue, idict: InternalDict) -> str:
         val = cls.__parse__(value)
         return f'NumberDecimal("{val.spelling}")'
@@ -990,68 +1046,15 @@ class Decimal128Display(SyntheticDisplayBase[Decimal128Value]):
     @classmethod
     @override
     def __parse__(cls, value: SBValue) -> Decimal128Value:
-        dat = bytes(value.data.uint8)
-        # The value is little-endian encoded, so we manually read it in that encoding
-        d1 = read_i32le(dat)
-        d2 = read_i32le(dat[4:])
-        d3 = read_i32le(dat[8:])
-        d4 = read_i32le(dat[12:])
-        # Combin the parts:
-        low_word = (d2 << 32) | d1
-        hi_word = (d4 << 32) | d3
-        d128_tetra = (hi_word << 64) | low_word
-        # Create an array of individual bits (high bits first):
-        bits = tuple(((d128_tetra >> n) & 1) for n in range(127, -1, -1))
-        # Recombine a sequence of bits into an int (high bits first)
-        mergebits: Callable[[tuple[int, ...]], int] = lambda bs: functools.reduce(lambda a, b: (a << 1) | b, bs, 0)
-        # Sign bit:
-        sign = bits[0]
-        # BID uses the first two combo bits to indicate that the exponent is shifted
-        if bits[1] and bits[2]:
-            shifted = True
-        else:
-            shifted = False
-
-        spelling = None
-        if not shifted:
-            # Regular bit positions:
-            exponent = bits[1:15]
-            coeff = bits[15:]
-        else:
-            # Bit positions are shifted over
-            exponent = bits[3:17]
-            # The significand has an implicit '0b100' prepended as the highest bits:
-            coeff = (1, 0, 0) + bits[17:]
-            # Check for special values in the remainder of the combination:
-            more = bits[3:6]
-            if more == (1, 0, 0) or more == (1, 0, 1):
-                spelling = "Infinity"
-            elif more == (1, 1, 0):
-                spelling = "NaN (quiet)"
-            elif more == (1, 1, 1):
-                spelling = "NaN (signaling)"
-
-        coeff = mergebits(coeff)
-        exponent = mergebits(exponent)
-        if spelling is None:
-            spelling = str(coeff)
-            e = exponent - 6176
-            if e == 0:
-                pass
-            elif e < 0:
-                spelling = spelling.zfill(abs(e))
-                split = len(spelling) + e
-                w, fr = spelling[:split], spelling[split:]
-                spelling = f"{w}.{fr}"
-            else:
-                spelling = spelling + "0" * e
-
-        if sign:
-            spelling = f"-{spelling}"
+        decoded = cls._decoded.get(value.process, value.load_addr)
+        if decoded is None:
+            decoded = decode_decimal128(bytes(value.data.uint8))
+        return decoded
 
-        # The "combination" bits
-        combination = mergebits(bits[1:18])
-        return Decimal128Value(sign, combination, exponent, coeff, spelling)
+    @classmethod
+    def decode_batch(cls, proc: SBProcess, addr: int, buf: bytes, offsets: Sequence[int]) -> None:
+        """Decode the values at ``offsets`` within ``buf``, which lives at ``addr`` in ``proc``"""
+        cls._decoded.update(proc, zip([addr + off for off in offsets], decode_decimal128_at(buf, offsets)))
 
     @override
     def get_children(self) -> Iterable[ChildItem]:
@@ -1101,6 +1104,27 @@ class BSONTDisplay(SyntheticDisplayBase["BSONTInfo | BSONTError"]):
     """
 
     __typename__ = "bson_t"
+    __summary_read_size__: ClassVar[int] = 512
+    "The number of bytes of the document data that are read to generate the summary"
+
+    @classmethod
+    @override
+    @print_errors
+    def __summary__(cls, value: SBValue, idict: InternalDict) -> str:
+        """
+        Generate a preview of the first few elements. This only reads the start
+        of the document data, and does not create any types or children, since
+        summaries are shown for every bson_t in e.g. a backtrace.
+        """
+        val = cls.__parse__(value)
+        if isinstance(val, BSONTError):
+            return f"<invalid bson_t: {val.reason}>"
+        try:
+            buf = memcache.read_at(value.process, val.addr, min(val.size, cls.__summary_read_size__))[1]
+        except LookupError as e:
+            return f"<Failed to read memory: {e}>"
+        # The preview parses keys with bytes.find(), so copy the (short) head of the document:
+        return f"{preview_document(bytes(buf), val.size)} ({val.size} bytes)"
 
     @classmethod
     @override
@@ -1202,9 +1226,13 @@ class BSONTDisplay(SyntheticDisplayBase["BSONTInfo | BSONTError"]):
         ptr_t = self.sbvalue.target.GetBasicType(lldb.eBasicTypeVoid).GetPointerType()
         yield "data address", val.addr, lldb.eFormatPointer, ptr_t
 
-        # Generate the __bson_document_xxx__ that will allow walking the document:
-        doc_t = DocumentDisplay.__get_sbtype__(self.sbvalue.frame, val.addr)
-        yield lambda: checked(self.sbvalue.synthetic_child_from_address("[content]", val.addr, doc_t))
+        # Generate the __bson_document_xxx__ that will allow walking the document,
+        # but only once the child is requested, since this evaluates an expression:
+        yield lambda: checked(
+            self.sbvalue.synthetic_child_from_address(
+                "[content]", val.addr, DocumentDisplay.__get_sbtype__(self.sbvalue.frame, val.addr)
+            )
+        )
 
 
 def checked(val: SBValue) -> SBValue:
@@ -1213,15 +1241,39 @@ def checked(val: SBValue) -> SBValue:
     return val
 
 
-def read_i32le(dat: bytes) -> int:
-    """Read a 32-bit integer from the given data."""
-    # Truncate before the read:
-    buf = dat[0:4]
-    return struct.unpack("<i", buf)[0]
+_types_cache: dict[tuple[int, str], SBType] = {}
+"The cache of generated types (for generate_or_get_type), by target and declaration"
 
 
-_types_cache: dict[tuple[int, str], SBType] = {}
-"The cache of generated types (for generate_or_get_type)"
+def _target_key(frame: SBFrame) -> int:
+    """
+    Identify the target of ``frame`` by its index in the debugger. Types that
+    are declared by evaluating expressions belong to the target, not to the
+    process, so they remain valid when the program is re-launched. They do not
+    outlive the target, though, and an index is reused once its target is
+    deleted, so a cached type must be checked with ``IsValid()`` before use.
+    """
+    target = frame.thread.process.target
+    return target.GetDebugger().GetIndexOfTarget(target)
+
+
+def _cached_type(target: int, key: str) -> SBType | None:
+    """
+    Get the cached type for ``key`` in ``target``, or `None` if it has not been
+    declared yet or was declared in a target that has since been deleted.
+    """
+    existing = _types_cache.get((target, key))
+    if existing is None or existing.IsValid():
+        return existing
+    # The type belonged to a deleted target whose index has been reused
+    stats.count("type cache invalidations")
+    del _types_cache[target, key]
+    _warmed_up_targets.discard(target)
+    return None
+
+
+_BSON_BYTE_DECL = "enum __bson_byte__ : unsigned char {};"
+"The declaration of the byte type used by document types"
 
 
 def generate_or_get_type(expr_prefix: str, frame: SBFrame) -> SBType:
@@ -1246,47 +1298,115 @@ def generate_or_get_type(expr_prefix: str, frame: SBFrame) -> SBType:
     we cache.
     """
     # The cache key
-    cachekey = frame.thread.process.id, expr_prefix
-    existing = _types_cache.get(cachekey)
+    cachekey = _target_key(frame), expr_prefix
+    existing = _cached_type(*cachekey)
+    stats.count("type cache hits" if existing is not None else "type cache misses")
     if existing is not None:
         # We've already generated this type before
         return existing
+    existing = _types_cache[cachekey] = _declare_type(expr_prefix, frame)
+    return existing
+
+
+def _declare_type(expr_prefix: str, frame: SBFrame) -> SBType:
+    """Evaluate an expression that declares a type, as described in `generate_or_get_type`"""
     # Create a new temporary object. Give it a unique name to prevent it from
     # colliding with any possible temporaries we may have generated previously.
     hash = hashlib.md5(expr_prefix.encode()).hexdigest()
     varname = f"__bson_lldb_tmp_{hash}"
     full_expr = f"{expr_prefix} {varname}; {varname}"
-    tmp = frame.EvaluateExpression(full_expr)
-    existing = tmp.type
-    _types_cache[cachekey] = existing
-    return existing
+    with stats.timed("EvaluateExpression"):
+        tmp = frame.EvaluateExpression(full_expr)
+    return tmp.type
 
 
-class BSONType(enum.Enum):
-    """The values for each bson element type tag"""
-
-    EOD = 0
-    Double = 0x1
-    UTF8 = 0x2
-    Document = 0x3
-    Array = 0x4
-    Binary = 0x5
-    Undefined = 0x6
-    ObjectID = 0x7
-    Bool = 0x8
-    Datetime = 0x9
-    Null = 0xA
-    Regex = 0xB
-    DBPointer = 0xC
-    Code = 0xD
-    Symbol = 0xE
-    CodeWithScope = 0xF
-    Int32 = 0x10
-    Timestamp = 0x11
-    Int64 = 0x12
-    Decimal128 = 0x13
-    MinKey = 255
-    MaxKey = 127
+def generate_or_get_types(prelude: str, definitions: Sequence[tuple[str, str]], frame: SBFrame) -> list[SBType]:
+    """
+    Obtain several types at once. For each ``(typename, definition)`` pair in
+    ``definitions``, this returns the same type that would be returned by
+    ``generate_or_get_type(f"{prelude} {definition}", frame)``.
+
+    Evaluating an expression costs about the same regardless of how much it
+    declares, so all of the types that are not yet cached are declared by a
+    single expression that yields a struct holding a pointer to each of them.
+    """
+    target = _target_key(frame)
+    keys = [f"{prelude} {defn}" if prelude else defn for _, defn in definitions]
+    missing = {key: name_defn for key, name_defn in zip(keys, definitions) if _cached_type(target, key) is None}
+    stats.count("type cache hits", len(keys) - len(missing))
+    stats.count("type cache misses", len(missing))
+    if len(missing) == 1:
+        # Nothing to batch
+        (key,) = missing
+        _types_cache[target, key] = _declare_type(key, frame)
+    elif missing:
+        defns = " ".join(f"{defn};" for _, defn in missing.values())
+        members = " ".join(f"{typename} *m{n};" for n, (typename, _) in enumerate(missing.values()))
+        batch_t = _declare_type(f"{prelude} {defns} struct __bson_types__ {{ {members} }}", frame)
+        if batch_t.IsValid() and len(batch_t.fields) == len(missing):
+            for key, field in zip(missing, batch_t.fields):
+                _types_cache[target, key] = field.type.GetPointeeType()
+        else:
+            # The batch failed to evaluate (e.g. one of the declarations was rejected),
+            # so declare each type on its own:
+            stats.count("type batch failures")
+            for key in missing:
+                _types_cache[target, key] = _declare_type(key, frame)
+    return [_types_cache[target, key] for key in keys]
+
+
+_warmed_up_targets: set[int] = set()
+"The targets (see `_target_key`) for which `warm_up_types` has been called"
+
+
+def warm_up_types(frame: SBFrame) -> None:
+    """
+    Generate the types for all element types that have a fixed type, using a
+    single expression evaluation.
+    """
+    _warmed_up_targets.add(_target_key(frame))
+    base_get_sbtype = SyntheticDisplayBase.__get_sbtype__.__func__  # type: ignore
+    fixed = [
+        (display.__typename__, display.__type_definition__())
+        for display in _ELEMENT_DISPLAYS.values()
+        if display.__get_sbtype__.__func__ is base_get_sbtype  # type: ignore
+    ]
+    generate_or_get_types(_BSON_BYTE_DECL, fixed, frame)
+
+
+_DOCUMENT_DISPLAYS: dict[BSONType, Type[DocumentDisplay]] = {
+    BSONType.Document: DocumentDisplay,
+    BSONType.Array: ArrayDisplay,
+}
+"The display classes for element types that have a size-dependent type"
+
+_ELEMENT_DISPLAYS: dict[BSONType, Type[SyntheticDisplayBase[Any]]] = {
+    BSONType.Double: DoubleDisplay,
+    BSONType.UTF8: UTF8Display,
+    BSONType.Binary: BinaryDisplay,
+    BSONType.Code: CodeDisplay,
+    BSONType.CodeWithScope: CodeWithScopeDisplay,
+    BSONType.Int32: Int32Display,
+    BSONType.Int64: Int64Display,
+    BSONType.ObjectID: ObjectIDDisplay,
+    BSONType.DBPointer: DBPointerDisplay,
+    BSONType.Regex: RegexDisplay,
+    BSONType.Symbol: SymbolDisplay,
+    BSONType.Datetime: DatetimeDisplay,
+    BSONType.Timestamp: TimestampDisplay,
+    BSONType.Decimal128: Decimal128Display,
+    BSONType.Null: NullDisplay,
+    BSONType.Undefined: UndefinedDisplay,
+    BSONType.MaxKey: MaxKeyDisplay,
+    BSONType.MinKey: MinKeyDisplay,
+}
+"The display classes for the other element types (except for bool, which uses a basic type)"
+
+_BATCH_DECODERS: dict[BSONType, Callable[[SBProcess, int, bytes, Sequence[int]], None]] = {
+    BSONType.Datetime: DatetimeDisplay.decode_batch,
+    BSONType.Decimal128: Decimal128Display.decode_batch,
+}
+"Functions that decode the values of many sibling elements of a type at once"
 
 
 class _BSONWalker:
@@ -1330,36 +1450,45 @@ class _BSONWalker:
         if isinstance(as_bson, BSONTError):
             raise ValueError(as_bson.reason)
 
-        # Create the synthetic __bson_document_xxx__ object for this doc
-        doc_t = DocumentDisplay.__get_sbtype__(val.frame, as_bson.addr)
-        # Obtain a value reference to the document data:
-        retval = val.CreateValueFromAddress("[root]", as_bson.addr, doc_t)
-
-        # Now resolve the path:
+        # Resolve the path on the raw document data. Only the final element
+        # gets an SBValue.
+        try:
+            buf, offset = memcache.read_segment(val.process, as_bson.addr, as_bson.size)
+        except LookupError as e:
+            raise ValueError(f"Failed to read document data: {e}")
+        # Offsets are within the whole cached segment, which begins at ``base``:
+        base = as_bson.addr - offset
+        name = "[root]"
+        type = BSONType.Document
+        start, end = offset, offset + as_bson.size
         for part in self._path:
             if isinstance(part, str):
                 # Access via ``p['foo']`` or ``p.foo``, requires our current node
                 # to be a document:
-                if not retval.type.name.startswith("__bson_document_"):
+                if type != BSONType.Document:
                     raise AttributeError(
-                        f'Element of type {retval.type.name} cannot be accessed as a document (looking for element "{part}")'
+                        f'Element of type {type.name} cannot be accessed as a document (looking for element "{part}")'
                     )
-                # We are accessing the synthetic children generated by DocumentDisplay.
-                # The keys are of the following format based on the element keys in the document:
-                want_child_name = f"['{part}']"
+                name = f"['{part}']"
             else:
                 # Access via indexing ``p[42]``, requires an array
-                if not retval.type.name.startswith("__bson_array_"):
+                if type != BSONType.Array:
                     raise AttributeError(
-                        f"Element of type {retval.type.name} cannot be accessed as an array (looking for element {part})"
+                        f"Element of type {type.name} cannot be accessed as an array (looking for element {part})"
                     )
-                # Array keys are bracketed, but not quoted
-                want_child_name = f"[{part}]"
-            # Find all children that match the key (usually only one)
-            matching = (c for c in retval.children if c.name == want_child_name)
-            # Get it:
-            got = next(iter(matching), None)
-            if got is None:
+                name = f"[{part}]"
+            if isinstance(part, int):
+                # Array elements can be found by position, without parsing the elements before them:
+                index = element_index(val.process, base + start, buf, start, end)
+                try:
+                    elem = index[part]
+                except IndexError:
+                    if index.error is not None:
+                        raise ValueError(f"Array data is invalid: {index.error.message}") from None
+                    elem = None
+            else:
+                elem = _KeyIndex.get(val.process, base + start, buf, start, end, type).find(part)
+            if elem is None:
                 # Didn't get it...
                 if isinstance(part, str):
                     raise KeyError(f'Document has no element "{part}"')
@@ -1367,9 +1496,11 @@ class _BSONWalker:
                     raise IndexError(f"Array index [{part}] is out-of-bounds")
             # Set this as our current node, which we may step in further, or
             # we may be done
-            retval = got
+            type = elem.type
+            start, end = start + elem.value_offset, start + elem.value_offset + elem.value_size
 
-        return retval
+        addr = base + start
+        return val.CreateValueFromAddress(name, addr, element_sbtype(val.frame, type, addr, end - start))
 
     def __getattr__(self, key: str) -> _BSONWalker:
         """Generate a new traversal for the given key"""
@@ -1380,6 +1511,67 @@ class _BSONWalker:
         return _BSONWalker(self._path + (key,))
 
 
+_element_indexes: _AddressMemo[ElementIndex] = _AddressMemo()
+"The offset indexes of documents, by the address of the document"
+
+
+def element_index(proc: SBProcess, addr: int, buf: bytes, start: int = 0, end: int | None = None) -> ElementIndex:
+    """
+    Get the offset index for the document in ``buf[start:end]``, which lives at
+    ``addr`` in ``proc``. Indexes are memoized until the process runs.
+    """
+    index = _element_indexes.get(proc, addr)
+    if index is None:
+        index = ElementIndex(buf, start, end)
+        _element_indexes.set(proc, addr, index)
+    return index
+
+
+class _KeyIndex:
+    """
+    A mapping from element keys to the elements of a document, which is built
+    incrementally by parsing only as far as needed to find the requested key.
+    Indexes are memoized for each document until the process runs.
+    """
+
+    _memos: ClassVar[dict[BSONType, _AddressMemo[_KeyIndex]]] = {type: _AddressMemo() for type in _DOCUMENT_DISPLAYS}
+    "The memoized indexes for each document type, by document address"
+
+    def __init__(self, elements: Iterable[DocumentElement | DocumentError]) -> None:
+        self._elements = iter(elements)
+        "The elements that have not yet been indexed"
+        self._by_key: dict[str, DocumentElement] = {}
+        "The elements that have been indexed so far"
+
+    @classmethod
+    def get(cls, proc: SBProcess, addr: int, buf: bytes, start: int, end: int, type: BSONType) -> _KeyIndex:
+        """
+        Get the index for the document or array in ``buf[start:end]``, which
+        lives at ``addr`` in ``proc``.
+        """
+        memo = cls._memos[type]
+        index = memo.get(proc, addr)
+        if index is None:
+            display = _DOCUMENT_DISPLAYS[type]
+            index = _KeyIndex(display._parse_elems(buf, start, end))
+            memo.set(proc, addr, index)
+        return index
+
+    def find(self, key: str) -> DocumentElement | None:
+        """Find the (first) element with the given key, or ``None``"""
+        found = self._by_key.get(key)
+        if found is not None:
+            return found
+        for elem in self._elements:
+            if isinstance(elem, DocumentError):
+                continue
+            # For duplicate keys, keep the first
+            self._by_key.setdefault(elem.key, elem)
+            if elem.key == key:
+                return self._by_key[key]
+        return None
+
+
 class _MemoryCache:
     """
     Reading process memory is an extremely slow operation, and we don't want to
@@ -1389,14 +1581,55 @@ class _MemoryCache:
     thus all child elements can reuse that buffer when they parse and render
     their own contents.
 
-    This class implements that cache of memory segments
+    This class implements that cache of memory segments. Each segment is the
+    data of a single read. Segments may overlap, but one never lies within
+    another, so when sorted by base address their ends are sorted as well.
+    The segment for an address is then the one with the greatest base address
+    at or below it (found by binary search), which is also the one that
+    extends furthest beyond the address. The cache holds at most
+    ``budget`` bytes, evicting the least-recently-used segments beyond that.
+    The extent of each evicted segment is remembered, so that a display that
+    still refers to it (and cannot read the process itself) gets it re-read.
+
+    The cached data is only valid for a single (process ID, stop ID) pair, and
+    everything is dropped when that changes, since the process may have
+    modified any of the memory that we read previously. Within one stop, reads
+    that are already covered by the cache do not touch the process at all, and
+    other reads are widened to whole pages. A new segment replaces the segments
+    that it covers, but is never concatenated with its neighbors, so that no
+    read copies more data than it reads.
     """
 
-    def __init__(self):
-        self._segments: dict[int, bytes] = {}
-        "Segments of memory keyed by the base address of the read operation"
-
-    def get_cached(self, addr: int) -> bytes:
+    PAGE_SIZE: ClassVar[int] = 4096
+    "Reads from the process are widened to multiples of this alignment"
+
+    def __init__(self, budget: int = 64 * 1024 * 1024):
+        self.budget = budget
+        "The maximum number of bytes to keep before evicting old segments"
+        self._bases: list[int] = []
+        "The base addresses of the segments, in sorted order"
+        self._segments: OrderedDict[int, bytes] = OrderedDict()
+        "Segments of memory keyed by base address, from least- to most-recently used"
+        self._nbytes = 0
+        "The total number of bytes held in ``_segments``"
+        self._generation: tuple[int, int] | None = None
+        "The process ID and stop ID at which the cached segments were read"
+        self._process: SBProcess | None = None
+        "The process from which the cached segments were read"
+        self._evicted_bases: list[int] = []
+        "The base addresses of the evicted segments, in sorted order"
+        self._evicted: dict[int, int] = {}
+        "The sizes of the evicted segments, by base address"
+
+    def clear(self) -> None:
+        """Drop every cached segment"""
+        self._bases.clear()
+        self._segments.clear()
+        self._nbytes = 0
+        self._evicted_bases.clear()
+        self._evicted.clear()
+
+    def get_cached(self, addr: int) -> memoryview:
         """
         Find and return a chunk of memory that was previously read from the
         process. The ``addr`` must be an address within a BSON document that
@@ -1405,45 +1638,828 @@ class _MemoryCache:
         The returned buffer begins at exactly ``addr``, and contains the full
         remainder of the cached segment, which may be much longer than the
         caller actually needs. We don't need additional granularity for our
-        purposes, though.
+        purposes, though. The buffer is a view of the cached segment, so
+        nothing is copied.
         """
-        segment = self.segment_containing(addr)
+        data, inner_offset = self.get_cached_segment(addr)
+        return memoryview(data)[inner_offset:]
+
+    def get_cached_segment(self, addr: int) -> tuple[bytes, int]:
+        """
+        Like `get_cached`, but returns the entire cached segment and the offset
+        of ``addr`` within that segment.
+        """
+        segment = self._refill(addr, self.segment_containing(addr))
+        stats.count("memory cache hits" if segment else "memory cache misses")
         if not segment:
             # Memory does not exist?
             print(f"lldb_bson: Note: Attempted read of uncached address 0x{addr:x}")
             print("".join(traceback.format_stack()))
-            return b"\0" * 512
+            return b"\0" * 512, 0
         base_addr, data = segment
-        inner_offset = addr - base_addr
-        return data[inner_offset:]
+        return data, addr - base_addr
 
     def segment_containing(self, addr: int) -> tuple[int, bytes] | None:
         """Find the segment that contains ``addr``, or returns None"""
-        for base_addr, data in self._segments.items():
-            end_addr = base_addr + len(data)
-            if addr > end_addr or addr < base_addr:
-                continue
-            return base_addr, data
-        return None
-
-    def read(self, val: SBValue) -> tuple[int, bytes]:
+        # The only candidate is the segment with the greatest base <= addr:
+        idx = bisect.bisect_right(self._bases, addr) - 1
+        if idx < 0:
+            return None
+        base_addr = self._bases[idx]
+        data = self._segments[base_addr]
+        if addr >= base_addr + len(data):
+            return None
+        self._segments.move_to_end(base_addr)
+        return base_addr, data
+
+    def read(self, val: SBValue) -> tuple[int, memoryview]:
         """
         Read the memory segment referenced by the given SBValue
         """
         return self.read_at(val.process, val.load_addr, val.size)
 
-    def read_at(self, proc: SBProcess, addr: int, size: int) -> tuple[int, bytes]:
+    def read_at(self, proc: SBProcess, addr: int, size: int) -> tuple[int, memoryview]:
         """
         Read from ``proc`` a chunk of memory beginning at ``addr`` and continuing
-        for ``size`` bytes.
+        for ``size`` bytes. If the process has not run since the memory was
+        last read, the data is returned from the cache. The returned buffer is
+        a view of the cached segment, so nothing is copied.
+        """
+        data, offset = self.read_segment(proc, addr, size)
+        return addr, memoryview(data)[offset : offset + size]
+
+    def read_segment(self, proc: SBProcess, addr: int, size: int) -> tuple[bytes, int]:
+        """
+        Like `read_at`, but returns the entire cached segment that contains the
+        requested memory, and the offset of ``addr`` within that segment.
         """
+        generation = proc.id, proc.GetStopID()
+        if generation != self._generation:
+            # This is a different process, or the process has run since we last read from it
+            self.clear()
+            self._generation = generation
+            self._process = proc
+        end_addr = addr + size
+        segment = self.segment_containing(addr)
+        if segment is not None:
+            base_addr, data = segment
+            if end_addr <= base_addr + len(data):
+                # We already have all of it
+                stats.count("memory cache hits")
+                return data, addr - base_addr
+        stats.count("memory cache misses")
+        # Read whole pages so that nearby reads will be satisfied by this one:
+        page_mask = self.PAGE_SIZE - 1
+        read_base = addr & ~page_mask
+        read_end = (end_addr + page_mask) & ~page_mask
         err = SBError()
-        buf = proc.ReadMemory(addr, size, err)
+        with stats.timed("ReadMemory"):
+            buf = proc.ReadMemory(read_base, read_end - read_base, err)
         if err.fail:
-            raise LookupError(err.description)
+            # The surrounding pages might not be readable. Read only what was asked for:
+            read_base = addr
+            err = SBError()
+            with stats.timed("ReadMemory"):
+                buf = proc.ReadMemory(addr, size, err)
+            if err.fail:
+                raise LookupError(err.description)
+        self._insert(read_base, buf)
+        # The new data may have been merged with the segments around it:
+        segment = self.segment_containing(addr)
+        assert segment is not None
+        base_addr, data = segment
+        return data, addr - base_addr
+
+    def _insert(self, addr: int, buf: bytes) -> None:
+        """Add a segment, replacing the existing segments that lie within it"""
+        end_addr = addr + len(buf)
+        before = bisect.bisect_right(self._bases, addr) - 1
+        if before >= 0 and self._bases[before] + len(self._segments[self._bases[before]]) >= end_addr:
+            # Nothing new: A single segment already covers all of it
+            return
+        # The segments that lie within the new one are consecutive, since their ends are sorted:
+        lo = hi = bisect.bisect_left(self._bases, addr)
+        while hi < len(self._bases) and self._bases[hi] + len(self._segments[self._bases[hi]]) <= end_addr:
+            self._nbytes -= len(self._segments.pop(self._bases[hi]))
+            hi += 1
+        self._bases[lo:hi] = [addr]
         self._segments[addr] = buf
-        return addr, buf
+        self._nbytes += len(buf)
+        self._evict()
+
+    def _evict(self) -> None:
+        """Drop least-recently-used segments until we are within our budget"""
+        # Never evict the most recent segment, even if it is over budget by itself
+        while self._nbytes > self.budget and len(self._segments) > 1:
+            base, data = self._segments.popitem(last=False)
+            self._nbytes -= len(data)
+            del self._bases[bisect.bisect_left(self._bases, base)]
+            # Remember where it was, replacing the extents of earlier evictions
+            # that lie within it. Like the segments, no extent lies within another.
+            end = base + len(data)
+            before = bisect.bisect_right(self._evicted_bases, base) - 1
+            if before >= 0 and self._evicted_bases[before] + self._evicted[self._evicted_bases[before]] >= end:
+                continue
+            lo = hi = bisect.bisect_left(self._evicted_bases, base)
+            while (
+                hi < len(self._evicted_bases)
+                and self._evicted_bases[hi] + self._evicted[self._evicted_bases[hi]] <= end
+            ):
+                del self._evicted[self._evicted_bases[hi]]
+                hi += 1
+            self._evicted_bases[lo:hi] = [base]
+            self._evicted[base] = len(data)
+
+    def _refill(self, addr: int, segment: tuple[int, bytes] | None) -> tuple[int, bytes] | None:
+        """
+        Given the cached ``segment`` that contains ``addr`` (if any), re-read
+        from the process the evicted segment that contained ``addr``, if that
+        extended beyond ``segment``. Returns the segment that now contains
+        ``addr``, or None if ``addr`` was never cached.
+        """
+        idx = bisect.bisect_right(self._evicted_bases, addr) - 1
+        if idx < 0 or self._process is None:
+            return segment
+        base = self._evicted_bases[idx]
+        size = self._evicted[base]
+        if addr >= base + size:
+            return segment
+        if segment is not None and segment[0] + len(segment[1]) >= base + size:
+            # Still cached, as part of another segment
+            return segment
+        del self._evicted_bases[idx]
+        del self._evicted[base]
+        stats.count("memory cache refills")
+        try:
+            self.read_segment(self._process, base, size)
+        except LookupError:
+            return segment
+        return self.segment_containing(addr)
 
 
 memcache = _MemoryCache()
 "A module-wide memory segment cache."
+
+
+class _Settings:
+    """
+    Limits on how much of large documents and strings is displayed. These are
+    changed with the ``bson settings`` command, and take effect the next time
+    that a value is updated.
+    """
+
+    def __init__(self) -> None:
+        self.max_children = 10_000
+        "Documents with more elements than this are displayed as a sample of their elements (0 for no limit)"
+        self.max_string_bytes = 64 * 1024
+        "Strings are truncated to this many bytes (0 for no limit)"
+        self.sample_head = 1000
+        "The number of leading elements that are included in a sample"
+        self.sample_tail = 1000
+        "The number of trailing elements that are included in a sample"
+        self.sample_stride = 0
+        "Every this-many elements between the head and the tail are included in a sample (0 to fit max-children)"
+
+    def names(self) -> list[str]:
+        """The names of the settings, as given to the ``bson settings`` command"""
+        return [attr.replace("_", "-") for attr in vars(self)]
+
+    def get(self, name: str) -> int:
+        """Get the value of the setting ``name``"""
+        return getattr(self, name.replace("-", "_"))
+
+    def set(self, name: str, value: int) -> None:
+        """Change the value of the setting ``name``"""
+        setattr(self, name.replace("-", "_"), value)
+
+
+settings = _Settings()
+"The module-wide display limits, changed by ``bson settings``"
+
+
+class _Stats:
+    """
+    Opt-in profiling, enabled with ``bson stats on``.
+
+    Time is recorded for each entry point through which LLDB calls into this
+    module (see `print_errors`). Within each entry point, the time is broken
+    down by category: reading memory, evaluating expressions, and parsing.
+    Time that falls in no category is recorded as "python". The times of
+    nested categories are not included in their parents' times.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        "Whether statistics are being recorded"
+        self._entry = ""
+        "The name of the outermost entry point that is executing"
+        self._nested: list[list[float]] = []
+        "For each timing in progress, the time spent in the timings nested within it"
+        self._samples: dict[tuple[str, str | None], list[float]] = {}
+        "The recorded times, by entry point and category. The category of the entry point's total time is ``None``"
+        self._counts: dict[str, int] = {}
+        "The counters of cache hits and misses, by name"
+
+    def reset(self) -> None:
+        """Discard everything that has been recorded"""
+        self._samples.clear()
+        self._counts.clear()
+
+    def entry(self, fn: Callable[..., Any], args: Sequence[Any]) -> ContextManager[None]:
+        """Time a call of ``fn`` with ``args``, if it is the outermost entry point"""
+        if not self.enabled or self._nested:
+            return _NOT_TIMED
+        name = fn.__qualname__
+        if "." in name and args:
+            # Use the class that the method was called on, rather than the one that defines it:
+            owner = args[0] if isinstance(args[0], type) else type(args[0])
+            name = f"{owner.__name__}.{fn.__name__}"
+        self._entry = name
+        return self._timing(None)
+
+    def relabel_entry(self, name: str) -> None:
+        """Change the name of the entry point that is executing"""
+        if self._nested:
+            self._entry = name
+
+    def timed(self, category: str) -> ContextManager[None]:
+        """Time a block of code in the given category"""
+        return self._timing(category) if self.enabled else _NOT_TIMED
+
+    def timed_iter(self, category: str, items: Iterable[T]) -> Iterator[T]:
+        """Time the production of each item of ``items`` in the given category"""
+        it = iter(items)
+        while True:
+            with self.timed(category):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Add ``n`` to the counter ``name``"""
+        if self.enabled:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def _timing(self, category: str | None) -> Iterator[None]:
+        nested = [0.0]
+        self._nested.append(nested)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._nested.pop()
+            if self._nested:
+                self._nested[-1][0] += elapsed
+                self._samples.setdefault((self._entry, category), []).append(elapsed - nested[0])
+            else:
+                # This is the outermost timing, which is normally an entry point.
+                # Record the total, and the time that was not otherwise accounted for:
+                entry = self._entry if category is None else "(outside of an entry point)"
+                self._samples.setdefault((entry, None), []).append(elapsed)
+                self._samples.setdefault((entry, category or "python"), []).append(elapsed - nested[0])
+
+    def report(self) -> Iterator[str]:
+        """Generate the lines of a report of the recorded statistics"""
+        yield f"{'':<44} {'calls':>8} {'total ms':>10} {'p50 ms':>9} {'p99 ms':>9}"
+        entries = sorted({entry for entry, _ in self._samples}, key=lambda e: -sum(self._samples[e, None]))
+        for entry in entries:
+            yield self._report_line(entry, self._samples[entry, None])
+            for (e, category), samples in sorted(self._samples.items(), key=lambda i: -sum(i[1])):
+                if e == entry and category is not None:
+                    yield self._report_line(f"  {category}", samples)
+        for cache in ("memory", "type"):
+            hits = self._counts.get(f"{cache} cache hits", 0)
+            misses = self._counts.get(f"{cache} cache misses", 0)
+            rate = f"{hits / (hits + misses):.1%}" if hits + misses else "n/a"
+            yield f"{cache.capitalize()} cache: {hits} hits, {misses} misses (hit rate: {rate})"
+
+    @staticmethod
+    def _report_line(label: str, samples: Sequence[float]) -> str:
+        ordered = sorted(samples)
+        p50 = ordered[len(ordered) // 2]
+        p99 = ordered[min(len(ordered) - 1, len(ordered) * 99 // 100)]
+        return f"{label:<44} {len(ordered):>8} {sum(ordered) * 1000:>10.2f} {p50 * 1000:>9.3f} {p99 * 1000:>9.3f}"
+
+
+_NOT_TIMED = contextlib.nullcontext()
+"A context manager that does nothing, for when statistics are disabled"
+
+stats = _Stats()
+"The module-wide profiling statistics, reported by ``bson stats``"
+
+
+class _ElementStore:
+    """
+    An optional on-disk cache of the element tables of large parsed documents,
+    shared between LLDB sessions. This is useful when repeatedly opening core
+    dumps that contain the same large documents.
+
+    Entries are keyed by the SHA-256 digest of the document data (and by
+    whether it is parsed as an array). The content alone determines how a
+    document parses, so the same entry serves any address, process, or core.
+    """
+
+    MIN_DOCUMENT_SIZE: ClassVar[int] = 64 * 1024
+    "Smaller documents are quicker to parse than to look up"
+
+    def __init__(self) -> None:
+        self.enabled = False
+        "Whether the store is used by DocumentDisplay"
+        self._db: sqlite3.Connection | None = None
+        "The database connection, opened on first use"
+
+    @property
+    def path(self) -> Path:
+        """The path to the database file"""
+        return cache_root() / "elements.db"
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """Get the database connection, opening it if necessary"""
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Other LLDB sessions may be using the same database
+            self._db = sqlite3.connect(str(self.path), timeout=10, isolation_level=None)
+            self._db.execute(r"""
+                CREATE TABLE IF NOT EXISTS elements (
+                    digest TEXT NOT NULL,
+                    qualifier TEXT NOT NULL,
+                    elements TEXT NOT NULL,
+                    PRIMARY KEY (digest, qualifier)
+                )
+                """)
+        return self._db
+
+    def clear(self) -> None:
+        """Delete all stored element tables"""
+        self.db.execute("DELETE FROM elements")
+
+    def load_or_parse(
+        self, display: Type[DocumentDisplay], buf: bytes, start: int = 0, end: int | None = None
+    ) -> Iterable[DocumentElement | DocumentError]:
+        """
+        Yield the elements of the document in ``buf[start:end]`` from the store,
+        or parse them with ``display`` if they are not stored. A document that
+        is parsed to the end is then added to the store.
+        """
+        digest = hashlib.sha256(memoryview(buf)[start:end]).hexdigest()
+        row = self.db.execute(
+            "SELECT elements FROM elements WHERE digest = ? AND qualifier = ?",
+            (digest, display.__qualifier__),
+        ).fetchone()
+        if row is not None:
+            for item in json.loads(row[0]):
+                if item[0] is None:
+                    yield DocumentError(item[1], item[2])
+                else:
+                    yield DocumentElement(BSONType(item[0]), item[1], item[2], item[3])
+            return
+        parsed: list[DocumentElement | DocumentError] = []
+        for item in display._parse_elems(buf, start, end):
+            parsed.append(item)
+            yield item
+        # Only reached if the caller consumed every element:
+        encoded = json.dumps(
+            [(None, *item) if isinstance(item, DocumentError) else (item.type.value, *item[1:]) for item in parsed]
+        )
+        self.db.execute(
+            "INSERT OR REPLACE INTO elements (digest, qualifier, elements) VALUES (?, ?, ?)",
+            (digest, display.__qualifier__, encoded),
+        )
+
+
+element_store = _ElementStore()
+"The module-wide on-disk element table store"
+
+
+def cache_root() -> Path:
+    """Get the directory in which lldb_bson keeps its persistent caches"""
+    if sys.platform == "win32":
+        return Path(os.environ["LocalAppData"]) / "lldb_bson"
+    if sys.platform == "darwin":
+        return Path.home() / "Library/Caches/lldb_bson"
+    xdg_cache = os.getenv("XDG_CACHE_HOME")
+    if xdg_cache:
+        return Path(xdg_cache) / "lldb_bson"
+    return Path.home() / ".cache/lldb_bson"
+
+
+@functools.lru_cache()
+def _tag_after_prefix_re(max_size: int) -> re.Pattern[bytes]:
+    """
+    Get a regex that matches a valid element type tag that follows a plausible
+    length prefix for documents of at most ``max_size`` bytes. We match on the
+    tag and look behind at the high byte of the prefix (which is zero for
+    documents below 16 MiB), since this lets the regex engine skip quickly
+    through both random data and runs of zeros.
+    """
+    high = min(max_size, 0x7FFF_FFFF) >> 24
+    return re.compile(rb"[\x01-\x13\x7f\xff](?<=[\x00-%s].)" % re.escape(bytes([high])), re.DOTALL)
+
+
+_EMPTY_DOCUMENT = b"\x05\x00\x00\x00\x00"
+"The encoding of an empty document"
+
+
+def _candidate_offsets(buf: bytes, max_size: int) -> Iterator[int]:
+    """
+    Yield the offsets at which a plausible document of at most ``max_size``
+    bytes may begin within ``buf``, in increasing order
+    """
+    tagged = (mat.start() - 4 for mat in _tag_after_prefix_re(max_size).finditer(buf, 4))
+
+    def _empties() -> Iterator[int]:
+        offset = buf.find(_EMPTY_DOCUMENT)
+        while offset >= 0:
+            yield offset
+            offset = buf.find(_EMPTY_DOCUMENT, offset + 1)
+
+    return heapq.merge(tagged, _empties())
+
+
+class ScannedDocument(NamedTuple):
+    """A document found by `scan_documents`"""
+
+    addr: int
+    "The address of the beginning of the document"
+    size: int
+    "The size of the document, in bytes"
+
+
+def readable_regions(proc: SBProcess) -> Iterator[tuple[int, int]]:
+    """Yield the ``(begin, end)`` addresses of the readable memory regions of ``proc``"""
+    regions = proc.GetMemoryRegions()
+    info = lldb.SBMemoryRegionInfo()
+    for n in range(regions.GetSize()):
+        if regions.GetMemoryRegionAtIndex(n, info) and info.IsReadable():
+            yield info.GetRegionBase(), info.GetRegionEnd()
+
+
+def scan_documents(
+    proc: SBProcess,
+    *,
+    min_size: int = 5,
+    max_size: int = 16 * 1024 * 1024,
+    chunk_size: int = 16 * 1024 * 1024,
+) -> Iterator[ScannedDocument]:
+    """
+    Search the readable memory of ``proc`` for data that parses as a BSON
+    document. The memory is read ``chunk_size`` bytes at a time, so at most
+    ``chunk_size + max_size`` bytes are held at once.
+
+    Documents that are nested within a found document are not reported
+    separately.
+    """
+    for region_begin, region_end in readable_regions(proc):
+        pos = region_begin
+        while pos < region_end:
+            chunk_end = min(region_end, pos + chunk_size)
+            err = SBError()
+            buf = proc.ReadMemory(pos, chunk_end - pos, err)
+            if err.fail:
+                pos = chunk_end
+                continue
+            # Candidates before this offset are nested within a document that we found
+            skip_to = 0
+            for offset in _candidate_offsets(buf, max_size):
+                if offset < skip_to:
+                    continue
+                size = read_i32le(buf, offset)
+                if size < min_size or size > max_size or pos + offset + size > region_end:
+                    continue
+                if offset + size <= len(buf):
+                    data, start = buf, offset
+                else:
+                    # The document continues beyond this chunk
+                    err = SBError()
+                    data, start = proc.ReadMemory(pos + offset, size, err), 0
+                    if err.fail:
+                        continue
+                # Check the terminator before doing a full parse:
+                if data[start + size - 1] != 0:
+                    continue
+                if any(isinstance(e, DocumentError) for e in DocumentDisplay._parse_elems(data, start, start + size)):
+                    continue
+                yield ScannedDocument(pos + offset, size)
+                skip_to = offset + size
+            # The next chunk overlaps this one by the size of a length prefix,
+            # since a candidate needs to be followed by a type tag. But don't
+            # re-read the tail of a document that extends past this chunk:
+            next_pos = chunk_end - 4 if chunk_end < region_end else chunk_end
+            pos = max(next_pos, pos + skip_to)
+
+
+class CommandError(Exception):
+    """Raised by subcommands to report an error to the user"""
+
+
+class _ArgumentParser(argparse.ArgumentParser):
+    """An argument parser that raises CommandError rather than exiting the process"""
+
+    @override
+    def error(self, message: str) -> NoReturn:
+        raise CommandError(f"{self.format_usage()}{self.prog}: error: {message}")
+
+    @override
+    def exit(self, status: int = 0, message: str | None = None) -> NoReturn:
+        # Only reached after printing help
+        raise CommandError(message or "")
+
+
+SubcommandFn = Callable[[SBExecutionContext, Sequence[str], SBCommandReturnObject], None]
+"The type of functions that implement a ``bson`` subcommand"
+
+_SUBCOMMANDS: dict[str, SubcommandFn] = {}
+"The subcommands of the ``bson`` command, by name"
+
+
+def subcommand(name: str) -> Callable[[SubcommandFn], SubcommandFn]:
+    """Decorator that registers a function as the ``bson`` subcommand ``name``"""
+
+    def _register(fn: SubcommandFn) -> SubcommandFn:
+        _SUBCOMMANDS[name] = fn
+        return fn
+
+    return _register
+
+
+@print_errors
+def bson_command(
+    debugger: SBDebugger, command: str, exe_ctx: SBExecutionContext, result: SBCommandReturnObject, idict: InternalDict
+) -> None:
+    """Implements the ``bson`` LLDB command by dispatching to a subcommand"""
+    argv = shlex.split(command)
+    if not argv or argv[0] not in _SUBCOMMANDS:
+        result.SetError(f"Usage: bson {{{','.join(_SUBCOMMANDS)}}} [args...]")
+        return
+    stats.relabel_entry(f"bson {argv[0]}")
+    try:
+        _SUBCOMMANDS[argv[0]](exe_ctx, argv[1:], result)
+    except CommandError as e:
+        # An empty message means that only help was requested
+        if str(e):
+            result.SetError(str(e))
+
+
+@subcommand("warmup")
+def _warmup_command(exe_ctx: SBExecutionContext, argv: Sequence[str], result: SBCommandReturnObject) -> None:
+    """Generate the common element types for the current target ahead of time"""
+    _ArgumentParser(prog="bson warmup", description=_warmup_command.__doc__).parse_args(argv)
+    if not exe_ctx.frame.IsValid():
+        raise CommandError("There is no selected frame in which to generate types")
+    warm_up_types(exe_ctx.frame)
+    result.AppendMessage("Generated the common BSON element types")
+
+
+@subcommand("cache")
+def _cache_command(exe_ctx: SBExecutionContext, argv: Sequence[str], result: SBCommandReturnObject) -> None:
+    """Control the on-disk cache of the element tables of large documents"""
+    parser = _ArgumentParser(prog="bson cache", description=_cache_command.__doc__)
+    parser.add_argument("action", choices=["on", "off", "clear", "status"])
+    args = parser.parse_args(argv)
+    if args.action == "on":
+        element_store.enabled = True
+    elif args.action == "off":
+        element_store.enabled = False
+    elif args.action == "clear":
+        element_store.clear()
+    state = "enabled" if element_store.enabled else "disabled"
+    result.AppendMessage(f"The element cache at {element_store.path} is {state}")
+
+
+@subcommand("settings")
+def _settings_command(exe_ctx: SBExecutionContext, argv: Sequence[str], result: SBCommandReturnObject) -> None:
+    """Show or change the limits on how much of large documents and strings is displayed"""
+    parser = _ArgumentParser(prog="bson settings", description=_settings_command.__doc__)
+    parser.add_argument("name", nargs="?", choices=settings.names(), help="The setting to show or change")
+    parser.add_argument("value", nargs="?", type=int, help="The new value of the setting")
+    args = parser.parse_args(argv)
+    if args.value is not None:
+        if args.value < 0:
+            raise CommandError(f"The value of {args.name} must not be negative")
+        settings.set(args.name, args.value)
+    for name in [args.name] if args.name else settings.names():
+        result.AppendMessage(f"{name} = {settings.get(name)}")
+
+
+@subcommand("stats")
+def _stats_command(exe_ctx: SBExecutionContext, argv: Sequence[str], result: SBCommandReturnObject) -> None:
+    """Profile where time is spent when displaying BSON values"""
+    parser = _ArgumentParser(prog="bson stats", description=_stats_command.__doc__)
+    parser.add_argument("action", nargs="?", choices=["on", "off", "reset", "show"], default="show")
+    args = parser.parse_args(argv)
+    if args.action == "on":
+        stats.enabled = True
+    elif args.action == "off":
+        stats.enabled = False
+    elif args.action == "reset":
+        stats.reset()
+    else:
+        for line in stats.report():
+            result.AppendMessage(line)
+        return
+    result.AppendMessage(f"Profiling is {'enabled' if stats.enabled else 'disabled'}")
+
+
+@subcommand("scan")
+def _scan_command(exe_ctx: SBExecutionContext, argv: Sequence[str], result: SBCommandReturnObject) -> None:
+    """Search the memory of the process (or core) for BSON documents"""
+    parser = _ArgumentParser(prog="bson scan", description=_scan_command.__doc__)
+    parser.add_argument("--min-size", type=int, default=5, help="Ignore documents smaller than this many bytes")
+    parser.add_argument(
+        "--max-size", type=int, default=16 * 1024 * 1024, help="Ignore documents larger than this many bytes"
+    )
+    parser.add_argument("--chunk-size", type=int, default=16, help="Read memory this many MiB at a time")
+    parser.add_argument("--list", action="store_true", help="Print the address and size of every document")
+    args = parser.parse_args(argv)
+    if not exe_ctx.process.IsValid():
+        raise CommandError("There is no process to scan")
+    count = 0
+    total = 0
+    # Count documents by the power of two that bounds their size:
+    histogram: dict[int, int] = {}
+    for doc in scan_documents(
+        exe_ctx.process, min_size=args.min_size, max_size=args.max_size, chunk_size=args.chunk_size * 1024 * 1024
+    ):
+        count += 1
+        total += doc.size
+        bucket = (doc.size - 1).bit_length()
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+        if args.list:
+            result.AppendMessage(f"0x{doc.addr:x}: {doc.size} bytes")
+    result.AppendMessage(f"Found {count} documents totalling {total} bytes")
+    for bucket in sorted(histogram):
+        result.AppendMessage(
+            f"  {1 << (bucket - 1) if bucket else 0:>10} < size <= {1 << bucket:<10} {histogram[bucket]:>10}"
+        )
+
+
+@subcommand("export")
+def _export_command(exe_ctx: SBExecutionContext, argv: Sequence[str], result: SBCommandReturnObject) -> None:
+    """Write BSON documents to a file as Extended JSON, with one document per line"""
+    parser = _ArgumentParser(prog="bson export", description=_export_command.__doc__)
+    parser.add_argument("expr", nargs="*", help="Expressions that evaluate to a bson_t or a pointer to a bson_t")
+    parser.add_argument(
+        "--raw",
+        nargs=2,
+        action="append",
+        default=[],
+        type=lambda s: int(s, 0),
+        metavar=("ADDRESS", "LENGTH"),
+        help="Export the document of LENGTH bytes at ADDRESS (may be repeated)",
+    )
+    parser.add_argument("--output", "-o", required=True, type=Path, help="The file to write")
+    parser.add_argument(
+        "--canonical", action="store_true", help="Generate Canonical Extended JSON, rather than Relaxed"
+    )
+    args = parser.parse_args(argv)
+    proc = exe_ctx.process
+    if not proc.IsValid():
+        raise CommandError("There is no process to read from")
+    # Find the address and size of each document:
+    docs = [_document_location(exe_ctx, expr) for expr in args.expr]
+    docs.extend((addr, length) for addr, length in args.raw)
+    # Write the documents as we encode them:
+    nbytes = 0
+    with args.output.open("w", encoding="utf-8") as out:
+        for addr, size in docs:
+            buf = _read_document(proc, addr, size)
+            try:
+                for frag in iter_extjson(buf, relaxed=not args.canonical):
+                    out.write(frag)
+            except ValueError as e:
+                raise CommandError(f"Document at 0x{addr:x} is invalid: {e}")
+            out.write("\n")
+            nbytes += size
+    result.AppendMessage(f"Wrote {len(docs)} documents ({nbytes} bytes of BSON) to {args.output}")
+
+
+def _document_location(exe_ctx: SBExecutionContext, expr: str) -> tuple[int, int]:
+    """Evaluate ``expr`` to a bson_t in the selected frame, and get the address and size of its data"""
+    val = exe_ctx.frame.EvaluateExpression(expr)
+    if val.error.fail:
+        raise CommandError(f"Failed to evaluate {expr!r}: {val.error.description}")
+    info = BSONTDisplay.__parse__(val)
+    if isinstance(info, BSONTError):
+        raise CommandError(f"{expr!r} is not a valid bson_t: {info.reason}")
+    return info.addr, info.size
+
+
+def _read_document(proc: SBProcess, addr: int, size: int) -> bytes:
+    """Read the data of a document directly from the process"""
+    err = SBError()
+    buf = proc.ReadMemory(addr, size, err)
+    if err.fail:
+        raise CommandError(f"Failed to read {size} bytes at 0x{addr:x}: {err.description}")
+    return buf
+
+
+class _DiffSnapshot(NamedTuple):
+    """A document saved by ``bson diff save``"""
+
+    expr: str | None
+    "The expression that was given for the document, if any"
+    addr: int
+    "The address of the document data when it was saved"
+    stop_id: int
+    "The stop ID of the process when the document was saved"
+    doc: DocumentSnapshot
+    "The saved document"
+
+
+_diff_snapshots: dict[str, _DiffSnapshot] = {}
+"The snapshots saved by ``bson diff save``, by name"
+
+
+@subcommand("diff")
+def _diff_command(exe_ctx: SBExecutionContext, argv: Sequence[str], result: SBCommandReturnObject) -> None:
+    """Save a snapshot of a document, and later show how the document has changed"""
+    parser = _ArgumentParser(
+        prog="bson diff",
+        description=_diff_command.__doc__,
+        epilog="Use 'save NAME EXPR' to take a snapshot of a bson_t, then 'compare NAME' after it has changed. "
+        "Without an EXPR, 'compare' re-evaluates the saved expression.",
+    )
+    parser.add_argument("action", choices=["save", "compare", "list", "drop"])
+    parser.add_argument("name", nargs="?", help="The name of the snapshot")
+    parser.add_argument("expr", nargs="?", help="An expression that evaluates to a bson_t or a pointer to a bson_t")
+    parser.add_argument(
+        "--raw",
+        nargs=2,
+        type=lambda s: int(s, 0),
+        metavar=("ADDRESS", "LENGTH"),
+        help="Use the document of LENGTH bytes at ADDRESS, rather than an expression",
+    )
+    parser.add_argument("--update", action="store_true", help="With 'compare', replace the snapshot afterwards")
+    parser.add_argument("--max-width", type=int, default=100, help="Truncate values to this many characters")
+    args = parser.parse_args(argv)
+    if args.action == "list":
+        for name, snap in _diff_snapshots.items():
+            source = snap.expr or f"0x{snap.addr:x}"
+            result.AppendMessage(f"{name}: {source} ({len(snap.doc.data)} bytes at stop {snap.stop_id})")
+        return
+    if args.name is None:
+        raise CommandError(f"A snapshot name is required for '{args.action}'")
+    if args.action == "drop":
+        if _diff_snapshots.pop(args.name, None) is None:
+            raise CommandError(f"There is no snapshot named {args.name!r}")
+        return
+
+    proc = exe_ctx.process
+    if not proc.IsValid():
+        raise CommandError("There is no process to read from")
+    saved = _diff_snapshots.get(args.name)
+    if args.action == "compare" and saved is None:
+        raise CommandError(f"There is no snapshot named {args.name!r}")
+    expr: str | None = args.expr
+    if args.raw is not None:
+        addr, size = args.raw
+    elif expr is not None:
+        addr, size = _document_location(exe_ctx, expr)
+    elif args.action == "compare" and saved is not None:
+        # Read the same document again, from the same expression or address:
+        expr = saved.expr
+        if expr is not None:
+            addr, size = _document_location(exe_ctx, expr)
+        else:
+            addr, size = saved.addr, read_i32le(_read_document(proc, saved.addr, 4))
+    else:
+        raise CommandError("An expression or --raw is required")
+    data = _read_document(proc, addr, size)
+
+    if args.action == "save":
+        _diff_snapshots[args.name] = _DiffSnapshot(expr, addr, proc.GetStopID(), DocumentSnapshot(data))
+        result.AppendMessage(f"Saved {size} bytes at 0x{addr:x} as {args.name!r}")
+        return
+
+    assert saved is not None
+    try:
+        changes = list(diff_documents(saved.doc, data))
+    except ValueError as e:
+        raise CommandError(f"Cannot compare invalid document data: {e}")
+    result.AppendMessage(
+        f"{len(changes)} changes since {args.name!r} was saved at stop {saved.stop_id} "
+        f"({len(saved.doc.data)} → {size} bytes)"
+    )
+    for change in changes:
+        _append_change(result, change, args.max_width)
+    if args.update:
+        _diff_snapshots[args.name] = saved._replace(addr=addr, stop_id=proc.GetStopID(), doc=DocumentSnapshot(data))
+
+
+def _append_change(result: SBCommandReturnObject, change: DocumentChange, max_width: int) -> None:
+    """Print one change found by ``bson diff compare``"""
+
+    def clip(s: str | None) -> str | None:
+        return s if s is None or len(s) <= max_width else s[:max_width] + "…"
+
+    if change.kind == "added":
+        result.AppendMessage(f"  + {change.path}: {clip(change.new)}")
+    elif change.kind == "removed":
+        result.AppendMessage(f"  - {change.path}: {clip(change.old)}")
+    else:
+        result.AppendMessage(f"  ~ {change.path}: {clip(change.old)} → {clip(change.new)}")
@@ -0,0 +1,283 @@
+"""
+Benchmarks for the LLDB-independent BSON decoding used by ``lldb_bson``.
+
+These measure the functions in ``lldb_bson_parse`` directly on bytes, so no
+debugger is required. The inputs are the BSON corpus test vectors from
+``src/libbson/tests/json/bson_corpus`` plus generated large documents.
+
+Run all benchmarks and print the results::
+
+    python lldb_bson_bench.py
+
+Save the results, and later compare against them, failing if any benchmark
+became more than 25% slower::
+
+    python lldb_bson_bench.py --json baseline.json
+    python lldb_bson_bench.py --compare baseline.json --max-regression 0.25
+
+CI runs the ``--quick`` benchmarks against ``lldb_bson_bench_baseline.json``,
+failing only if a benchmark became twice as slow, since CI hosts differ. When a
+change is expected to alter the timings, regenerate that file with::
+
+    python lldb_bson_bench.py --quick --json lldb_bson_bench_baseline.json
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import functools
+import json
+import math
+import re
+import struct
+import sys
+import timeit
+from pathlib import Path
+from typing import Any, Callable, Iterable, NamedTuple, Sequence
+
+from lldb_bson_parse import (
+    BSONType,
+    DocumentElement,
+    ElementIndex,
+    datetime_fields,
+    datetime_summaries_at,
+    datetime_summary,
+    decode_decimal128,
+    decode_decimal128_at,
+    iter_extjson,
+    parse_document,
+    parse_elements,
+    parse_regex,
+)
+
+THIS_DIR = Path(__file__).resolve().parent
+DEFAULT_CORPUS_DIR = THIS_DIR / "src/libbson/tests/json/bson_corpus"
+
+
+class Benchmark(NamedTuple):
+    name: str
+    "The name of the benchmark"
+    fn: Callable[[], Any]
+    "The function to time"
+    units: int
+    "The number of items that each call to ``fn`` processes"
+
+
+class Result(NamedTuple):
+    name: str
+    seconds: float
+    "The best time of a single call"
+    units: int
+
+
+def load_corpus(corpus_dir: Path) -> list[bytes]:
+    """Load the valid documents from the BSON corpus test vectors"""
+    docs: list[bytes] = []
+    for path in sorted(corpus_dir.glob("*.json")):
+        data = json.loads(path.read_text(encoding="utf-8"))
+        docs.extend(bytes.fromhex(case["canonical_bson"]) for case in data.get("valid", ()))
+    if not docs:
+        raise RuntimeError(f"No BSON corpus test vectors were found in {corpus_dir}")
+    return docs
+
+
+def values_of_type(docs: Iterable[bytes], type: BSONType) -> list[tuple[bytes, int]]:
+    """Find the ``(document, offset)`` of every top-level element value of the given type"""
+    return [
+        (doc, elem.value_offset)
+        for doc in docs
+        for elem in parse_elements(doc)
+        if isinstance(elem, DocumentElement) and elem.type == type
+    ]
+
+
+def _element(type: BSONType, key: str, value: bytes) -> bytes:
+    return bytes([type.value]) + key.encode() + b"\0" + value
+
+
+def _document(elements: Iterable[bytes]) -> bytes:
+    body = b"".join(elements)
+    return struct.pack("<i", len(body) + 5) + body + b"\0"
+
+
+def _string(s: str) -> bytes:
+    enc = s.encode() + b"\0"
+    return struct.pack("<i", len(enc)) + enc
+
+
+def generate_document(size: int) -> bytes:
+    """
+    Generate a document of at least ``size`` bytes with a mix of element types,
+    resembling a large array of records.
+    """
+    records: list[bytes] = []
+    nbytes = 0
+    while nbytes < size:
+        n = len(records)
+        record = _document(
+            [
+                _element(BSONType.Int32, "_id", struct.pack("<i", n)),
+                _element(BSONType.UTF8, "name", _string(f"user-{n:08}")),
+                _element(BSONType.Double, "score", struct.pack("<d", n / 7)),
+                _element(BSONType.Datetime, "updated", struct.pack("<q", 1_600_000_000_000 + n)),
+                _element(BSONType.Bool, "active", bytes([n % 2])),
+                _element(
+                    BSONType.Array, "tags", _document(_element(BSONType.UTF8, str(i), _string("t")) for i in range(3))
+                ),
+            ]
+        )
+        records.append(_element(BSONType.Document, str(n), record))
+        nbytes += len(records[-1])
+    return _document(records)
+
+
+def generate_array(type: BSONType, values: Sequence[bytes]) -> tuple[bytes, list[int]]:
+    """Generate an array of the given encoded values, and return it with the offsets of the values"""
+    arr = _document(_element(type, str(i), val) for i, val in enumerate(values))
+    return arr, [elem.value_offset for elem in parse_elements(arr, is_array=True) if isinstance(elem, DocumentElement)]
+
+
+def _consume(it: Iterable[Any]) -> None:
+    for _ in it:
+        pass
+
+
+def _parse_all(doc: bytes) -> None:
+    _consume(parse_document(doc).elements)
+
+
+def _index_all(doc: bytes) -> None:
+    len(ElementIndex(doc))
+
+
+def _extjson_all(doc: bytes) -> None:
+    _consume(iter_extjson(doc))
+
+
+def make_benchmarks(corpus: Sequence[bytes], large_sizes: Iterable[int]) -> list[Benchmark]:
+    """Create the benchmarks for the given corpus documents and generated document sizes"""
+    decimals = [doc[off : off + 16] for doc, off in values_of_type(corpus, BSONType.Decimal128)]
+    regexes = values_of_type(corpus, BSONType.Regex)
+    datetimes = [struct.unpack_from("<q", doc, off)[0] for doc, off in values_of_type(corpus, BSONType.Datetime)]
+    # Only dates that Python can represent can be displayed:
+    datetimes = [d for d in datetimes if 0 <= d < 253402300800000]
+
+    def parse_corpus() -> None:
+        for doc in corpus:
+            _consume(parse_document(doc).elements)
+
+    def extjson_corpus() -> None:
+        for doc in corpus:
+            _consume(iter_extjson(doc))
+
+    def decode_decimals() -> None:
+        for dat in decimals:
+            decode_decimal128(dat)
+
+    def parse_regexes() -> None:
+        for doc, off in regexes:
+            parse_regex(doc, off)
+
+    def format_datetimes() -> None:
+        for millis in datetimes:
+            datetime_summary(millis)
+            datetime_fields(millis)
+
+    # Time-series style arrays, with values that are close together:
+    n = 100_000
+    decimal_array, decimal_offsets = generate_array(
+        BSONType.Decimal128, [(1000 + i % 500).to_bytes(14, "little") + b"\x3c\x30" for i in range(n)]
+    )
+    datetime_array, datetime_offsets = generate_array(
+        BSONType.Datetime, [struct.pack("<q", 1_600_000_000_000 + i * 10) for i in range(n)]
+    )
+
+    benches = [
+        Benchmark("corpus/parse", parse_corpus, len(corpus)),
+        Benchmark("corpus/extjson", extjson_corpus, len(corpus)),
+        Benchmark("decimal128/decode", decode_decimals, len(decimals)),
+        Benchmark("decimal128/decode-array", lambda: decode_decimal128_at(decimal_array, decimal_offsets), n),
+        Benchmark("regex/parse", parse_regexes, len(regexes)),
+        Benchmark("datetime/format", format_datetimes, len(datetimes)),
+        Benchmark("datetime/summarize-array", lambda: datetime_summaries_at(datetime_array, datetime_offsets), n),
+    ]
+    for size in large_sizes:
+        doc = generate_document(size)
+        label = f"{size >> 20}MiB"
+        benches += [
+            Benchmark(f"large-{label}/parse", functools.partial(_parse_all, doc), 1),
+            Benchmark(f"large-{label}/index", functools.partial(_index_all, doc), 1),
+            Benchmark(f"large-{label}/extjson", functools.partial(_extjson_all, doc), 1),
+        ]
+    return benches
+
+
+def run(bench: Benchmark, min_time: float, repeat: int) -> Result:
+    """Time the benchmark, returning the best of ``repeat`` rounds of at least ``min_time`` seconds each"""
+    timer = timeit.Timer(bench.fn)
+    # Find a number of calls that takes at least 0.2 seconds, then scale it up to min_time:
+    number, elapsed = timer.autorange()
+    number = max(number, math.ceil(number * min_time / elapsed))
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    return Result(bench.name, best, bench.units)
+
+
+def compare(results: Sequence[Result], baseline: dict[str, float], max_regression: float) -> list[str]:
+    """Get a message for each result that is more than ``max_regression`` slower than in the baseline"""
+    failures: list[str] = []
+    for res in results:
+        prev = baseline.get(res.name)
+        if prev is None:
+            continue
+        change = res.seconds / prev - 1
+        print(f"  {res.name:<28} {change:+8.1%}")
+        if change > max_regression:
+            failures.append(f"{res.name} is {change:.1%} slower than the baseline ({res.seconds:.6f}s vs {prev:.6f}s)")
+    return failures
+
+
+def main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", type=Path, default=DEFAULT_CORPUS_DIR, help="The BSON corpus directory")
+    parser.add_argument("-k", metavar="REGEX", help="Only run the benchmarks whose name matches this pattern")
+    parser.add_argument("--quick", action="store_true", help="Skip the largest document, and time fewer rounds")
+    parser.add_argument("--json", metavar="FILE", type=Path, help="Write the results to this file")
+    parser.add_argument("--compare", metavar="FILE", type=Path, help="Compare against results saved with --json")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.25,
+        metavar="FRACTION",
+        help="With --compare, fail if a benchmark is slower by more than this fraction (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+
+    sizes = [1 << 20, 4 << 20] if args.quick else [1 << 20, 4 << 20, 16 << 20]
+    benches = make_benchmarks(load_corpus(args.corpus), sizes)
+    if args.k:
+        benches = [b for b in benches if re.search(args.k, b.name)]
+
+    results: list[Result] = []
+    for bench in benches:
+        res = run(bench, min_time=0.2 if args.quick else 1.0, repeat=3 if args.quick else 5)
+        results.append(res)
+        per_unit = res.seconds / res.units if res.units else 0
+        print(f"{res.name:<28} {res.seconds * 1000:10.3f} ms {per_unit * 1e6:10.3f} µs/item  ({res.units} items)")
+
+    if args.json:
+        args.json.write_text(json.dumps({r.name: r.seconds for r in results}, indent=2) + "\n", encoding="utf-8")
+
+    if args.compare:
+        print(f"Compared to {args.compare}:")
+        baseline: dict[str, float] = json.loads(args.compare.read_text(encoding="utf-8"))
+        failures = compare(results, baseline, args.max_regression)
+        for msg in failures:
+            print(f"REGRESSION: {msg}", file=sys.stderr)
+        if failures:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
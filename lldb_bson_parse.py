@@ -0,0 +1,904 @@
+"""
+Decoding of raw BSON data for the ``lldb_bson`` module.
+
+Nothing in this module depends on LLDB: everything here works on plain
+``bytes``, so it can be imported (and benchmarked) outside of a debugger
+session. ``lldb_bson`` builds its displays on top of these functions.
+"""
+
+from __future__ import annotations
+
+import array
+import base64
+import bisect
+import decimal
+import enum
+import functools
+import json
+import math
+import struct
+import sys
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Any, Generator, Iterable, Iterator, NamedTuple, Sequence, TypeVar
+
+if TYPE_CHECKING:
+    from typing_extensions import override
+else:
+
+    def override(f: T) -> T:
+        return f
+
+
+T = TypeVar("T")
+"Unbounded invariant type parameter"
+
+
+class LazySequence(Sequence[T]):
+    """
+    A sequence whose items are pulled from an iterable only when they are first
+    requested. Items that have been pulled are kept, so each item is only ever
+    computed once.
+    """
+
+    def __init__(self, items: Iterable[T]) -> None:
+        self._iter = iter(items)
+        "The iterator that produces the remaining items"
+        self._items: list[T] = []
+        "The items that have been pulled so far"
+        self._done = False
+        "Whether the iterator has been exhausted"
+
+    def count_up_to(self, n: int) -> int:
+        """
+        Return the number of items, or ``n`` if there are at least ``n`` items.
+        Does not pull any more than ``n`` items.
+        """
+        while len(self._items) < n and not self._done:
+            try:
+                self._items.append(next(self._iter))
+            except StopIteration:
+                self._done = True
+        return min(len(self._items), n)
+
+    @override
+    def __len__(self) -> int:
+        while not self._done:
+            self.count_up_to(len(self._items) + 1)
+        return len(self._items)
+
+    @override
+    def __getitem__(self, idx: int) -> T:  # type: ignore[override]
+        if isinstance(idx, slice) or idx < 0:
+            # These require knowing the full length
+            len(self)
+        elif self.count_up_to(idx + 1) <= idx:
+            raise IndexError(idx)
+        return self._items[idx]
+
+    @override
+    def __iter__(self) -> Iterator[T]:
+        idx = 0
+        while self.count_up_to(idx + 1) > idx:
+            yield self._items[idx]
+            idx += 1
+
+
+class BSONType(enum.Enum):
+    """The values for each bson element type tag"""
+
+    EOD = 0
+    Double = 0x1
+    UTF8 = 0x2
+    Document = 0x3
+    Array = 0x4
+    Binary = 0x5
+    Undefined = 0x6
+    ObjectID = 0x7
+    Bool = 0x8
+    Datetime = 0x9
+    Null = 0xA
+    Regex = 0xB
+    DBPointer = 0xC
+    Code = 0xD
+    Symbol = 0xE
+    CodeWithScope = 0xF
+    Int32 = 0x10
+    Timestamp = 0x11
+    Int64 = 0x12
+    Decimal128 = 0x13
+    MinKey = 255
+    MaxKey = 127
+
+
+_FIXED_VALUE_SIZES: dict[BSONType, int] = {
+    BSONType.Double: 8,
+    BSONType.Bool: 1,
+    BSONType.Undefined: 0,
+    BSONType.Null: 0,
+    BSONType.MinKey: 0,
+    BSONType.MaxKey: 0,
+    BSONType.Datetime: 8,
+    BSONType.ObjectID: 12,
+    BSONType.Int32: 4,
+    BSONType.Timestamp: 8,
+    BSONType.Int64: 8,
+    BSONType.Decimal128: 16,
+}
+"The sizes of element values that have a fixed size, by their type tag"
+
+
+_I32LE = struct.Struct("<i")
+
+
+def read_i32le(dat: bytes | memoryview, offset: int = 0) -> int:
+    """Read a 32-bit integer from the given data, beginning at ``offset``."""
+    # Read in-place, without copying the buffer:
+    return _I32LE.unpack_from(dat, offset)[0]
+
+
+class DocumentInfo(NamedTuple):
+    """A decoded document"""
+
+    elements: LazySequence[DocumentElement | DocumentError]
+    """
+    Existing elements or errors found while parsing the data. Elements are only
+    parsed as far as they are requested.
+    """
+
+
+class DocumentElement(NamedTuple):
+    """Represents an element within a document"""
+
+    type: BSONType
+    key: str
+    value_offset: int
+    "Offset from the beginning of the document data where the element's value appears"
+    value_size: int
+    "The size of the element's value (in bytes)"
+
+
+class DocumentError(NamedTuple):
+    """Represents an error while decoding a document"""
+
+    message: str
+    error_offset: int
+
+
+def parse_document(buf: bytes, *, is_array: bool = False) -> DocumentInfo:
+    """
+    Parse the document that occupies all of ``buf``. The elements are parsed
+    lazily as they are accessed.
+    """
+    return DocumentInfo(LazySequence(parse_elements(buf, is_array=is_array)))
+
+
+def parse_elements(
+    buf: bytes, start: int = 0, end: int | None = None, *, is_array: bool = False
+) -> Iterator[DocumentElement | DocumentError]:
+    """
+    Iteratively yield elements, or an error if parsing fails. The document
+    occupies ``buf[start:end]`` (by default, all of ``buf``), and the
+    offsets of the elements are relative to ``start``. The buffer is never
+    sliced: elements are parsed in-place at increasing offsets.
+
+    If ``is_array`` is true, also checks that the keys are the array indices.
+    """
+    if end is None:
+        end = len(buf)
+    cur_offset = start + 4
+    array_idx = 0
+    while cur_offset < end:
+        elem = yield from _parse_one(buf, cur_offset, end)
+        if isinstance(elem, DocumentError):
+            # An error ocurred, so we can't reliably continue parsing
+            yield elem._replace(error_offset=elem.error_offset - start)
+            return
+        if elem.type == BSONType.EOD:
+            # This is the end.
+            cur_offset += 1
+            break
+        # Yield this one, and then advance to the next element:
+        yield elem._replace(value_offset=elem.value_offset - start)
+        if is_array:
+            # Validate that array keys are increasing integers:
+            expect_key = str(array_idx)
+            if elem.key != expect_key:
+                yield DocumentError(
+                    f"Array element must have incrementing integer keys "
+                    f'(Expected "{expect_key}", got "{elem.key}")',
+                    cur_offset - start,
+                )
+        array_idx += 1
+        cur_offset = elem.value_offset + elem.value_size
+    else:
+        if end > start:
+            yield DocumentError(f"Unexpected end-of-data", cur_offset - start)
+            return
+    # Check that we actually consumed the whole buffer:
+    remain = end - cur_offset
+    if remain > 0:
+        yield DocumentError(f"Extra {remain} bytes in document data", cur_offset - start)
+
+
+def _parse_one(
+    buf: bytes, elem_offset: int, end: int
+) -> Generator[DocumentError, None, DocumentElement | DocumentError]:
+    """
+    Parse the element that begins at ``elem_offset`` within ``buf``. The
+    element must end before ``end``. Offsets are relative to ``buf``.
+    """
+    try:
+        # Read the tag type
+        type_tag = BSONType(buf[elem_offset])
+    except ValueError:
+        # The tag byte is not a valid tag value
+        return DocumentError(f"Invalid element type tag 0x{buf[elem_offset]:x}", elem_offset)
+    # Stop if this is the end:
+    if type_tag == BSONType.EOD:
+        return DocumentElement(type_tag, "", elem_offset, 0)
+    # Find the null terminator on the key:
+    key_nulpos = buf.find(0, elem_offset + 1, end)
+    if key_nulpos < 0:
+        return DocumentError(f"Unexpected end-of-data while parsing the element key", elem_offset)
+    key_bytes = buf[elem_offset + 1 : key_nulpos]
+    try:
+        key = key_bytes.decode("utf-8")
+    except UnicodeDecodeError as e:
+        yield DocumentError(f"Element key {key_bytes} is not valid UTF-8 ({e})", elem_offset)
+        key = key_bytes.decode("utf-8", errors="replace")
+    # The absolute offset of the element's value within the buffer:
+    value_offset = key_nulpos + 1
+    # Get the fixed size of the element:
+    value_size = _FIXED_VALUE_SIZES.get(type_tag)
+    if value_size is not None:
+        pass  # This element has a fixed size
+    elif type_tag == BSONType.Regex:
+        # Size is dynamic and given as two C strings:
+        nul1 = buf.find(0, value_offset, end)
+        nul2 = buf.find(0, nul1 + 1, end) if nul1 >= 0 else -1
+        if nul2 < 0:
+            return DocumentError(f"Unexpected end-of-data while parsing a regular expression", elem_offset)
+        value_size = nul2 + 1 - value_offset
+    else:
+        if value_offset + 4 > end:
+            return DocumentError(f"Unexpected end-of-data while parsing a length prefix", elem_offset)
+        prefix = read_i32le(buf, value_offset)
+        if type_tag in (BSONType.Code, BSONType.Symbol, BSONType.UTF8):
+            # Size is 4 + a length prefix (which includes the null terminator)
+            value_size = prefix + 4 if prefix >= 1 else None
+        elif type_tag in (BSONType.Array, BSONType.Document, BSONType.CodeWithScope):
+            # Size is given by the length prefix
+            value_size = prefix if prefix >= 5 else None
+        elif type_tag == BSONType.DBPointer:
+            # Size is a length prefix, plus four, plus 12 bytes for the OID
+            value_size = prefix + 4 + 12 if prefix >= 1 else None
+        elif type_tag == BSONType.Binary:
+            # Size is a length prefix, plus four, plus one for the subtype
+            value_size = prefix + 4 + 1 if prefix >= 0 else None
+        else:
+            assert False, f"Unhandled value tag? {type_tag=} {elem_offset=} {key=}"
+        if value_size is None:
+            return DocumentError(f"Invalid length prefix {prefix} for element of type {type_tag.name}", elem_offset)
+    if value_offset + value_size > end:
+        return DocumentError(f"Element value extends beyond the end of the document", elem_offset)
+    return DocumentElement(type_tag, key, value_offset, value_size)
+
+
+def _parse_one_now(buf: bytes, elem_offset: int, end: int) -> DocumentElement | DocumentError:
+    """Parse the element at ``elem_offset`` like `_parse_one`, but ignore any non-fatal errors"""
+    gen = _parse_one(buf, elem_offset, end)
+    while True:
+        try:
+            next(gen)
+        except StopIteration as stop:
+            return stop.value
+
+
+_FIXED_SIZES_BY_TAG: dict[int, int] = {type.value: size for type, size in _FIXED_VALUE_SIZES.items()}
+"`_FIXED_VALUE_SIZES`, by the integer value of the type tag"
+
+_PREFIXED_SIZES_BY_TAG: dict[int, tuple[int, int]] = {
+    BSONType.UTF8.value: (4, 1),
+    BSONType.Code.value: (4, 1),
+    BSONType.Symbol.value: (4, 1),
+    BSONType.Document.value: (0, 5),
+    BSONType.Array.value: (0, 5),
+    BSONType.CodeWithScope.value: (0, 5),
+    BSONType.DBPointer.value: (4 + 12, 1),
+    BSONType.Binary.value: (4 + 1, 0),
+}
+"""
+For values that begin with a length prefix: The number of bytes to add to the
+prefix to get the size of the value, and the smallest valid prefix.
+"""
+
+
+class ElementIndex:
+    """
+    The offsets of the elements of a document, allowing random access to the
+    Nth element. The offsets are found by a light scan that only steps over
+    each element, and proceeds only as far as has been requested. Elements are
+    fully parsed only when they are accessed.
+
+    Unlike `parse_elements`, this does not check element keys, so non-fatal
+    errors (such as a misnumbered array) are not reported.
+    """
+
+    def __init__(self, buf: bytes, start: int = 0, end: int | None = None) -> None:
+        self._buf = buf
+        "The buffer that contains the document"
+        self._start = start
+        "The offset of the document within ``buf``"
+        self._end = len(buf) if end is None else end
+        "The offset of the end of the document within ``buf``"
+        self._offsets = array.array("Q")
+        "The offsets of the elements found so far, relative to ``buf``"
+        self._next = start + 4
+        "The offset of the next element to scan, or -1 if the scan is finished"
+        self._parsed: dict[int, DocumentElement] = {}
+        "The elements that have been parsed, by index"
+        self.error: DocumentError | None = None
+        "The error that stopped the scan, if any. This is only known once the scan reaches it"
+
+    def count_up_to(self, n: int) -> int:
+        """
+        Return the number of elements, or ``n`` if there are at least ``n``
+        elements. Does not scan past the first ``n`` elements.
+        """
+        if len(self._offsets) < n and self._next >= 0:
+            self._scan(n)
+        return min(len(self._offsets), n)
+
+    def __len__(self) -> int:
+        return self.count_up_to(sys.maxsize)
+
+    def __getitem__(self, idx: int) -> DocumentElement:
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or self.count_up_to(idx + 1) <= idx:
+            raise IndexError(idx)
+        elem = self._parsed.get(idx)
+        if elem is None:
+            parsed = _parse_one_now(self._buf, self._offsets[idx], self._end)
+            # The scan has already checked that this element is valid:
+            assert isinstance(parsed, DocumentElement), parsed
+            elem = self._parsed[idx] = parsed._replace(value_offset=parsed.value_offset - self._start)
+        return elem
+
+    def find(self, offset: int) -> int:
+        """
+        Get the index of the element that contains the byte at ``offset``
+        (relative to the start of the document). Returns the index of the last
+        element if ``offset`` is beyond it, or zero if it is before the first.
+        """
+        pos = self._start + offset
+        while self._next >= 0 and (not self._offsets or self._offsets[-1] <= pos):
+            self._scan(len(self._offsets) + 1024)
+        return max(0, bisect.bisect_right(self._offsets, pos) - 1)
+
+    def offset(self, idx: int) -> int:
+        """Get the offset of the element at ``idx``, relative to the start of the document"""
+        if self.count_up_to(idx + 1) <= idx:
+            raise IndexError(idx)
+        return self._offsets[idx] - self._start
+
+    def _scan(self, n: int) -> None:
+        """Scan forward until ``n`` elements have been found, or until the end of the document"""
+        buf, start, end, offsets = self._buf, self._start, self._end, self._offsets
+        find = buf.find
+        unpack_i32 = _I32LE.unpack_from
+        pos = self._next
+        while len(offsets) < n:
+            if pos >= end:
+                if end > start:
+                    self._stop(DocumentError("Unexpected end-of-data", pos - start))
+                else:
+                    self._stop(None)
+                return
+            tag = buf[pos]
+            if tag == 0:
+                # This is the end:
+                remain = end - (pos + 1)
+                self._stop(DocumentError(f"Extra {remain} bytes in document data", pos + 1 - start) if remain else None)
+                return
+            value_offset = find(0, pos + 1, end) + 1
+            size = _FIXED_SIZES_BY_TAG.get(tag)
+            if size is None and value_offset and tag in _PREFIXED_SIZES_BY_TAG and value_offset + 4 <= end:
+                extra, min_prefix = _PREFIXED_SIZES_BY_TAG[tag]
+                prefix = unpack_i32(buf, value_offset)[0]
+                if prefix >= min_prefix:
+                    size = prefix + extra
+            if size is None or not value_offset or value_offset + size > end:
+                # An unusual element (a regex), or an invalid one. Let the full parser deal with it:
+                elem = _parse_one_now(buf, pos, end)
+                if isinstance(elem, DocumentError):
+                    self._stop(elem._replace(error_offset=elem.error_offset - start))
+                    return
+                value_offset, size = elem.value_offset, elem.value_size
+            offsets.append(pos)
+            pos = value_offset + size
+        self._next = pos
+
+    def _stop(self, error: DocumentError | None) -> None:
+        self._next = -1
+        self.error = error
+
+
+class Decimal128Value(NamedTuple):
+    """Represents a parsed Decimal128 value"""
+
+    sign: int
+    combination: int
+    exponent: int
+    significand: int
+    spelling: str
+
+
+_U64X2LE = struct.Struct("<QQ")
+_I64LE = struct.Struct("<q")
+
+
+def decode_decimal128(dat: bytes) -> Decimal128Value:
+    """Decode the 16 bytes of a Decimal128 value into its parts"""
+    # The value is little-endian encoded:
+    return _decode_decimal128_bits(int.from_bytes(dat[:16], "little"))
+
+
+def decode_decimal128_at(buf: bytes, offsets: Iterable[int]) -> list[Decimal128Value]:
+    """
+    Decode the Decimal128 values at each of the ``offsets`` within ``buf``.
+    Values that occur more than once are only decoded once.
+    """
+    unpack = _U64X2LE.unpack_from
+    decoded: dict[int, Decimal128Value] = {}
+    ret: list[Decimal128Value] = []
+    for off in offsets:
+        low, high = unpack(buf, off)
+        bits = (high << 64) | low
+        val = decoded.get(bits)
+        if val is None:
+            val = decoded[bits] = _decode_decimal128_bits(bits)
+        ret.append(val)
+    return ret
+
+
+def _decode_decimal128_bits(bits: int) -> Decimal128Value:
+    """Decode a Decimal128 value, given as an unsigned 128-bit integer"""
+    sign = bits >> 127
+    spelling = None
+    # BID uses the first two combo bits to indicate that the exponent is shifted
+    if (bits >> 125) & 0b11 != 0b11:
+        # Regular bit positions:
+        exponent = (bits >> 113) & 0x3FFF
+        coeff = bits & ((1 << 113) - 1)
+    else:
+        # Bit positions are shifted over
+        exponent = (bits >> 111) & 0x3FFF
+        # The significand has an implicit '0b100' prepended as the highest bits:
+        coeff = (0b100 << 111) | (bits & ((1 << 111) - 1))
+        # Check for special values in the remainder of the combination:
+        more = (bits >> 122) & 0b111
+        if more in (0b100, 0b101):
+            spelling = "Infinity"
+        elif more == 0b110:
+            spelling = "NaN (quiet)"
+        elif more == 0b111:
+            spelling = "NaN (signaling)"
+
+    if spelling is None:
+        spelling = str(coeff)
+        e = exponent - 6176
+        if e == 0:
+            pass
+        elif e < 0:
+            spelling = spelling.zfill(abs(e))
+            split = len(spelling) + e
+            w, fr = spelling[:split], spelling[split:]
+            spelling = f"{w}.{fr}"
+        else:
+            spelling = spelling + "0" * e
+
+    if sign:
+        spelling = f"-{spelling}"
+
+    # The "combination" bits
+    combination = (bits >> 110) & 0x1FFFF
+    return Decimal128Value(sign, combination, exponent, coeff, spelling)
+
+
+def parse_regex(buf: bytes, offset: int = 0) -> tuple[bytes, bytes]:
+    """Get the pattern and the options of the regular expression at ``offset`` within ``buf``"""
+    # A regex is encoded with two C-strings. Find the nulls:
+    nulpos_1 = buf.index(0, offset)
+    nulpos_2 = buf.index(0, nulpos_1 + 1)
+    # Split them up:
+    return buf[offset:nulpos_1], buf[nulpos_1 + 1 : nulpos_2]
+
+
+def datetime_summary(millis: int) -> str:
+    """Get the summary string for a Datetime of ``millis`` milliseconds since the Unix epoch"""
+    seconds, millis_part = divmod(millis, 1000)
+    try:
+        s = _datetime_summary_prefix(seconds)
+    except (OverflowError, OSError, ValueError):
+        # Python cannot represent this date
+        return f"Date({millis})"
+    return f'Date("{s} +{millis_part * 1000:06}μs")'
+
+
+def datetime_summaries_at(buf: bytes, offsets: Iterable[int]) -> list[str]:
+    """Get the summary strings for the Datetime values at each of the ``offsets`` within ``buf``"""
+    unpack = _I64LE.unpack_from
+    return [datetime_summary(unpack(buf, off)[0]) for off in offsets]
+
+
+@functools.lru_cache(maxsize=4096)
+def _datetime_summary_prefix(seconds: int) -> str:
+    """
+    Format the whole seconds of a Datetime summary. Consecutive values in
+    time-series data often share the same second, so these are memoized.
+    """
+    return f"{datetime.fromtimestamp(seconds):%a %b %m %Y %H:%M:%S}"
+
+
+def datetime_fields(millis: int) -> dict[str, str | int]:
+    """Get the detailed breakdown of a Datetime of ``millis`` milliseconds since the Unix epoch"""
+    # We can create a rich display using Python's datetime parsing:
+    dt = datetime.fromtimestamp(millis / 1000)
+    # Adjusted to the local time zone:
+    adjusted = dt.astimezone()
+    return {
+        "[isoformat]": dt.isoformat(),
+        "[date]": f"{dt:%B %d, %Y}",
+        "[time]": dt.strftime("%H:%M:%S +%fμs"),
+        "[local]": adjusted.strftime("%c"),
+        "Year": dt.year,
+        "Month": dt.month,
+        "Day": dt.day,
+        "Hour": dt.hour,
+        "Minute": dt.minute,
+        "Second": dt.second,
+        "+μs": dt.microsecond,
+    }
+
+
+def iter_extjson(
+    buf: bytes, *, relaxed: bool = True, start: int = 0, end: int | None = None, is_array: bool = False
+) -> Iterator[str]:
+    """
+    Encode the document in ``buf[start:end]`` as Extended JSON, yielding the
+    text in fragments as the document is parsed. This works on the raw bytes,
+    without creating any SBValues.
+
+    If ``relaxed`` is true, generates Relaxed Extended JSON, otherwise
+    generates Canonical Extended JSON. Raises ValueError if the data does not
+    parse as a document.
+    """
+    yield "[" if is_array else "{"
+    first = True
+    for elem in parse_elements(buf, start, end, is_array=is_array):
+        if isinstance(elem, DocumentError):
+            raise ValueError(f"{elem.message} (at offset {start + elem.error_offset})")
+        if not first:
+            yield ", "
+        first = False
+        if not is_array:
+            yield f"{json.dumps(elem.key, ensure_ascii=False)}: "
+        yield from _iter_extjson_value(buf, elem.type, start + elem.value_offset, elem.value_size, relaxed)
+    yield "]" if is_array else "}"
+
+
+def _iter_extjson_value(buf: bytes, type: BSONType, offset: int, size: int, relaxed: bool) -> Iterator[str]:
+    """Encode the element value of the given type that occupies ``size`` bytes at ``offset``"""
+    end = offset + size
+    if type in (BSONType.Document, BSONType.Array):
+        yield from iter_extjson(buf, relaxed=relaxed, start=offset, end=end, is_array=type == BSONType.Array)
+    elif type == BSONType.CodeWithScope:
+        code = _read_string(buf, offset + 4)
+        yield f'{{"$code": {json.dumps(code, ensure_ascii=False)}, "$scope": '
+        yield from iter_extjson(buf, relaxed=relaxed, start=offset + 4 + 4 + read_i32le(buf, offset + 4), end=end)
+        yield "}"
+    else:
+        yield json.dumps(_extjson_scalar(buf, type, offset, relaxed), ensure_ascii=False)
+
+
+def _extjson_scalar(buf: bytes, type: BSONType, offset: int, relaxed: bool) -> Any:
+    """Decode a non-document element value into the equivalent JSON-compatible value"""
+    if type == BSONType.Double:
+        val: float = struct.unpack_from("<d", buf, offset)[0]
+        if math.isnan(val):
+            return {"$numberDouble": "NaN"}
+        if math.isinf(val):
+            return {"$numberDouble": "Infinity" if val > 0 else "-Infinity"}
+        if relaxed:
+            return val
+        spelling = repr(val).upper()
+        mantissa, e, exponent = spelling.partition("E")
+        if "." not in mantissa:
+            mantissa += ".0"
+        return {"$numberDouble": f"{mantissa}{e}{exponent}"}
+    if type in (BSONType.UTF8, BSONType.Code, BSONType.Symbol):
+        string = _read_string(buf, offset)
+        if type == BSONType.Code:
+            return {"$code": string}
+        if type == BSONType.Symbol:
+            return {"$symbol": string}
+        return string
+    if type == BSONType.Binary:
+        data_size = read_i32le(buf, offset)
+        subtype = buf[offset + 4]
+        data = buf[offset + 5 : offset + 5 + data_size]
+        if subtype == 2 and data_size >= 4:
+            # The old binary subtype has a redundant inner length prefix
+            data = data[4:]
+        return {"$binary": {"base64": base64.b64encode(data).decode(), "subType": f"{subtype:02x}"}}
+    if type == BSONType.ObjectID:
+        return {"$oid": buf[offset : offset + 12].hex()}
+    if type == BSONType.Bool:
+        return buf[offset] != 0
+    if type == BSONType.Datetime:
+        millis: int = struct.unpack_from("<q", buf, offset)[0]
+        if relaxed and 0 <= millis < 253402300800000:
+            # Years 1970 through 9999 are given as ISO-8601 strings
+            dt = datetime(1970, 1, 1) + timedelta(milliseconds=millis)
+            frac = f".{dt.microsecond // 1000:03}" if dt.microsecond else ""
+            return {"$date": f"{dt:%Y-%m-%dT%H:%M:%S}{frac}Z"}
+        return {"$date": {"$numberLong": str(millis)}}
+    if type == BSONType.Regex:
+        nul1 = buf.index(0, offset)
+        nul2 = buf.index(0, nul1 + 1)
+        pattern = buf[offset:nul1].decode("utf-8", errors="replace")
+        options = buf[nul1 + 1 : nul2].decode("utf-8", errors="replace")
+        return {"$regularExpression": {"pattern": pattern, "options": options}}
+    if type == BSONType.DBPointer:
+        ref = _read_string(buf, offset)
+        oid_offset = offset + 4 + read_i32le(buf, offset)
+        return {"$dbPointer": {"$ref": ref, "$id": {"$oid": buf[oid_offset : oid_offset + 12].hex()}}}
+    if type == BSONType.Int32:
+        int32 = read_i32le(buf, offset)
+        return int32 if relaxed else {"$numberInt": str(int32)}
+    if type == BSONType.Int64:
+        int64: int = struct.unpack_from("<q", buf, offset)[0]
+        return int64 if relaxed else {"$numberLong": str(int64)}
+    if type == BSONType.Timestamp:
+        increment, timestamp = struct.unpack_from("<II", buf, offset)
+        return {"$timestamp": {"t": timestamp, "i": increment}}
+    if type == BSONType.Decimal128:
+        return {"$numberDecimal": _decimal128_to_string(buf[offset : offset + 16])}
+    if type == BSONType.Null:
+        return None
+    if type == BSONType.Undefined:
+        return {"$undefined": True}
+    if type == BSONType.MinKey:
+        return {"$minKey": 1}
+    if type == BSONType.MaxKey:
+        return {"$maxKey": 1}
+    assert False, f"Unhandled type tag? {type=}"
+
+
+def _read_string(buf: bytes, offset: int) -> str:
+    """Decode the length-prefixed and null-terminated string at ``offset``"""
+    strlen = read_i32le(buf, offset)
+    return buf[offset + 4 : offset + 4 + strlen - 1].decode("utf-8", errors="replace")
+
+
+def _decimal128_to_string(dat: bytes) -> str:
+    """Convert an encoded Decimal128 to its string representation, as given by the Decimal128 specification"""
+    bits = int.from_bytes(dat, "little")
+    sign = bits >> 127
+    combination = (bits >> 122) & 0x1F
+    if combination == 0x1F:
+        return "NaN"
+    if combination == 0x1E:
+        return "-Infinity" if sign else "Infinity"
+    if (bits >> 125) & 0x3 == 0x3:
+        # The significand would have an implied '0b100' prefix, which always
+        # exceeds the maximum significand, and is therefore treated as zero.
+        exponent = (bits >> 111) & 0x3FFF
+        coeff = 0
+    else:
+        exponent = (bits >> 113) & 0x3FFF
+        coeff = bits & ((1 << 113) - 1)
+        if coeff > 10**34 - 1:
+            coeff = 0
+    # The decimal module implements the same to-scientific-string conversion:
+    digits = tuple(int(c) for c in str(coeff))
+    return str(decimal.Decimal((sign, digits, exponent - 6176)))
+
+
+def preview_document(
+    buf: bytes, size: int, *, is_array: bool = False, max_elements: int = 3, max_string: int = 32
+) -> str:
+    """
+    Render a short, one-line preview of the document of ``size`` bytes that
+    begins at the start of ``buf``. Only the first ``max_elements`` elements are
+    shown, and nested documents are elided, so ``buf`` may hold only a prefix
+    of the document.
+    """
+    end = min(len(buf), size)
+    parts: list[str] = []
+    for elem in parse_elements(buf, 0, end, is_array=is_array):
+        if isinstance(elem, DocumentError):
+            # If we only have part of the document, the remaining elements are just cut off
+            parts.append("…" if end < size else "<invalid>")
+            break
+        if len(parts) == max_elements:
+            parts.append("…")
+            break
+        value = _preview_value(buf, elem, max_string)
+        parts.append(value if is_array else f"{json.dumps(elem.key, ensure_ascii=False)}: {value}")
+    joined = ", ".join(parts)
+    return f"[{joined}]" if is_array else f"{{{joined}}}"
+
+
+def _preview_value(buf: bytes, elem: DocumentElement, max_string: int) -> str:
+    """Render the value of ``elem`` for `preview_document`"""
+    if elem.type in (BSONType.Document, BSONType.CodeWithScope):
+        return "{}" if elem.value_size == 5 else "{…}"
+    if elem.type == BSONType.Array:
+        return "[]" if elem.value_size == 5 else "[…]"
+    if elem.type == BSONType.UTF8:
+        string = _read_string(buf, elem.value_offset)
+        if len(string) > max_string:
+            string = string[:max_string] + "…"
+        return json.dumps(string, ensure_ascii=False)
+    return json.dumps(_extjson_scalar(buf, elem.type, elem.value_offset, True), ensure_ascii=False)
+
+
+class DocumentSnapshot:
+    """
+    A copy of the data of a document, for comparing with later versions using
+    `diff_documents`. The element indexes of the document and its
+    subdocuments are kept, so they are only built once.
+    """
+
+    def __init__(self, data: bytes) -> None:
+        self.data = bytes(data)
+        "The document data"
+        self._indexes: dict[int, ElementIndex] = {}
+        "The element indexes of the document and its subdocuments, by their offset"
+        # Index the top-level elements now, rather than during the first comparison:
+        len(self.index(0, len(self.data)))
+
+    def index(self, start: int, end: int) -> ElementIndex:
+        """Get the element index of the (sub)document in ``data[start:end]``"""
+        index = self._indexes.get(start)
+        if index is None:
+            index = self._indexes[start] = ElementIndex(self.data, start, end)
+        return index
+
+
+class DocumentChange(NamedTuple):
+    """A difference between two versions of a document, found by `diff_documents`"""
+
+    kind: str
+    'One of "added", "removed", or "changed"'
+    path: str
+    "The path to the element, such as ``cursor.firstBatch[3]``"
+    old: str | None
+    "The old value, as Relaxed Extended JSON (``None`` if it was added)"
+    new: str | None
+    "The new value, as Relaxed Extended JSON (``None`` if it was removed)"
+
+
+def diff_documents(old: DocumentSnapshot, new: bytes) -> Iterator[DocumentChange]:
+    """
+    Find the elements that differ between the ``old`` version of a document
+    and the ``new`` data. Raises ValueError if either version is invalid.
+
+    Unchanged data is never parsed: each (sub)document is first compared as
+    a whole, and if it differs, only the elements between the first and last
+    differing bytes are parsed. Changed subdocuments are compared the same way.
+    """
+    return _diff_range(old, 0, len(old.data), new, 0, len(new), False, "")
+
+
+def _diff_range(
+    old: DocumentSnapshot, o_start: int, o_end: int, new: bytes, n_start: int, n_end: int, is_array: bool, path: str
+) -> Iterator[DocumentChange]:
+    """Diff the document in ``old.data[o_start:o_end]`` with the one in ``new[n_start:n_end]``"""
+    old_data = old.data
+    old_len = o_end - o_start
+    new_len = n_end - n_start
+    if old_len == new_len and old_data[o_start:o_end] == new[n_start:n_end]:
+        return
+    # Find the unchanged data at either end. (Skip the length header, which differs if the lengths differ):
+    shorter = min(old_len, new_len)
+    prefix = 4 + _common_prefix_length(old_data, o_start + 4, new, n_start + 4, shorter - 4)
+    suffix = _common_suffix_length(old_data, o_end, new, n_end, shorter - prefix)
+    # The elements that end before the first difference are unchanged, and the
+    # next element begins at the same offset in both versions:
+    old_index = old.index(o_start, o_end)
+    first = old_index.find(prefix)
+    pos = old_index.offset(first) if old_index.count_up_to(1) else 4
+    # Collect the elements of each version from there, until they line up
+    # again within the unchanged data at the end:
+    delta = new_len - old_len
+    old_pos, new_pos = pos, pos
+    old_elems: list[DocumentElement] = []
+    new_elems: list[DocumentElement] = []
+    while not (old_pos + delta == new_pos and old_pos >= old_len - suffix and new_pos >= new_len - suffix):
+        old_done = old_pos >= old_len - 1
+        new_done = new_pos >= new_len - 1
+        if old_done and new_done:
+            break
+        if not old_done and (new_done or old_pos + delta <= new_pos):
+            elem = _diff_element_at(old_data, o_start, old_pos, o_end)
+            old_elems.append(elem)
+            old_pos = elem.value_offset + elem.value_size
+        else:
+            elem = _diff_element_at(new, n_start, new_pos, n_end)
+            new_elems.append(elem)
+            new_pos = elem.value_offset + elem.value_size
+    # Match up the elements by key:
+    new_by_key = {elem.key: elem for elem in reversed(new_elems)}
+    old_keys = set()
+    for o_elem in old_elems:
+        old_keys.add(o_elem.key)
+        elem_path = _diff_path(path, o_elem.key, is_array)
+        n_elem = new_by_key.get(o_elem.key)
+        if n_elem is None:
+            yield DocumentChange("removed", elem_path, _diff_value(old_data, o_start, o_elem), None)
+            continue
+        o_value = (o_start + o_elem.value_offset, o_start + o_elem.value_offset + o_elem.value_size)
+        n_value = (n_start + n_elem.value_offset, n_start + n_elem.value_offset + n_elem.value_size)
+        if o_elem.type == n_elem.type and o_elem.type in (BSONType.Document, BSONType.Array):
+            yield from _diff_range(old, *o_value, new, *n_value, o_elem.type == BSONType.Array, elem_path)
+        elif o_elem.type != n_elem.type or old_data[slice(*o_value)] != new[slice(*n_value)]:
+            yield DocumentChange(
+                "changed", elem_path, _diff_value(old_data, o_start, o_elem), _diff_value(new, n_start, n_elem)
+            )
+    for n_elem in new_elems:
+        if n_elem.key not in old_keys:
+            yield DocumentChange(
+                "added", _diff_path(path, n_elem.key, is_array), None, _diff_value(new, n_start, n_elem)
+            )
+
+
+def _common_prefix_length(a: bytes, a_start: int, b: bytes, b_start: int, limit: int) -> int:
+    """Get the length of the common prefix of ``a[a_start:]`` and ``b[b_start:]``, up to ``limit``"""
+    # Binary search, comparing ever-smaller chunks:
+    lo, hi = 0, max(0, limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[a_start + lo : a_start + mid] == b[b_start + lo : b_start + mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix_length(a: bytes, a_end: int, b: bytes, b_end: int, limit: int) -> int:
+    """Get the length of the common suffix of ``a[:a_end]`` and ``b[:b_end]``, up to ``limit``"""
+    lo, hi = 0, max(0, limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[a_end - mid : a_end - lo] == b[b_end - mid : b_end - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _diff_element_at(buf: bytes, start: int, pos: int, end: int) -> DocumentElement:
+    """Parse the element at offset ``pos`` of the document in ``buf[start:end]``, with offsets relative to ``start``"""
+    elem = _parse_one_now(buf, start + pos, end)
+    if isinstance(elem, DocumentError):
+        raise ValueError(f"{elem.message} (at offset {elem.error_offset})")
+    if elem.type == BSONType.EOD:
+        raise ValueError(f"Unexpected end of document (at offset {start + pos})")
+    return elem._replace(value_offset=elem.value_offset - start)
+
+
+def _diff_path(path: str, key: str, is_array: bool) -> str:
+    """Append an element's key to the path of its parent"""
+    if is_array:
+        return f"{path}[{key}]"
+    if not key.isidentifier():
+        return f"{path}[{json.dumps(key, ensure_ascii=False)}]"
+    return f"{path}.{key}" if path else key
+
+
+def _diff_value(buf: bytes, start: int, elem: DocumentElement) -> str:
+    """Render the value of an element for a DocumentChange"""
+    return "".join(_iter_extjson_value(buf, elem.type, start + elem.value_offset, elem.value_size, True))